@@ -0,0 +1,297 @@
+from __future__ import annotations
+import asyncio
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import anyio
+from loguru import logger
+from peewee import Database
+
+import database
+from database import db, QuoteKey
+from quote_usage import QuoteUsage
+from limiters import InstrumentedLimiter, db_limiter
+
+T = TypeVar("T")
+_Job = Tuple[
+    Callable[..., Any], Tuple[Any, ...], asyncio.Future, asyncio.AbstractEventLoop
+]
+
+
+def _set_result(future: asyncio.Future, result: Any) -> None:
+    if not future.cancelled():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: BaseException) -> None:
+    if not future.cancelled():
+        future.set_exception(exception)
+
+
+class DatabaseThread:
+    """Runs all database work on one dedicated thread that owns the database connection.
+
+    Jobs are put into a queue and every caller gets an awaitable future for its result,
+    so no anyio worker thread is needed per query.
+    If a limiter is given, every job holds one of its tokens until it is done, which bounds the queue
+    and makes the waiting time measurable."""
+
+    def __init__(
+        self,
+        database_: Database,
+        name: str = "database",
+        limiter: Optional[InstrumentedLimiter] = None,
+    ) -> None:
+        self._database = database_
+        self._name = name
+        self.limiter = limiter
+        self._jobs: queue.SimpleQueue[Optional[_Job]] = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def queue_size(self) -> int:
+        """How many jobs are waiting for the database thread."""
+        return self._jobs.qsize()
+
+    def start(self) -> None:
+        """Starts the database thread, which also opens the database connection.
+
+        This blocks until the connection is open.
+        :raises: The error of the connection if it couldn't be opened, the thread is not running then.
+        """
+        if self.running:
+            return
+        connected = threading.Event()
+        errors: List[BaseException] = []
+        self._thread = threading.Thread(
+            target=self._work, args=(connected, errors), name=self._name, daemon=True
+        )
+        self._thread.start()
+        connected.wait()
+        if errors:
+            # The thread ends right away, so no job can be left waiting for it.
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+
+    def _work(self, connected: threading.Event, errors: List[BaseException]) -> None:
+        # The connection belongs to this thread, so it has to be opened here.
+        try:
+            self._database.connect(reuse_if_open=True)
+        except BaseException as ex:  # pylint: disable=broad-except
+            errors.append(ex)
+            return
+        finally:
+            connected.set()
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                func, args, future, loop = job
+                if future.cancelled():
+                    continue
+                try:
+                    result = func(*args)
+                except BaseException as ex:  # pylint: disable=broad-except
+                    loop.call_soon_threadsafe(_set_exception, future, ex)
+                else:
+                    loop.call_soon_threadsafe(_set_result, future, result)
+        finally:
+            self._database.close()
+            logger.debug("The database thread stopped.")
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs func(*args) on the database thread and waits for the result.
+
+        :raises: RuntimeError if the database thread isn't running.
+        """
+        if not self.running:
+            raise RuntimeError("The database thread is not running.")
+        if self.limiter is None:
+            return await self._submit(func, *args)
+        async with self.limiter.slot():
+            return await self._submit(func, *args)
+
+    async def _submit(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        self._jobs.put((func, args, future, loop))
+        return await future  # type: ignore[no-any-return]
+
+    def stop(self) -> None:
+        """Lets the database thread finish the queued jobs and then closes the connection.
+
+        This blocks until the thread is done."""
+        if self._thread is None:
+            return
+        self._jobs.put(None)
+        self._thread.join()
+        self._thread = None
+
+
+db_thread = DatabaseThread(db, limiter=db_limiter)
+
+
+class _Write:
+    """A single write that waits for the commit of its batch."""
+
+    def __init__(self, func: Callable[..., Any], args: Tuple[Any, ...]) -> None:
+        self.func = func
+        self.args = args
+        # Set once the write is committed, or once it is its turn to commit the next batch.
+        self.done = anyio.Event()
+        self.lead = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class GroupCommitQueue:
+    """Collects writes and commits them together in one transaction on the database thread (group commit).
+
+    While one transaction is being committed, the writes that come in wait and then share the next one,
+    so an idle database commits a write right away, but a busy one needs far fewer commits.
+    The first waiting write commits the next batch for everyone, with at most `max_batch_size` writes.
+    `window` adds a wait before each commit to let more writes join, at the cost of latency.
+    Every write runs in its own savepoint, so a failing write only fails for its caller."""
+
+    def __init__(
+        self, thread: DatabaseThread, window: float = 0.0, max_batch_size: int = 100
+    ) -> None:
+        if window < 0:
+            raise ValueError("The commit window can't be negative.")
+        if max_batch_size < 1:
+            raise ValueError("The maximum batch size must be at least 1.")
+        self._thread = thread
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[_Write] = []
+        self._committing = False
+        self.writes = 0  # How many writes were committed or failed.
+        self.commits = 0  # How many transactions were committed.
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs func(*args) on the database thread as part of the next group commit.
+
+        Once queued, the write happens even if the caller is cancelled, so it can't be cancelled.
+        :return: The result of func, once it is committed.
+        :raises: Whatever func raised, the other writes of the batch are not affected.
+        """
+        write = _Write(func, args)
+        self._pending.append(write)
+        # Other writes may be waiting for this one to commit their batch.
+        with anyio.CancelScope(shield=True):
+            if self._committing:
+                await write.done.wait()
+            else:
+                self._committing = True
+                write.lead = True
+            if write.lead:
+                await self._commit_next()
+        if write.error is not None:
+            raise write.error
+        return write.result  # type: ignore[no-any-return]
+
+    async def _commit_next(self) -> None:
+        """Commits the next batch of pending writes and hands over to the first write that is left."""
+        if self.window > 0:
+            await anyio.sleep(self.window)
+        batch = self._pending[: self.max_batch_size]
+        del self._pending[: len(batch)]
+        try:
+            results = await self._thread.run(
+                database.run_in_transaction,
+                [(write.func, write.args) for write in batch],
+            )
+            for write, (error, result) in zip(batch, results):
+                write.error = error
+                write.result = result
+            self.commits += 1
+        except Exception as ex:  # pylint: disable=broad-except
+            for write in batch:
+                write.error = ex
+        finally:
+            self.writes += len(batch)
+            if len(batch) > 1:
+                logger.debug(f"Committed {len(batch)} writes together.")
+            for write in batch:
+                write.lead = False
+                write.done.set()
+            if self._pending:
+                self._pending[0].lead = True
+                self._pending[0].done.set()
+            else:
+                self._committing = False
+
+    @property
+    def mean_batch_size(self) -> float:
+        """How many writes shared a commit on average."""
+        return self.writes / self.commits if self.commits else 0.0
+
+
+write_queue = GroupCommitQueue(db_thread)
+
+
+async def get_quotes(keys: List[QuoteKey]) -> Dict[QuoteKey, Optional[str]]:
+    """Gets the quotes for many (guild id, keyword) pairs with a single query."""
+    return await db_thread.run(database.resolve_quotes, keys)
+
+
+async def add_quote(guild_id: int, keyword: str, text: str, author_id: int) -> None:
+    """Saves a quote to the database, replacing an older one with the same keyword."""
+    await write_queue.run(database.add_quote, guild_id, keyword, text, author_id)
+
+
+async def add_global_quote(
+    keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+) -> bool:
+    """Saves a global quote and returns whether it did.
+
+    Unless overwrite is set, an existing global quote with that keyword is kept."""
+    return await write_queue.run(
+        database.add_global_quote, keyword, text, author_id, overwrite
+    )
+
+
+async def delete_quote(guild_id: int, keyword: str) -> bool:
+    """Deletes a quote of a guild and returns whether there was one."""
+    return await write_queue.run(database.delete_quote, guild_id, keyword)
+
+
+async def list_keywords_page(
+    guild_id: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: Optional[str] = None,
+    limit: int = 50,
+) -> List[str]:
+    """Gets one page of the keywords of a guild in alphabetical order, see database.list_keywords_page."""
+    return await db_thread.run(
+        database.list_keywords_page, guild_id, after, before, start, limit
+    )
+
+
+async def search_quotes(
+    guild_id: int, text: str, limit: int = 10
+) -> List[Tuple[str, str]]:
+    """Searches the quotes of a guild by keyword and text, see database.search_quotes."""
+    return await db_thread.run(database.search_quotes, guild_id, text, limit)
+
+
+async def record_usage(usages: List[QuoteUsage]) -> None:
+    """Adds the usage statistics of many quotes in one transaction."""
+    await db_thread.run(database.record_usage, usages)
+
+
+async def list_keywords(guild_id: int) -> List[str]:
+    """Gets the keywords of all quotes of a guild."""
+    return await db_thread.run(database.list_keywords, guild_id)
+
+
+async def set_quotes_anywhere(guild_id: int, enabled: bool) -> None:
+    """Saves whether quotes trigger anywhere in messages of that guild."""
+    await write_queue.run(database.set_quotes_anywhere, guild_id, enabled)
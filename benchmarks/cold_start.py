@@ -0,0 +1,113 @@
+"""Measures how long it takes after a start until the first quote is answered from the in-memory quote index.
+
+Run it from the repository root with `python -m benchmarks.cold_start`.
+It compares loading the index from the database with loading it from a quote snapshot.
+Both use a temporary database and snapshot file, so bot.db is not touched.
+The files were just written, so both are read from the page cache, like after a restart."""
+from __future__ import annotations
+import argparse
+import random
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Set, Tuple
+
+from database import (
+    db,
+    Quote,
+    GuildSettings,
+    QuoteIndex,
+    QuotePrefilter,
+    configure_database,
+    migrate_database,
+    import_quotes,
+    read_quotes,
+    read_anywhere_guilds,
+)
+from quote_snapshot import dump_snapshot, read_snapshot, write_snapshot
+
+
+def _fill_database(quotes: int, guilds: int) -> Tuple[int, str]:
+    random.seed(42)
+    rows = []
+    for number in range(quotes):
+        keyword = "".join(random.choices(string.ascii_lowercase, k=10))
+        rows.append(
+            {
+                "guildId": number % guilds,
+                "keyword": keyword,
+                "result": " ".join(random.choices(string.ascii_letters, k=40)),
+                "authorId": 1,
+            }
+        )
+        if len(rows) == 1000:
+            import_quotes(rows)
+            rows = []
+    import_quotes(rows)
+    guild_id, keyword = Quote.select(Quote.guildId, Quote.keyword).tuples().get()
+    return guild_id, keyword
+
+
+def _time_to_first_quote(
+    load: Callable[[], Tuple[Dict[int, Dict[str, str]], Set[int]]],
+    guild_id: int,
+    keyword: str,
+) -> Tuple[float, float]:
+    """Starts with an empty index and measures until a quote can be answered.
+
+    :return: The seconds for loading and for the whole start until the first answer.
+    """
+    index = QuoteIndex(QuotePrefilter())
+    started = time.perf_counter()
+    guilds, anywhere_guilds = load()
+    loaded = time.perf_counter()
+    index.replace(guilds, anywhere_guilds)
+    assert index.get(guild_id, keyword) is not None
+    return loaded - started, time.perf_counter() - started
+
+
+def main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        configure_database("performance", str(Path(directory) / "bench.db"))
+        db.connect()
+        db.create_tables([Quote, GuildSettings])
+        migrate_database()
+        guild_id, keyword = _fill_database(args.quotes, args.guilds)
+        snapshot_path = Path(directory) / "quotes.snapshot"
+
+        started = time.perf_counter()
+        data = dump_snapshot("sqlite", read_quotes(), read_anywhere_guilds())
+        write_snapshot(snapshot_path, data)
+        print(
+            f"Snapshot of {args.quotes} quotes: {len(data) / 1024 / 1024:.1f} MB, "
+            f"written in {(time.perf_counter() - started) * 1000:.0f}ms."
+        )
+
+        def from_database() -> Tuple[Dict[int, Dict[str, str]], Set[int]]:
+            return read_quotes(), read_anywhere_guilds()
+
+        def from_snapshot() -> Tuple[Dict[int, Dict[str, str]], Set[int]]:
+            snapshot = read_snapshot(snapshot_path, "sqlite")
+            assert snapshot is not None
+            return snapshot.guilds, snapshot.anywhere_guilds
+
+        for name, load in (("database", from_database), ("snapshot", from_snapshot)):
+            timings = [
+                _time_to_first_quote(load, guild_id, keyword)
+                for _ in range(args.repeat)
+            ]
+            load_time, first_quote = min(timings, key=lambda timing: timing[1])
+            print(
+                f"{name:<9} load={load_time * 1000:8.1f}ms first quote after {first_quote * 1000:8.1f}ms "
+                f"(best of {args.repeat})"
+            )
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quotes", type=int, default=100_000)
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
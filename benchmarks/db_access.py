@@ -0,0 +1,103 @@
+"""Compares the per query latency of the database thread with one anyio worker thread hop per query.
+
+Run it from the repository root with `python -m benchmarks.db_access`.
+It uses a temporary database, so bot.db is not touched."""
+from __future__ import annotations
+import argparse
+import random
+import statistics
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, List
+
+import anyio
+
+from database import db, Quote, resolve_quote
+from async_database import db_thread
+
+
+def _fill_database(quote_count: int, guild_count: int) -> List[str]:
+    keywords = [
+        "".join(random.choices(string.ascii_lowercase, k=8)) for _ in range(quote_count)
+    ]
+    rows = [
+        {
+            "guildId": random.randrange(guild_count),
+            "keyword": keyword,
+            "result": keyword.upper(),
+            "authorId": 1,
+        }
+        for keyword in keywords
+    ]
+    with db.atomic():
+        for start in range(0, len(rows), 500):
+            Quote.insert_many(rows[start : start + 500]).execute()
+    return keywords
+
+
+async def _measure(
+    name: str,
+    lookup: Callable[[int, str], Awaitable[object]],
+    keywords: List[str],
+    guild_count: int,
+    queries: int,
+    concurrency: int,
+) -> None:
+    latencies: List[float] = []
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            keyword = random.choice(keywords)
+            start = time.perf_counter()
+            await lookup(random.randrange(guild_count), keyword)
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    async with anyio.create_task_group() as task_group:
+        for _ in range(concurrency):
+            task_group.start_soon(worker, queries // concurrency)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        f"{name:<16} concurrency={concurrency:<3} "
+        f"mean={statistics.mean(latencies) * 1e6:8.1f}us "
+        f"p50={latencies[len(latencies) // 2] * 1e6:8.1f}us "
+        f"p99={latencies[int(len(latencies) * 0.99)] * 1e6:8.1f}us "
+        f"throughput={len(latencies) / elapsed:8.0f}/s"
+    )
+
+
+async def _main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db.init(str(Path(directory) / "bench.db"))
+        db.connect()
+        db.create_tables([Quote])
+        keywords = _fill_database(args.quotes, args.guilds)
+        db.close()
+        db_thread.start()
+
+        async def thread_hop(guild_id: int, keyword: str) -> object:
+            return await anyio.to_thread.run_sync(resolve_quote, guild_id, keyword)
+
+        async def database_thread(guild_id: int, keyword: str) -> object:
+            return await db_thread.run(resolve_quote, guild_id, keyword)
+
+        for concurrency in (1, 10, 50):
+            for name, lookup in (
+                ("to_thread", thread_hop),
+                ("database thread", database_thread),
+            ):
+                await _measure(
+                    name, lookup, keywords, args.guilds, args.queries, concurrency
+                )
+        db_thread.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quotes", type=int, default=10_000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=5_000)
+    anyio.run(_main, parser.parse_args(), backend="asyncio")
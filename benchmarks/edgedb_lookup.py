@@ -0,0 +1,129 @@
+"""Measures how the time to resolve a quote trigger in EdgeDB grows with the number of quotes in a guild.
+
+Run it from the repository root with `python -m benchmarks.edgedb_lookup [--edgedb INSTANCE] [--explain]`.
+Run it before and after `edgedb migrate` applies 00008 to see what the exclusive constraint on (guild, keyword)
+changes, --explain also prints the query plan of getquote.edgeql at every size (needs EdgeDB 3 or newer).
+The quotes are seeded with a plain INSERT, so the benchmark works without the constraint as well.
+Everything happens inside one transaction that is rolled back at the end, so the instance keeps no benchmark data."""
+from __future__ import annotations
+import argparse
+import random
+import statistics
+import string
+import time
+from typing import List
+
+import anyio
+import edgedb
+
+from queries import edgeql_queries
+from queries.registry import AsyncQuerySource
+
+
+# Seeds quotes without an UNLESS CONFLICT clause, which would need the constraint of migration 00008.
+# The keywords are random, so there are no duplicates to skip.
+_SEED_QUOTES = """
+WITH guild := (SELECT Guild FILTER .discord_id = <std::bigint>$guild_id LIMIT 1),
+    author := (SELECT User FILTER .discord_id = 1 LIMIT 1)
+FOR keyword IN {array_unpack(<array<str>>$keywords)}
+UNION (
+    INSERT GuildQuote {
+        keyword := <bounded_str>keyword,
+        quote_text := str_upper(keyword),
+        created_by := author,
+        guild := guild,
+    }
+);
+"""
+
+
+class _Rollback(Exception):
+    """Raised to roll back the benchmark transaction."""
+
+
+def _random_keyword() -> str:
+    return "".join(random.choices(string.ascii_lowercase, k=12))
+
+
+async def _measure(
+    tx: AsyncQuerySource, guild_id: int, keywords: List[str], lookups: int
+) -> List[float]:
+    latencies: List[float] = []
+    for _ in range(lookups):
+        # Every fifth lookup misses, like most messages in a real chat.
+        keyword = (
+            _random_keyword() if random.random() < 0.2 else random.choice(keywords)
+        )
+        started = time.perf_counter()
+        await edgeql_queries.get_quote(tx, keyword, guild_id=guild_id)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return latencies
+
+
+async def _benchmark(tx: AsyncQuerySource, args: argparse.Namespace) -> None:
+    random.seed(42)
+    # The guild id is random, so a shared EdgeDB instance doesn't get mixed up with real guilds.
+    guild_id = random.randrange(10**17, 10**18)
+    await edgeql_queries.registry["import_users"](tx, user_ids=[1])
+    await edgeql_queries.registry["import_guilds"](tx, guild_ids=[guild_id])
+    keywords: List[str] = []
+    for size in args.sizes:
+        new_keywords = [_random_keyword() for _ in range(size - len(keywords))]
+        for start in range(0, len(new_keywords), 1000):
+            await tx.query(
+                _SEED_QUOTES,
+                guild_id=guild_id,
+                keywords=new_keywords[start : start + 1000],
+            )
+        keywords += new_keywords
+        latencies = await _measure(tx, guild_id, keywords, args.lookups)
+        print(
+            f"{size:>8} quotes: mean={statistics.mean(latencies) * 1e6:9.1f}us "
+            f"p50={latencies[len(latencies) // 2] * 1e6:9.1f}us "
+            f"p99={latencies[int(len(latencies) * 0.99)] * 1e6:9.1f}us"
+        )
+        if args.explain:
+            # This shows whether the lookup seeks the index of the constraint or scans the quotes of the guild.
+            plan = await tx.query_single(
+                "analyze " + edgeql_queries.registry["getquote"].text,
+                keyword=random.choice(keywords),
+                guild_id=guild_id,
+            )
+            print(plan)
+
+
+async def _main(args: argparse.Namespace) -> None:
+    client = edgedb.create_async_client(args.edgedb or edgeql_queries.instance_name)
+    try:
+        async for tx in client.with_retry_options(
+            edgedb.RetryOptions(attempts=1)
+        ).transaction():
+            async with tx:
+                await _benchmark(tx, args)
+                raise _Rollback()
+    except _Rollback:
+        pass
+    finally:
+        await client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 50_000],
+        help="The numbers of quotes in the guild to measure at, in increasing order.",
+    )
+    parser.add_argument("--lookups", type=int, default=1_000)
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print the query plan of a lookup at every size.",
+    )
+    parser.add_argument(
+        "--edgedb", default=None, help="The EdgeDB instance name or DSN to measure."
+    )
+    anyio.run(_main, parser.parse_args(), backend="asyncio")
@@ -0,0 +1,96 @@
+"""Measures how much logging costs per Discord message, before and after the fast logging path.
+
+Run it from the repository root with `python -m benchmarks.logging_overhead`.
+It compares the old InterceptHandler with the current one for discord.py records, once with a sink that drops
+debug messages (like the bot without Debugging) and once with a sink that takes them,
+and the f-string debug calls of the hot paths with loguru's deferred formatting.
+The runs are noisy, so every time is the best of --repeat runs, and it is worth running it a few times.
+The new handler is clearly faster for discord.py records, the deferred formatting of the hot path debug calls
+was within the noise of the f-strings."""
+from __future__ import annotations
+import argparse
+import logging
+import time
+from typing import Any, Callable, Union
+
+from loguru import logger
+
+from loguru_intercept import InterceptHandler
+
+
+class _OldInterceptHandler(logging.Handler):
+    """The InterceptHandler as it was before, to compare with."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            level: Union[int, str] = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+        frame, depth = logging.currentframe(), 2  # type: Any, int
+        while frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back
+            depth += 1
+        logger.opt(depth=depth, exception=record.exc_info).log(
+            level, record.getMessage()
+        )
+
+
+class _Message:
+    """Looks like the parts of a discord.Message that the hot paths log."""
+
+    id = 123456789012345678
+    content = "does anyone have the quote for this?"
+
+
+def _time(calls: int, repeat: int, func: Callable[[], None]) -> float:
+    """:return: The best time per call in nanoseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(calls):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return best / calls * 1e9
+
+
+def _report(name: str, before: float, after: float) -> None:
+    print(
+        f"{name:<34} before={before:8.0f}ns after={after:8.0f}ns ({before / after:.1f}x)"
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    message = _Message()
+    discord_log = logging.getLogger("discord.benchmark")
+    discord_log.setLevel(logging.DEBUG)
+    discord_log.propagate = False
+
+    def discord_record() -> None:
+        discord_log.debug("Dispatching event %s with %r", "message", message.content)
+
+    def f_string() -> None:
+        logger.debug(f"Processing Message with ID {message.id}")
+
+    def deferred() -> None:
+        logger.debug("Processing Message with ID {}", message.id)
+
+    for sink_level in ("INFO", "DEBUG"):
+        logger.remove()
+        logger.add(lambda _: None, level=sink_level, format="{message}")
+        timings = []
+        for handler in (_OldInterceptHandler(), InterceptHandler()):
+            discord_log.handlers = [handler]
+            timings.append(_time(args.calls, args.repeat, discord_record))
+        _report(f"discord.py record, sink {sink_level}", *timings)
+        _report(
+            f"hot path debug call, sink {sink_level}",
+            _time(args.calls, args.repeat, f_string),
+            _time(args.calls, args.repeat, deferred),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,136 @@
+"""Runs the same quote workload against every quote store backend and compares the latencies.
+
+Run it from the repository root with `python -m benchmarks.quote_store`.
+The SQLite store uses a temporary database, so bot.db is not touched.
+The EdgeDB store is only measured if an instance is given with --edgedb, it writes into that instance."""
+from __future__ import annotations
+import argparse
+import random
+import statistics
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import anyio
+
+from async_database import db_thread
+from database import db, Quote, GuildSettings, configure_database, migrate_database
+from quote_store import QuoteStore, create_quote_store
+
+
+def _report(store: str, operation: str, latencies: List[float]) -> None:
+    latencies.sort()
+    print(
+        f"{store:<8} {operation:<14} "
+        f"mean={statistics.mean(latencies) * 1e6:9.1f}us "
+        f"p50={latencies[len(latencies) // 2] * 1e6:9.1f}us "
+        f"p99={latencies[int(len(latencies) * 0.99)] * 1e6:9.1f}us"
+    )
+
+
+async def _measure(
+    operations: int, concurrency: int, operation: Callable[[], Awaitable[object]]
+) -> List[float]:
+    latencies: List[float] = []
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    async with anyio.create_task_group() as task_group:
+        for _ in range(concurrency):
+            task_group.start_soon(worker, max(1, operations // concurrency))
+    return latencies
+
+
+async def _run_workload(store: QuoteStore, args: argparse.Namespace) -> None:
+    random.seed(42)
+    # The guild ids are random, so a shared EdgeDB instance doesn't get mixed up with real guilds.
+    guilds = [random.randrange(10**17, 10**18) for _ in range(args.guilds)]
+    keywords: Dict[int, List[str]] = {guild: [] for guild in guilds}
+
+    async def add() -> None:
+        guild = random.choice(guilds)
+        keyword = "".join(random.choices(string.ascii_lowercase, k=8))
+        keywords[guild].append(keyword)
+        await store.add_quote(guild, keyword, keyword.upper(), 1)
+
+    async def get() -> Optional[str]:
+        guild = random.choice(guilds)
+        # Every fifth lookup misses, like most messages in a real chat.
+        if random.random() < 0.2 or not keywords[guild]:
+            return await store.get_quote(guild, "no such keyword")
+        return await store.get_quote(guild, random.choice(keywords[guild]))
+
+    async def get_many() -> object:
+        keys = []
+        for _ in range(args.batch):
+            guild = random.choice(guilds)
+            if keywords[guild]:
+                keys.append((guild, random.choice(keywords[guild])))
+        return await store.get_quotes(keys)
+
+    async def list_keywords() -> object:
+        return await store.list_keywords(random.choice(guilds))
+
+    async def delete() -> None:
+        guild = random.choice(guilds)
+        if keywords[guild]:
+            await store.delete_quote(guild, keywords[guild].pop())
+
+    _report(store.name, "add_quote", await _measure(args.quotes, 1, add))
+    _report(
+        store.name,
+        f"add_quote(x{args.concurrency})",
+        await _measure(args.quotes, args.concurrency, add),
+    )
+    _report(
+        store.name, "get_quote", await _measure(args.lookups, args.concurrency, get)
+    )
+    _report(
+        store.name,
+        f"get_quotes({args.batch})",
+        await _measure(args.lookups // args.batch, args.concurrency, get_many),
+    )
+    _report(store.name, "list_keywords", await _measure(args.guilds, 1, list_keywords))
+    _report(store.name, "delete_quote", await _measure(args.quotes // 10, 1, delete))
+    for guild in guilds:
+        for keyword in keywords[guild]:
+            await store.delete_quote(guild, keyword)
+
+
+async def _main(args: argparse.Namespace) -> None:
+    await _run_workload(create_quote_store("memory"), args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure_database(path=str(Path(directory) / "bench.db"))
+        db_thread.start()
+        await db_thread.run(db.create_tables, [Quote, GuildSettings])
+        await db_thread.run(migrate_database)
+        await _run_workload(create_quote_store("sqlite"), args)
+        await anyio.to_thread.run_sync(db_thread.stop)
+
+    if args.edgedb:
+        store = create_quote_store("edgedb", dsn=args.edgedb)
+        await store.open()
+        try:
+            await _run_workload(store, args)
+        finally:
+            await store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quotes", type=int, default=2_000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=5_000)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--edgedb", default=None, help="The EdgeDB instance name or DSN to measure."
+    )
+    anyio.run(_main, parser.parse_args(), backend="asyncio")
@@ -0,0 +1,86 @@
+"""Compares quote lookup and insert throughput of the storage profiles on a database with many quotes.
+
+Run it from the repository root with `python -m benchmarks.storage_profile`.
+It uses temporary databases, so bot.db is not touched.
+The profiles mostly differ in how fast they commit, lookups are served from the page cache by all of them."""
+from __future__ import annotations
+import argparse
+import random
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from database import (
+    db,
+    Quote,
+    STORAGE_PROFILES,
+    configure_database,
+    resolve_quote,
+    run_maintenance,
+)
+
+
+def _random_keyword() -> str:
+    return "".join(random.choices(string.ascii_lowercase, k=10))
+
+
+def _fill_database(quote_count: int, guild_count: int) -> List[str]:
+    keywords = [_random_keyword() for _ in range(quote_count)]
+    with db.atomic():
+        for start in range(0, quote_count, 500):
+            Quote.insert_many(
+                [
+                    {
+                        "guildId": random.randrange(guild_count),
+                        "keyword": keyword,
+                        "result": keyword * 10,
+                        "authorId": 1,
+                    }
+                    for keyword in keywords[start : start + 500]
+                ]
+            ).execute()
+    return keywords
+
+
+def _benchmark(profile: str, args: argparse.Namespace) -> None:
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+        configure_database(profile, str(Path(directory) / "bench.db"))
+        db.connect()
+        db.create_tables([Quote])
+        keywords = _fill_database(args.quotes, args.guilds)
+        run_maintenance(analyze=True)
+
+        started = time.perf_counter()
+        for _ in range(args.lookups):
+            resolve_quote(random.randrange(args.guilds), random.choice(keywords))
+        lookups = args.lookups / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(args.inserts):
+            # Every insert is its own transaction, just like addquote.
+            Quote.create(
+                guildId=random.randrange(args.guilds),
+                keyword=_random_keyword(),
+                result="text",
+                authorId=1,
+            )
+        inserts = args.inserts / (time.perf_counter() - started)
+        db.close()
+    print(
+        f"{profile:<12} lookups={lookups:10.0f}/s inserts={inserts:10.0f}/s"
+        f" ({args.quotes} quotes)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quotes", type=int, default=100_000)
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=20_000)
+    parser.add_argument("--inserts", type=int, default=2_000)
+    arguments = parser.parse_args()
+    for storage_profile in STORAGE_PROFILES:
+        _benchmark(storage_profile, arguments)
@@ -14,7 +14,6 @@ from typing import (
     Tuple,
     Callable,
     Dict,
-    Iterator,
     Final,
     Coroutine,
     Set,
@@ -29,6 +28,8 @@ import random
 import warnings
 import time
 import re
+import tempfile
+from pathlib import Path
 
 try:  # These are mandatory.
     import aiohttp
@@ -53,7 +54,6 @@ try:  # These are mandatory.
     import attr
     import anyio
     from anyio.abc import TaskGroup
-    from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
     from anyio.streams.text import TextStream
     import edgedb
 except ImportError as e:
@@ -61,8 +61,34 @@ except ImportError as e:
         "You have some dependencies missing, please install them with pipenv install --deploy"
     ) from e
 
-from database import db, Quote
-from loguru_intercept import InterceptHandler
+from database import (
+    db,
+    Quote,
+    GuildSettings,
+    quote_index,
+    quote_prefilter,
+    configure_database,
+    run_maintenance,
+    migrate_database,
+    read_anywhere_guilds,
+    GLOBAL_GUILD_ID,
+    QuoteMatch,
+    read_quote_rows,
+    import_quotes as import_quote_rows,
+)
+import async_database
+import quote_transfer
+from async_database import db_thread, write_queue
+from loguru_intercept import DebugSampler, InterceptHandler
+from quote_lookup import QuoteLookupBatcher
+from quote_snapshot import QuoteSnapshotWriter, read_snapshot
+from quote_store import create_quote_store
+from quote_usage import QuoteUsageTracker
+from outbound import OutboundScheduler
+from log_batcher import LogBatcher
+from entity_sync import EntitySync
+from metrics import Metrics
+from limiters import db_limiter, blocking_limiter, all_limiters
 from checks import getconf, configOwner, is_in_owners
 
 Command = commands.Command
@@ -94,6 +120,23 @@ log.addHandler(InterceptHandler())  # This makes discord use loguru for logging.
 config = getconf()
 login = config["Login"]
 settings = config["Settings"]
+if not config.has_section("Database"):
+    config.add_section("Database")
+database_settings = config["Database"]
+db_limiter.total_tokens = database_settings.getint(
+    "Database Pool Size", fallback=db_limiter.total_tokens
+)
+# Quote writes wait this many milliseconds for more writes to commit them together.
+write_queue.window = (
+    database_settings.getfloat("Write Batch Window", fallback=write_queue.window * 1000)
+    / 1000
+)
+write_queue.max_batch_size = database_settings.getint(
+    "Write Batch Size", fallback=write_queue.max_batch_size
+)
+blocking_limiter.total_tokens = settings.getint(
+    "Blocking Pool Size", fallback=blocking_limiter.total_tokens
+)
 loginID = login.get("Login Token")
 debugging = settings.getboolean("Debugging", fallback=False)
 logger.remove()  # This removes the default loguru logger.
@@ -113,6 +156,8 @@ else:
     logger.add(
         sys.stderr,
         level="DEBUG",
+        # Debug messages that are logged for every Discord message are limited per line of code.
+        filter=DebugSampler(settings.getint("Debug Log Limit", fallback=10)),
         enqueue=True,
         diagnose=True,
         colorize=True,
@@ -181,9 +226,65 @@ global_quotes: Dict[
 shutting_down_event: anyio.Event  # This is basically just a boolean False value, that can be waited for.
 started_up_event: anyio.Event
 global_task_group: TaskGroup  # A task group is a way to run multiple things at the same time. This will be set later.
-log_send_channel: MemoryObjectSendStream[str]
-log_recv_channel: MemoryObjectReceiveStream[str]
-log_send_channel, log_recv_channel = anyio.create_memory_object_stream(10, str)
+# The log records for the log channel wait here and are sent as many at a time as fit into one message.
+log_batcher = LogBatcher(
+    capacity=settings.getint("Log Buffer Size", fallback=500),
+    drop_policy=settings.get("Log Drop Policy", "oldest").lower(),
+)
+# Where the quotes are kept: sqlite (bot.db), edgedb or memory (nothing is saved).
+quote_backend = database_settings.get("Backend", "sqlite").lower()
+quote_store = create_quote_store(
+    quote_backend,
+    **(
+        {
+            "dsn": database_settings.get("EdgeDB DSN"),
+            "entity_cache_size": database_settings.getint(
+                "Entity Cache Size", fallback=100_000
+            ),
+        }
+        if quote_backend == "edgedb"
+        else {}
+    ),
+)
+# Quote usage statistics are collected in memory and written in batches.
+quote_usage = QuoteUsageTracker(
+    quote_store.record_usage,
+    interval=database_settings.getfloat("Usage Flush Interval", fallback=60.0),
+    max_pending=database_settings.getint("Usage Flush Size", fallback=500),
+)
+# send_message_both and the replies of the quote commands go through this, so they keep their order per channel
+# and wait only as long as the rate limits of Discord require.
+# The short replies in on_message, ping and the embeds of the owner commands still send directly.
+outbound = OutboundScheduler()
+# How long every event listener and command takes, the handlers are timed when setup_bot registers them.
+metrics = Metrics()
+# The metrics are written here in the Prometheus text format, leave it empty to not write them.
+metrics_file = settings.get("Metrics File", "")
+# The guilds, members and channels are saved to the quote store in the background, if it keeps them.
+entity_sync = EntitySync(
+    quote_store,
+    chunk_size=database_settings.getint("Sync Chunk Size", fallback=500),
+    interval=database_settings.getfloat("Sync Interval", fallback=5.0),
+)
+# The quote index is saved here on shutdown and every few minutes, so a restart doesn't wait for the database.
+quote_snapshot_file = database_settings.get("Snapshot File", "quotes.snapshot")
+quote_snapshots: Optional[QuoteSnapshotWriter] = (
+    QuoteSnapshotWriter(
+        quote_index,
+        Path(quote_snapshot_file),
+        quote_backend,
+        interval=database_settings.getfloat("Snapshot Interval", fallback=600.0),
+    )
+    if quote_snapshot_file
+    else None
+)
+# This bundles quote lookups that have to go to the database, the window is configured in milliseconds.
+# Only used until the quote index is loaded, see get_quote_anyio.
+quote_lookups = QuoteLookupBatcher(
+    quote_store.get_quotes,
+    window=database_settings.getfloat("Quote Batch Window", fallback=2.0) / 1000,
+    max_batch_size=database_settings.getint("Quote Batch Size", fallback=50),
+)
 
 
 def input_to_bool(text: str) -> Optional[bool]:
@@ -208,7 +309,7 @@ async def sleep_both(sleep_time: float) -> None:
     """
     try:
         lib = sniffio.current_async_library()
-        logger.debug(f"Called sleep from {lib} for {sleep_time} seconds.")
+        logger.debug("Called sleep from {} for {} seconds.", lib, sleep_time)
         await anyio.sleep(sleep_time)
     except sniffio.AsyncLibraryNotFoundError:
         warnings.warn("Sleep was called without async context.")
@@ -267,43 +368,46 @@ async def send_message_both(
     if isinstance(target, commands.Context):
         target = target.channel
 
-    def chunks(long_string: str) -> Iterator[str]:
-        """Produce `n`-character chunks from `s`."""
-        for start in range(0, len(long_string), 1950):
-            yield long_string[start : start + 1950]
+    def chunks(long_string: str) -> List[str]:
+        """Splits the message into parts that fit into one Discord message, at least one."""
+        return [
+            long_string[start : start + 1950]
+            for start in range(0, len(long_string), 1950)
+        ] or [long_string]
 
-    async def log_sent_message(
-        to: discord.abc.Messageable, message_to_send: str
-    ) -> None:
-        """Logs the message sending."""
+    def target_name(to: discord.abc.Messageable) -> str:
+        """Gets a readable name of where the message goes, for the log."""
         if isinstance(to, discord.TextChannel):
-            name = to.name
+            return to.name
         elif isinstance(to, discord.DMChannel):
-            name = to.recipient.name
+            return to.recipient.name
         elif isinstance(to, discord.GroupChannel) and to.name is not None:
-            name = to.name
+            return to.name
         else:
-            name = str(to)
-        from_library = sniffio.current_async_library()
-        logger.debug(f"Sending message {message_to_send} to {name} from {from_library}")
-
-    if len(message) > 1950:
-        for sub_message in chunks(message):
-            await send_message_both(target, sub_message, no_log, kwargs=kwargs)
-            await sleep_both(3)
-        return
+            return str(to)
+
+    def log_sent_message(to: discord.abc.Messageable, message_to_send: str) -> None:
+        """Logs the message sending, the details are only looked up if debug messages are logged."""
+        logger.opt(lazy=True).debug(
+            "Sending message {} to {} from {}",
+            lambda: message_to_send,
+            lambda: target_name(to),
+            sniffio.current_async_library,
+        )
 
+    # Long messages are sent in parts, the scheduler sends them right after each other.
+    parts = chunks(message)
     try:
         if not no_log:
-            await log_sent_message(target, message)
+            log_sent_message(target, message)
         library = sniffio.current_async_library()
         if library == "asyncio":
-            await target.send(content=message, **kwargs)
+            await outbound.send(target, parts, **kwargs)
         else:
             raise RuntimeError("Trio is no longer supported")
     except sniffio.AsyncLibraryNotFoundError:
         warnings.warn("Not in async Context.", RuntimeWarning)
-        task = partial(target.send, content=message, **kwargs)
+        task = partial(outbound.send, target, parts, **kwargs)
         logger.warning(
             f"Sending message {message} to {str(target)} from outside async context."
         )
@@ -359,7 +463,10 @@ def log_startup() -> None:
 
 
 async def _add_global_quote_anyio(
-    keyword: str, text: str, author: Optional[discord.User] = None
+    keyword: str,
+    text: str,
+    author: Optional[discord.User] = None,
+    overwrite: bool = False,
 ) -> None:
     """This adds a global quote to the database.
 
@@ -368,19 +475,13 @@ async def _add_global_quote_anyio(
     :param keyword: The keyword of the quote
     :param text: The text that the bot should send when the keyword is detected.
     :param author: Optional,
+    :param overwrite: Whether an existing global quote with that keyword gets replaced.
     """
     keyword = keyword.lower()
-    quote = await anyio.to_thread.run_sync(
-        Quote.get_or_none, -1 == Quote.guildId, keyword == Quote.keyword
-    )
-    if quote is None:
-        logger.info(
-            f"Adding global quote {keyword} with text {text} because it is not in the database."
-        )
-        quote = Quote(guildId=-1, keyword=keyword, result=text, authorId=-1)
-        if author is not None:
-            quote.authorId = author.id
-        await anyio.to_thread.run_sync(quote.save)
+    author_id = author.id if author is not None else -1
+    if await quote_store.add_global_quote(keyword, text, author_id, overwrite):
+        logger.info(f"Saved global quote {keyword} with text {text}.")
+        quote_index.set(GLOBAL_GUILD_ID, keyword, text)
 
 
 def log_to_channel(message: str) -> None:
@@ -403,11 +504,8 @@ def log_to_channel(message: str) -> None:
                 library = sniffio.current_async_library()
                 if debugging:
                     print(f"Logging to Discord from Library: {library}")
-                try:
-                    # logging_queue.put_nowait(message)
-                    log_send_channel.send_nowait(message)
-                except anyio.WouldBlock as e:
-                    raise RuntimeError("Queue is full") from e
+                # This never blocks, if the buffer is full the drop policy of the batcher decides what is lost.
+                log_batcher(message)
 
         else:
             return
@@ -420,17 +518,14 @@ def log_to_channel(message: str) -> None:
         print(
             f"Logging to Discord failed for message: {message} because of unknown async context."
         )
-    except RuntimeError:
-        print(
-            f"Logging to Discord failed for message: {message} because the queue is full"
-        )
 
 
 def setup_channel_logger() -> Optional[int]:
     """Sets up a logger and returns the ID of the logger."""
+    # The batcher puts the records into a code block.
     format_str = (
-        "```{time: HH:mm:ss.SSS} | <level>{level: <8}</level> | {function}:{line} - <level>{"
-        "message}</level>```"
+        "{time: HH:mm:ss.SSS} | <level>{level: <8}</level> | {function}:{line} - <level>{"
+        "message}</level>"
     )
     if log_channel is not None:
         logger.info(f"Setting up logging to {log_channel.name}")
@@ -468,7 +563,7 @@ async def on_ready_anyio() -> None:
     async with anyio.create_task_group() as task_group:
         # This is no longer a coroutine in anyio >3.0.0 or in git version so we can suppress PyCharms warning.
         # noinspection PyAsyncCall
-        task_group.start_soon(anyio.to_thread.run_sync, log_startup)
+        task_group.start_soon(blocking_limiter.run_sync, log_startup)
     # This is no longer a coroutine in anyio >3.0.0 or in git version so we can suppress PyCharms warning.
     # noinspection PyAsyncCall
     started_up_event.set()
@@ -483,11 +578,14 @@ async def on_ready_anyio() -> None:
             task_group.start_soon(task)
         # This is no longer a coroutine in anyio >3.0.0 or in git version so we can suppress PyCharms warning.
         # noinspection PyAsyncCall
-        task_group.start_soon(anyio.to_thread.run_sync, setup_log_channel)
+        task_group.start_soon(blocking_limiter.run_sync, setup_log_channel)
 
     # This is no longer a coroutine in anyio >3.0.0 or in git version so we can suppress PyCharms warning.
     # noinspection PyAsyncCall
     global_task_group.start_soon(logging_task_anyio)
+    assert bot is not None
+    for guild in bot.guilds:
+        entity_sync.sync_guild(guild)
     logger.debug("Done with setup in anyio.")
 
 
@@ -503,11 +601,68 @@ all_events.append(on_ready)
 async def on_guild_join(server: discord.Guild) -> None:
     """This runs whenever the bot gets invited into a new guild."""
     logger.success(f"I just joined the server {server.name} with the ID {server.id}")
+    # We might have been in this guild before, so get its quotes back into the index.
+    quotes = await quote_store.read_quotes(server.id)
+    quote_index.replace_guild(server.id, quotes.get(server.id, {}))
+    entity_sync.sync_guild(server)
 
 
 all_events.append(on_guild_join)
 
 
+async def on_guild_update(before: discord.Guild, after: discord.Guild) -> None:
+    """This runs whenever a guild changes, for example its name."""
+    if before.name != after.name:
+        entity_sync.guild_changed(after)
+
+
+all_events.append(on_guild_update)
+
+
+async def on_member_join(member: discord.Member) -> None:
+    """This runs whenever someone joins a guild the bot is in."""
+    entity_sync.member_joined(member)
+
+
+all_events.append(on_member_join)
+
+
+async def on_member_remove(member: discord.Member) -> None:
+    """This runs whenever someone leaves a guild the bot is in, or gets kicked or banned."""
+    entity_sync.member_left(member)
+
+
+all_events.append(on_member_remove)
+
+
+async def on_user_update(before: discord.User, after: discord.User) -> None:
+    """This runs whenever someone the bot knows changes their name, tag or avatar."""
+    if (before.name, before.discriminator) != (after.name, after.discriminator):
+        entity_sync.user_changed(after)
+
+
+all_events.append(on_user_update)
+
+
+async def on_guild_channel_create(channel: discord.abc.GuildChannel) -> None:
+    """This runs whenever a channel is created in a guild the bot is in."""
+    entity_sync.channel_changed(channel)
+
+
+all_events.append(on_guild_channel_create)
+
+
+async def on_guild_channel_update(
+    before: discord.abc.GuildChannel, after: discord.abc.GuildChannel
+) -> None:
+    """This runs whenever a channel of a guild the bot is in changes."""
+    if before.name != after.name:
+        entity_sync.channel_changed(after)
+
+
+all_events.append(on_guild_channel_update)
+
+
 async def on_guild_remove(server: discord.Guild) -> None:
     """This runs whenever the bot leaves a guild."""
     global log_channel  # pylint: disable=global-statement
@@ -515,47 +670,26 @@ async def on_guild_remove(server: discord.Guild) -> None:
         if log_channel.guild == server:
             log_channel = None
             logger.warning("Removed the server used for logging, turned it off.")
+    quote_index.drop_guild(server.id)
     logger.warning(f"I left the server {server.name} with the ID {server.id}")
 
 
 all_events.append(on_guild_remove)
 
 
-def _get_quote_sync(guild: discord.Guild, text: str) -> Optional[str]:
-    """This gets a quote from the database.
-
-    It prefers a guild specific quote, but if it can't find a guild quote, it will also look for a global quote.
-    :param guild: The discord.Guild that should be checked for quotes
-    :param text: The keyword to search for
-    :return: Either the found string, or None if nothing was found.
-    """
-    logger.debug(f"Looking for quote with text: {text} in guild {guild.name}")
-    quote = Quote.get_or_none(guild.id == Quote.guildId, text.lower() == Quote.keyword)
-    if quote:
-        return str(quote.result)
-    else:
-        quote = Quote.get_or_none(-1 == Quote.guildId, text.lower() == Quote.keyword)
-        if quote:
-            return str(quote.result)
-    logger.debug("No quote found.")
-    return None
-
-
 async def get_quote_anyio(guild: Optional[discord.Guild], text: str) -> Optional[str]:
-    if guild:
-        return cast(
-            Optional[str],
-            await anyio.to_thread.run_sync(_get_quote_sync, guild, text),
-        )
-    else:
-        task = partial(
-            Quote.get_or_none, -1 == Quote.guildId, text.lower() == Quote.keyword
-        )
-        quote = await anyio.to_thread.run_sync(task)
-        if quote:
-            return str(quote.result)
-        else:
-            return None
+    """Gets the quote for the given text, preferring guild quotes over global quotes.
+
+    This uses the in-memory quote index once it is loaded and only falls back to the database before that.
+    Database lookups are coalesced and batched by quote_lookups."""
+    if quote_index.loaded:
+        return quote_index.get(guild.id if guild else None, text)
+    if guild is not None:
+        logger.debug("Looking for quote with text: {} in guild {}", text, guild.name)
+    quote = await quote_lookups.get(guild.id if guild else None, text)
+    if quote is None:
+        logger.debug("No quote found.")
+    return quote
 
 
 async def on_message(message: discord.Message) -> None:
@@ -573,7 +707,7 @@ async def on_message(message: discord.Message) -> None:
     ):  # If the message is from a bot, we ignore it and just end here.
         return
 
-    logger.debug(f"Processing Message with ID {message.id}")
+    logger.debug("Processing Message with ID {}", message.id)
 
     # noinspection SpellCheckingInspection
     def booleanable(old_message: discord.Message) -> bool:
@@ -591,7 +725,21 @@ async def on_message(message: discord.Message) -> None:
     ] = message.channel
     guild = cast(Union[Guild, Guild, None], message.guild)
 
-    quote = await get_quote_anyio(guild, text)
+    quote: Optional[str] = None
+    match: Optional[QuoteMatch] = None
+    with metrics.measure("quote", "resolve"):
+        if not quote_index.loaded:
+            # Usage isn't recorded before the index is loaded, because we don't know which quote this was.
+            quote = await get_quote_anyio(guild, text)
+        elif guild is not None and guild.id in quote_index.anywhere_guilds:
+            match = quote_index.match_anywhere(guild.id, text)
+        elif quote_prefilter.might_match(guild.id if guild else None, text):
+            match = quote_index.match(guild.id if guild else None, text)
+            if match is None:
+                quote_prefilter.record_false_positive()
+    if match is not None:
+        quote_guild, keyword, quote = match
+        quote_usage.record(quote_guild, keyword, message.author.id, channel.id)
     if quote:
         await channel.send(quote)
         return
@@ -650,7 +798,7 @@ async def on_message(message: discord.Message) -> None:
                 "Here is the link: https://my.w.tt/LexRMPK1eS. Enjoy reading! :D"
             )
     else:
-        logger.debug(f"Going to process message with {message.id} as a command!")
+        logger.debug("Going to process message with {} as a command!", message.id)
         # TODO: Bug. Process Commands already runs even without being called even though on_message is overridden.
         # await bot.process_commands(message)
 
@@ -774,7 +922,7 @@ async def shutdown(ctx: Context) -> None:
     shutting_down_event.set()
     logger.warning(f"Shutting down on request of {ctx.author.name}!")
     await sleep_both(3)
-    db.close()
+    await close_database_anyio()
     try:
         assert bot is not None
         raise SystemExit from None
@@ -829,9 +977,9 @@ async def restart(ctx: Context) -> None:
     await send_message_both(ctx, "Restarting", delete_after=3)
     await asyncio.sleep(5)
     logger.warning(f"Restarting on request of {ctx.author.name}!")
-    db.close()
+    await close_database_anyio()
     try:
-        await log_send_channel.aclose()
+        log_batcher.close()
     except discord.NotFound:
         pass
     # noinspection PyBroadException
@@ -1730,23 +1878,20 @@ async def _add_quote_anyio(ctx: Context, keyword: str, quote_text: str) -> None:
     """Actually adds a quote to the database using anyio."""
     if ctx.message.guild is None:
         raise ValueError("We don't have any guild ID!")
-    quote = Quote(
-        guildId=ctx.message.guild.id,
-        keyword=keyword.lower(),
-        result=quote_text,
-        authorId=ctx.author.id,
+    await quote_store.add_quote(
+        ctx.message.guild.id, keyword, quote_text, ctx.author.id
     )
-    await anyio.to_thread.run_sync(quote.save)
+    quote_index.set(ctx.message.guild.id, keyword, quote_text)
     logger.success(
         f"Added quote {keyword.lower()} with text: {quote_text} for guild: {ctx.message.guild} by {ctx.author.name}"
     )
-    # The reasoning for moving it to a separate thread is to not block the main loop for database access.
+    # The reasoning for using the database thread is to not block the main loop for database access.
 
 
 @commands.command(aliases=["addq"])
 @commands.has_permissions(manage_messages=True)
 async def addquote(ctx: Context, keyword: str, *, quote_text: str) -> None:
-    """Adds a quote to the database.
+    """Adds a quote to the database or replaces the one with that keyword.
 
     Specify the keyword in "" if it has spaces in it.
     Like this: addquote "key message" Reacting Text"""
@@ -1799,7 +1944,7 @@ all_slash_commands.append(
 async def add_global_quote(
     ctx: commands.Context, keyword: str, *, quote_text: str
 ) -> None:
-    """Adds a global quote to the database.
+    """Adds a global quote to the database or replaces the one with that keyword.
 
     Specify the keyword in "" if it has spaces in it.
     Like this: addgq "key message" Reacting Text"""
@@ -1813,13 +1958,141 @@ async def add_global_quote(
             "Neither the Keyword nor the quote text can start with punctuation to avoid running bot commands.",
         )
         return
-    await _add_global_quote_anyio(keyword, quote_text, ctx.author)
+    await _add_global_quote_anyio(keyword, quote_text, ctx.author, overwrite=True)
     await send_message_both(ctx, "I saved the quote.")
 
 
 all_commands.append(add_global_quote)
 # This command should not get a / command version.
 
+# Bigger files can't be uploaded to Discord without Nitro.
+MAX_UPLOAD_SIZE: Final[int] = 8 * 1024 * 1024
+
+
+@commands.command(hidden=True, name="exportquotes")
+@is_in_owners()
+async def export_quotes(
+    ctx: Context, file_format: str = "jsonl", scope: str = "server"
+) -> None:
+    """Exports the quotes of this server, or of all servers, as a JSONL or CSV file.
+
+    Like this: exportquotes csv all
+    The quotes are read in batches, so this doesn't hold up the bot. Only works for the bot owners.
+    :param file_format: Either jsonl or csv.
+    :param scope: Either server for the quotes of this server or all for every quote.
+    """
+    assert ctx.author.id in configOwner
+    if quote_backend != "sqlite":
+        await send_message_both(
+            ctx, "Exporting only works with the SQLite quote backend."
+        )
+        return
+    if file_format.lower() not in quote_transfer.FORMATS or scope not in (
+        "server",
+        "all",
+    ):
+        await send_message_both(ctx, "Use exportquotes [jsonl|csv] [server|all].")
+        return
+    if scope == "server" and ctx.guild is None:
+        await send_message_both(ctx, "Use exportquotes jsonl all in PM Channels.")
+        return
+    guild_id = None if scope == "all" else ctx.guild.id
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / f"quotes.{file_format.lower()}"
+        file = await blocking_limiter.run_sync(
+            partial(path.open, "w", encoding="utf-8", newline="")
+        )
+        try:
+            writer = quote_transfer.QuoteWriter(file, file_format.lower())
+            last_id = 0
+            while rows := await db_thread.run(read_quote_rows, last_id, guild_id):
+                await blocking_limiter.run_sync(writer.write, rows)
+                last_id = rows[-1][0]
+        finally:
+            await blocking_limiter.run_sync(file.close)
+        logger.info(f"{ctx.author.name} exported {writer.written} quotes.")
+        if path.stat().st_size > MAX_UPLOAD_SIZE:
+            await send_message_both(
+                ctx,
+                f"The export of {writer.written} quotes is too big for Discord, use quote_transfer.py on the server.",
+            )
+            return
+        await outbound.send(
+            ctx.channel,
+            [f"Here are {writer.written} quotes."],
+            file=discord.File(str(path)),
+        )
+
+
+all_commands.append(export_quotes)
+# This command should not get a / command version.
+
+
+@commands.command(hidden=True, name="importquotes")
+@is_in_owners()
+async def import_quotes(ctx: Context, overwrite: str = "no") -> None:
+    """Imports the quotes of the JSONL or CSV file attached to the message.
+
+    Every row needs the fields guild_id, keyword and quote, author_id is optional.
+    The quotes are written in batches, one transaction each, and the progress is shown while it runs.
+    Only works for the bot owners.
+    :param overwrite: Whether to replace existing quotes with the same keyword, yes or no.
+    """
+    assert ctx.author.id in configOwner
+    if quote_backend != "sqlite":
+        await send_message_both(
+            ctx, "Importing only works with the SQLite quote backend."
+        )
+        return
+    replace = input_to_bool(overwrite)
+    if not ctx.message.attachments or replace is None:
+        await send_message_both(
+            ctx, "Attach a .jsonl or .csv file and use importquotes [yes|no]."
+        )
+        return
+    attachment = ctx.message.attachments[0]
+    try:
+        file_format = quote_transfer.file_format(Path(attachment.filename))
+    except quote_transfer.QuoteFileError as error:
+        await send_message_both(ctx, str(error))
+        return
+    result = quote_transfer.ImportResult()
+    progress = await outbound.send(ctx.channel, ["Importing the quotes..."])
+    assert progress is not None
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / f"quotes.{file_format}"
+        await attachment.save(path)
+        file = await blocking_limiter.run_sync(path.open, "rb")
+        try:
+            reader = quote_transfer.QuoteReader(file, file_format)
+            last_update = time.monotonic()
+            while batch := await blocking_limiter.run_sync(reader.read_batch):
+                result.written += await db_thread.run(import_quote_rows, batch, replace)
+                result.guilds.update(quote["guildId"] for quote in batch)
+                if time.monotonic() - last_update > 5:
+                    last_update = time.monotonic()
+                    await progress.edit(
+                        content=f"Importing the quotes, {reader.progress} done..."
+                    )
+        finally:
+            await blocking_limiter.run_sync(file.close)
+    result.rows = reader.rows
+    result.invalid = reader.invalid
+    for guild_id in result.guilds:
+        quotes = await quote_store.read_quotes(guild_id)
+        quote_index.replace_guild(guild_id, quotes.get(guild_id, {}))
+    logger.info(
+        f"{ctx.author.name} imported {result.written} quotes into {len(result.guilds)} guilds."
+    )
+    await progress.edit(
+        content=f"I imported {result.written} of {result.rows} quotes, "
+        f"{result.kept} already existed and {result.invalid} were invalid."
+    )
+
+
+all_commands.append(import_quotes)
+# This command should not get a / command version.
+
 
 @commands.command(hidden=False, aliases=["delq", "delquote"])
 @commands.has_permissions(manage_messages=True)
@@ -1831,11 +2104,8 @@ async def deletequote(ctx: Context, keyword: str) -> None:
     Only works for people that can delete messages in this server."""
     assert ctx.guild is not None
     assert ctx.author.permissions_in(ctx.channel).manage_messages
-    quote = Quote.get_or_none(
-        Quote.guildId == ctx.guild.id, Quote.keyword == keyword.lower()
-    )
-    if quote:
-        quote.delete_instance()
+    if await quote_store.delete_quote(ctx.guild.id, keyword):
+        quote_index.remove(ctx.guild.id, keyword)
         await send_message_both(ctx, "The quote was deleted.")
     else:
         await send_message_both(ctx, "I could not find the quote.")
@@ -1845,21 +2115,144 @@ all_commands.append(deletequote)
 # This command should not get a / command version.
 
 
+@commands.command(hidden=False, name="quotemode")
+@commands.has_permissions(manage_messages=True)
+@commands.guild_only()
+async def quote_mode(ctx: Context, mode: str) -> None:
+    """Sets when quotes trigger on this server.
+
+    exact: Only when the whole message is the keyword.
+    anywhere: When the keyword appears as a word anywhere in the message.
+    Only works for people that can delete messages in this server."""
+    assert ctx.guild is not None
+    assert ctx.author.permissions_in(ctx.channel).manage_messages
+    mode = mode.lower()
+    if mode not in ["exact", "anywhere"]:
+        await send_message_both(ctx, "The mode must be either exact or anywhere.")
+        return
+    anywhere = mode == "anywhere"
+    await async_database.set_quotes_anywhere(ctx.guild.id, anywhere)
+    quote_index.set_anywhere(ctx.guild.id, anywhere)
+    logger.info(f"{ctx.author.name} set the quote mode of {ctx.guild.name} to {mode}")
+    await send_message_both(ctx, f"Quotes now trigger {mode}.")
+
+
+all_commands.append(quote_mode)
+all_slash_commands.append(
+    SlashCommandInfo(
+        command=quote_mode,
+        name="quotemode",
+        description="Sets whether quotes trigger on exact messages or anywhere in them.",
+        options=[
+            manage_commands.create_option(
+                name="mode",
+                description="Either exact or anywhere.",
+                option_type=3,
+                required=True,
+            )
+        ],
+    )
+)
+
+
+QUOTE_PAGE_SIZE: Final[int] = 50
+QUOTE_PAGE_PREVIOUS: Final[
+    str
+] = "\N{BLACK LEFT-POINTING TRIANGLE}\N{VARIATION SELECTOR-16}"
+QUOTE_PAGE_NEXT: Final[
+    str
+] = "\N{BLACK RIGHT-POINTING TRIANGLE}\N{VARIATION SELECTOR-16}"
+
+
+def fit_quote_page(
+    header: str, keywords: List[str], from_end: bool = False
+) -> List[str]:
+    """Drops keywords until the page fits into one Discord message.
+
+    :param header: The text that comes before the keywords.
+    :param keywords: The keywords of the page in alphabetical order.
+    :param from_end: Whether to keep the last keywords instead of the first ones, for a page before the shown one.
+    :return: The keywords that fit, still in alphabetical order.
+    """
+    length = len(header)
+    fitting: List[str] = []
+    for keyword in reversed(keywords) if from_end else keywords:
+        length += len(keyword) + 2
+        if length > 1950 and fitting:
+            break
+        fitting.append(keyword)
+    return fitting[::-1] if from_end else fitting
+
+
 @commands.command(hidden=False, aliases=["liqu"], name="listquotes")
-async def list_quotes(ctx: Context) -> None:
-    """Lists all quotes on the current server."""
-    result = ""
+async def list_quotes(ctx: Context, *, start: str = "") -> None:
+    """Lists the quotes on the current server, one page at a time.
+
+    Only the shown page is read from the database, react with the arrows to go to the previous or next page.
+    :param start: The keyword to start the list at, defaults to the first one.
+    """
     if ctx.guild is None:
         await send_message_both(ctx, "You cannot run this command in a PM Channel.")
         return
-    query = Quote.select(Quote.keyword).where(ctx.guild.id == Quote.guildId)
-    results = await anyio.to_thread.run_sync(query.execute)
-    for quote in results:
-        result = result + str(quote.keyword) + "; "
-    if result != "":
-        await send_message_both(ctx, result)
-    else:
-        await send_message_both(ctx, "I couldn't find any quotes on this server.")
+    guild_id = ctx.guild.id
+    header = f"There are {quote_index.count(guild_id)} quotes on this server:\n"
+    keywords = await quote_store.list_keywords_page(
+        guild_id, start=start or None, limit=QUOTE_PAGE_SIZE
+    )
+    if not keywords:
+        if start:
+            await send_message_both(ctx, f"I couldn't find any quotes from {start} on.")
+        else:
+            await send_message_both(ctx, "I couldn't find any quotes on this server.")
+        return
+    keywords = fit_quote_page(header, keywords)
+    page_message = await outbound.send(ctx.channel, [header + "; ".join(keywords)])
+    assert page_message is not None
+    if len(keywords) == quote_index.count(guild_id):
+        return
+    try:
+        await page_message.add_reaction(QUOTE_PAGE_PREVIOUS)
+        await page_message.add_reaction(QUOTE_PAGE_NEXT)
+    except discord.Forbidden:
+        logger.info(f"Can't add the page reactions in {ctx.channel}.")
+        return
+
+    def check(reaction: discord.Reaction, user: discord.User) -> bool:
+        return (
+            reaction.message.id == page_message.id
+            and user.id == ctx.author.id
+            and str(reaction.emoji) in (QUOTE_PAGE_PREVIOUS, QUOTE_PAGE_NEXT)
+        )
+
+    while True:
+        try:
+            reaction, user = await wait_for_event_both(
+                "reaction_add", check=check, timeout=120.0
+            )
+        except TimeoutError:
+            break
+        try:
+            await page_message.remove_reaction(reaction.emoji, user)
+        except discord.Forbidden:
+            pass
+        backwards = str(reaction.emoji) == QUOTE_PAGE_PREVIOUS
+        if backwards:
+            page = await quote_store.list_keywords_page(
+                guild_id, before=keywords[0], limit=QUOTE_PAGE_SIZE
+            )
+        else:
+            page = await quote_store.list_keywords_page(
+                guild_id, after=keywords[-1], limit=QUOTE_PAGE_SIZE
+            )
+        if not page:
+            continue
+        header = f"There are {quote_index.count(guild_id)} quotes on this server:\n"
+        keywords = fit_quote_page(header, page, from_end=backwards)
+        await page_message.edit(content=header + "; ".join(keywords))
+    try:
+        await page_message.clear_reactions()
+    except discord.HTTPException:
+        pass
 
 
 all_commands.append(list_quotes)
@@ -1867,12 +2260,159 @@ all_slash_commands.append(
     SlashCommandInfo(
         command=list_quotes,
         name="listquotes",
-        description="Lists all quotes of this server.",
-        options=[],
+        description="Lists the quotes of this server, one page at a time.",
+        options=[
+            manage_commands.create_option(
+                name="start",
+                description="The keyword to start the list at.",
+                option_type=3,
+                required=False,
+            )
+        ],
+    )
+)
+
+
+@commands.command(hidden=False, aliases=["sequ"], name="searchquote")
+async def search_quote(ctx: Context, *, text: str) -> None:
+    """Searches the quotes on the current server by keyword and text.
+
+    Finds keywords that start with the text, quotes that contain it and keywords that look like it.
+    :param text: What to search for.
+    """
+    if ctx.guild is None:
+        await send_message_both(ctx, "You cannot run this command in a PM Channel.")
+        return
+    found = await quote_store.search_quotes(ctx.guild.id, text, limit=10)
+    if not found:
+        await send_message_both(ctx, f"I couldn't find any quotes for {text}.")
+        return
+    lines = []
+    for keyword, result in found:
+        preview = " ".join(result.split())
+        if len(preview) > 100:
+            preview = preview[:97] + "..."
+        lines.append(f"**{keyword}**: {preview}")
+    await send_message_both(ctx, "\n".join(lines))
+
+
+all_commands.append(search_quote)
+all_slash_commands.append(
+    SlashCommandInfo(
+        command=search_quote,
+        name="searchquote",
+        description="Searches the quotes of this server by keyword and text.",
+        options=[
+            manage_commands.create_option(
+                name="text",
+                description="What to search for.",
+                option_type=3,
+                required=True,
+            )
+        ],
     )
 )
 
 
+@commands.command(hidden=True, name="prefilterstats")
+@is_in_owners()
+async def prefilter_stats(ctx: Context) -> None:
+    """Shows how well the quote prefilter works.
+
+    Only works for the bot owners."""
+    assert ctx.author.id in configOwner
+    lines = [
+        f"The quote prefilter checked {quote_prefilter.checks} messages.",
+        f"Ruled out: {quote_prefilter.rejected} ({quote_prefilter.hit_rate:.1%})",
+        f"False positives: {quote_prefilter.false_positives} ({quote_prefilter.false_positive_rate:.1%})",
+    ]
+    await send_message_both(ctx, "\n".join(lines))
+
+
+all_commands.append(prefilter_stats)
+# This command should not get a / command version.
+
+
+@commands.command(hidden=True, name="poolstats")
+@is_in_owners()
+async def pool_stats(ctx: Context) -> None:
+    """Shows how busy the pools for blocking work are and how long the EdgeDB queries take.
+
+    Only works for the bot owners."""
+    assert ctx.author.id in configOwner
+    lines = []
+    for limiter in all_limiters:
+        lines.append(
+            f"{limiter.name}: {limiter.busy}/{limiter.total_tokens} busy, {limiter.waiting} waiting, "
+            f"mean wait {limiter.mean_wait * 1000:.1f} ms, max wait {limiter.max_wait * 1000:.1f} ms"
+        )
+    lines.append(f"Jobs queued for the database thread: {db_thread.queue_size()}")
+    lines.append(
+        f"Group commits: {write_queue.commits}, {write_queue.mean_batch_size:.1f} writes per commit"
+    )
+    lines.append(
+        f"Outbound messages: {outbound.sent} sent, {outbound.failed} failed, "
+        f"{outbound.queued} queued in {outbound.busy_channels} channels, "
+        f"mean wait {outbound.mean_wait * 1000:.1f} ms, max wait {outbound.max_wait * 1000:.1f} ms, "
+        f"mean send {outbound.mean_send_time * 1000:.1f} ms, max send {outbound.max_send_time * 1000:.1f} ms"
+    )
+    lines.append(
+        f"Log channel: {log_batcher.pending} records waiting, {log_batcher.dropped} dropped, "
+        f"{log_batcher.coalesced} coalesced into {log_batcher.batches} messages"
+    )
+    if entity_sync.enabled:
+        lines.append(
+            f"Entity sync: {entity_sync.full_syncs} guilds synced, {entity_sync.users_saved} users saved, "
+            f"{entity_sync.pending} changes waiting, {entity_sync.failures} failures"
+        )
+    for name, stats in quote_store.query_stats().items():
+        lines.append(
+            f"Query {name}: {stats['calls']:.0f} calls, {stats['errors']:.0f} errors, "
+            f"mean {stats['mean_time'] * 1000:.1f} ms, max {stats['max_time'] * 1000:.1f} ms"
+        )
+    await send_message_both(ctx, "\n".join(lines))
+
+
+all_commands.append(pool_stats)
+# This command should not get a / command version.
+
+
+@commands.command(hidden=True, name="stats")
+@is_in_owners()
+async def handler_stats(ctx: Context, name: str = "") -> None:
+    """Shows how long the events, commands and quote lookups took and how often they failed.
+
+    Only works for the bot owners.
+    Give a name to only show the handlers that have it in their name."""
+    assert ctx.author.id in configOwner
+    minutes = max(metrics.uptime / 60, 1 / 60)
+    histograms = sorted(
+        (
+            histogram
+            for histogram in metrics.histograms()
+            if histogram.calls and name.lower() in histogram.name.lower()
+        ),
+        key=lambda histogram: histogram.total_time,
+        reverse=True,
+    )
+    if not histograms:
+        await send_message_both(ctx, "Nothing was timed yet.")
+        return
+    lines = []
+    for histogram in histograms:
+        lines.append(
+            f"{histogram.kind} {histogram.name}: {histogram.calls} calls ({histogram.calls / minutes:.1f}/min), "
+            f"{histogram.errors} errors, mean {histogram.mean_time * 1000:.1f} ms, "
+            f"p50 {histogram.quantile(0.5) * 1000:.1f} ms, p95 {histogram.quantile(0.95) * 1000:.1f} ms, "
+            f"p99 {histogram.quantile(0.99) * 1000:.1f} ms, max {histogram.max_time * 1000:.1f} ms"
+        )
+    await send_message_both(ctx, "\n".join(lines))
+
+
+all_commands.append(handler_stats)
+# This command should not get a / command version.
+
+
 @commands.command(hidden=True, aliases=["eval"])
 @is_in_owners()
 async def evaluate(ctx: Context, *, message: str) -> None:
@@ -2071,21 +2611,24 @@ async def setup_bot() -> None:
         intents=intents,
     )
 
+    # Every handler is timed, see the stats command.
     for event in all_events:
-        bot.add_listener(event)
+        bot.add_listener(metrics.timed("event", event.__name__, event), event.__name__)
 
     for command in all_commands:
         bot.add_command(command)
+        metrics.time_invoke(command, "command", command.qualified_name)
 
     if all_slash_commands:
         slash = SlashCommand(bot, sync_commands=True)
         for slash_command in all_slash_commands:
-            slash.add_slash_command(
+            registered = slash.add_slash_command(
                 cmd=slash_command.command,
                 name=slash_command.name,
                 description=slash_command.description,
                 options=slash_command.options,
             )
+            metrics.time_invoke(registered, "slash", slash_command.name)
 
 
 async def cycle_playing_status_anyio(period: int = 5 * 60) -> None:
@@ -2122,16 +2665,57 @@ async def cycle_playing_status_anyio(period: int = 5 * 60) -> None:
             break
 
 
+async def database_maintenance_anyio(period: float) -> None:
+    """Runs the database maintenance every period seconds in the blocking pool."""
+    analyze = True  # The first run after startup does a full ANALYZE.
+    while True:
+        await sleep_both(period)
+        try:
+            result = await blocking_limiter.run_sync(run_maintenance, analyze)
+            logger.debug(f"Database maintenance is done: {result}")
+            analyze = False
+        except peewee.OperationalError as ex:
+            logger.warning(f"Database maintenance failed: {ex}")
+
+
 async def logging_task_anyio() -> None:
-    """Sends a log message to the log channel."""
+    """Sends the log records to the log channel, as many as fit into one message at a time."""
     while True:
-        message = await log_recv_channel.receive()
-        if not shutting_down_event.is_set():
-            if log_channel is not None:
-                await send_message_both(log_channel, message, True)
-            await sleep_both(3)
-        else:
+        message = await log_batcher.next_batch()
+        if message is None or shutting_down_event.is_set():
             break
+        if log_channel is not None:
+            await send_message_both(log_channel, message, True)
+
+
+async def load_quote_index_anyio() -> None:
+    """Loads all quotes from the quote store into the quote index, replacing what it had.
+
+    Quotes can be added or deleted while the store is read, the index records those changes
+    and applies them again on top of what was read."""
+    started = time.perf_counter()
+    quote_index.record_changes()
+    try:
+        guilds = await quote_store.read_quotes()
+        anywhere_guilds = await db_thread.run(read_anywhere_guilds)
+    except BaseException:
+        quote_index.stop_recording()
+        raise
+    quote_index.replace(guilds, anywhere_guilds)
+    logger.debug(
+        f"Loaded the quotes from the {quote_store.name} store in {time.perf_counter() - started:.2f}s."
+    )
+
+
+async def close_database_anyio() -> None:
+    """Writes the pending quote usage and the quote snapshot and closes the quote store and the database thread.
+
+    The database thread finishes the queued work first."""
+    await quote_usage.aclose()
+    if quote_snapshots is not None:
+        await quote_snapshots.aclose()
+    await quote_store.close()
+    await blocking_limiter.run_sync(db_thread.stop)
 
 
 async def main() -> None:
@@ -2147,8 +2731,43 @@ async def main() -> None:
             await setup_bot()
             assert bot is not None
             logger.debug("Initializing Database.")
-            await anyio.to_thread.run_sync(db.connect)
-            await anyio.to_thread.run_sync(db.create_tables, [Quote])
+            configure_database(database_settings.get("Storage Profile", "default"))
+            db_thread.start()
+            await db_thread.run(db.create_tables, [Quote, GuildSettings])
+            schema_version = await db_thread.run(migrate_database)
+            logger.debug(f"The database uses schema version {schema_version}.")
+            await quote_store.open()
+            snapshot = None
+            if quote_snapshots is not None:
+                snapshot = await blocking_limiter.run_sync(
+                    read_snapshot, quote_snapshots.path, quote_backend
+                )
+            if quote_snapshots is not None and snapshot is not None:
+                # Quotes work right away, the store is read in the background to catch up with it.
+                quote_index.replace(snapshot.guilds, snapshot.anywhere_guilds)
+                quote_snapshots.mark_written()
+                logger.debug(
+                    f"Loaded {snapshot.quotes} quotes from the snapshot of {time.ctime(snapshot.created_at)}."
+                )
+                # noinspection PyAsyncCall
+                task_group.start_soon(load_quote_index_anyio)
+            else:
+                await load_quote_index_anyio()
+            if quote_snapshots is not None:
+                # noinspection PyAsyncCall
+                task_group.start_soon(quote_snapshots.run)
+            # noinspection PyAsyncCall
+            task_group.start_soon(quote_usage.run)
+            if entity_sync.enabled:
+                # noinspection PyAsyncCall
+                task_group.start_soon(entity_sync.run)
+            if metrics_file:
+                # noinspection PyAsyncCall
+                task_group.start_soon(
+                    metrics.run,
+                    Path(metrics_file),
+                    settings.getfloat("Metrics Interval", fallback=15.0),
+                )
             logger.debug("Database is initialized.")
             start_cmd = partial(bot.start, loginID, reconnect=True)
             global_task_group = task_group
@@ -2157,6 +2776,14 @@ async def main() -> None:
             task_group.start_soon(start_cmd)
             # noinspection PyAsyncCall
             task_group.start_soon(cycle_playing_status_anyio)
+            maintenance_hours = database_settings.getfloat(
+                "Maintenance Interval", fallback=6.0
+            )
+            if maintenance_hours > 0:
+                # noinspection PyAsyncCall
+                task_group.start_soon(
+                    database_maintenance_anyio, maintenance_hours * 60 * 60
+                )
     except KeyboardInterrupt:
         if bot is not None:
             # This is no longer a coroutine in anyio >3.0.0 or in git version so we can suppress PyCharms warning.
@@ -2167,7 +2794,7 @@ async def main() -> None:
             raise SystemExit
     finally:
         logger.debug("Closing the Database connection.")
-        await anyio.to_thread.run_sync(db.close)
+        await close_database_anyio()
         await logger.complete()
 
 
@@ -2183,6 +2810,8 @@ if __name__ == "__main__":
             backtrace=True,  # That shows all the functions that called the function that errored.
             diagnose=True,  # This means, show all variables when a Error occurs
             enqueue=True,  # Send all messages into a queue first, that is faster.
+            compression="gz",  # The queue thread compresses old files, so the bot doesn't wait for it.
+            filter=DebugSampler(settings.getint("Debug Log Limit", fallback=10)),
         )
     else:
         logger.add(
@@ -2192,6 +2821,8 @@ if __name__ == "__main__":
             backtrace=False,
             diagnose=False,
             enqueue=True,
+            compression="gz",
+            filter=DebugSampler(settings.getint("Debug Log Limit", fallback=10)),
         )
 
     for (
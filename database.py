@@ -1,7 +1,101 @@
-from peewee import Model, IntegerField, CharField, TextField
-from playhouse.sqliteq import SqliteQueueDatabase
+from __future__ import annotations
+import difflib
+from collections import Counter
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Final,
+    Iterable,
+    Set,
+    Tuple,
+    Collection,
+    List,
+    Callable,
+)
 
-db = SqliteQueueDatabase("bot.db")
+from peewee import (
+    Model,
+    IntegerField,
+    CharField,
+    TextField,
+    BooleanField,
+    DateTimeField,
+    SqliteDatabase,
+    EXCLUDED,
+)
+
+from quote_matcher import KeywordMatcher
+from quote_usage import QuoteUsage
+
+# These are the pragmas that get applied to every new database connection.
+# WAL lets readers continue while something writes and is used by every profile.
+STORAGE_PROFILES: Final[Dict[str, Dict[str, Any]]] = {
+    # Plain SQLite settings.
+    "default": {"journal_mode": "wal"},
+    # Faster commits, but the last ones can get lost if the machine (not the bot) crashes.
+    "performance": {
+        "journal_mode": "wal",
+        "synchronous": "normal",  # With WAL, this only syncs on checkpoints.
+        "cache_size": -32_000,  # 32 MB of page cache, negative values are in KiB.
+        "mmap_size": 256 * 1024 * 1024,  # Read pages via a 256 MB memory map.
+        "temp_store": "memory",
+        "wal_autocheckpoint": 4000,  # Pages, the maintenance task checkpoints in between.
+        "journal_size_limit": 64 * 1024 * 1024,
+        # Only takes effect for new databases, older ones need a VACUUM once.
+        "auto_vacuum": "incremental",
+    },
+    # Syncs every commit to disk.
+    "safe": {"journal_mode": "wal", "synchronous": "full"},
+}
+
+# All database work of the bot runs on one dedicated thread (see async_database.py),
+# so a plain SqliteDatabase is enough and we can use transactions.
+db = SqliteDatabase("bot.db", pragmas=STORAGE_PROFILES["default"])
+
+GLOBAL_GUILD_ID: Final[int] = -1  # The guildId that is used for global quotes.
+
+
+def configure_database(profile: str = "default", path: str = "bot.db") -> None:
+    """Selects the database file and the storage profile whose pragmas are applied on connect.
+
+    This must be called before the database thread is started.
+    :raises: ValueError if the profile doesn't exist.
+    """
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(
+            f"Unknown storage profile {profile}, use one of {', '.join(STORAGE_PROFILES)}."
+        )
+    db.init(path, pragmas=STORAGE_PROFILES[profile])
+
+
+def run_maintenance(analyze: bool = False, vacuum_pages: int = 1000) -> Dict[str, int]:
+    """Runs the periodic database maintenance.
+
+    This updates the query planner statistics, gives free pages back to the file system if the database
+    uses incremental auto vacuum and checkpoints the WAL without waiting for readers or writers.
+    It uses its own connection, so it can run in any thread while the database thread keeps working.
+    :param analyze: Whether to run a full ANALYZE instead of letting PRAGMA optimize decide.
+    :param vacuum_pages: How many free pages to give back at most.
+    :return: Some numbers about what was done.
+    """
+    with db.connection_context():
+        if analyze:
+            db.execute_sql("ANALYZE")
+        db.execute_sql("PRAGMA optimize")
+        free_pages = db.execute_sql("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = db.execute_sql("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum == 2 and free_pages:  # 2 means incremental.
+            db.execute_sql(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+        busy, wal_pages, checkpointed = db.execute_sql(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).fetchone()
+    return {
+        "free_pages": free_pages,
+        "wal_pages": wal_pages,
+        "checkpointed_pages": checkpointed,
+        "checkpoint_blocked": busy,
+    }
 
 
 class BaseModel(Model):
@@ -16,12 +110,759 @@ class Quote(BaseModel):
     guildId: int
     keyword: char
     result: text
-    authorId: int"""
+    authorId: int
+    timesUsed: int, how often the quote was triggered.
+    lastUsedAt: datetime, optional
+    lastUsedBy: int, optional, the ID of the user that triggered the quote last.
+    lastUsedIn: int, optional, the ID of the channel the quote was triggered in last."""
 
     guildId = IntegerField()
     keyword = CharField()
     result = TextField(null=False)
     authorId = IntegerField(null=False)
+    timesUsed = IntegerField(default=0)
+    lastUsedAt = DateTimeField(null=True)
+    lastUsedBy = IntegerField(null=True)
+    lastUsedIn = IntegerField(null=True)
+
+
+# Every guild can only have one quote per keyword, which also makes it usable as upsert conflict target.
+# SQLite has no INCLUDE columns, so the result is read through the rowid after the index seek.
+Quote.add_index(Quote.guildId, Quote.keyword, unique=True)
+
+
+class GuildSettings(BaseModel):
+    """Represents the settings of a Discord guild.
+
+    Fields:
+    guildId: int
+    quotesAnywhere: bool, whether quotes trigger anywhere in a message instead of only on exact matches."""
+
+    guildId = IntegerField(unique=True)
+    quotesAnywhere = BooleanField(default=False)
+
+
+def _dedupe_quotes(batch_size: int = 500) -> None:
+    """Deletes all but the newest quote of every (guildId, keyword) pair.
+
+    Every batch of duplicate pairs is deleted in its own transaction, so the database never stays locked for long."""
+    while True:
+        with db.atomic():
+            duplicates = db.execute_sql(
+                "SELECT guildId, keyword, MAX(id) FROM quote"
+                " GROUP BY guildId, keyword HAVING COUNT(*) > 1 LIMIT ?",
+                (batch_size,),
+            ).fetchall()
+            for guild_id, keyword, newest in duplicates:
+                Quote.delete().where(
+                    Quote.guildId == guild_id,
+                    Quote.keyword == keyword,
+                    Quote.id < newest,
+                ).execute()
+        if len(duplicates) < batch_size:
+            return
+
+
+def _make_quote_index_unique() -> None:
+    """Replaces the old (guildId, keyword) index with a unique one."""
+    _dedupe_quotes()
+    with db.atomic():
+        db.execute_sql('DROP INDEX IF EXISTS "quote_guildId_keyword"')
+        db.create_tables([Quote])  # This recreates the missing index.
+
+
+def _add_usage_columns() -> None:
+    """Adds the usage statistics columns to the Quote table."""
+    existing = {column.name for column in db.get_columns("quote")}
+    columns = {
+        "timesUsed": "INTEGER NOT NULL DEFAULT 0",
+        "lastUsedAt": "DATETIME",
+        "lastUsedBy": "INTEGER",
+        "lastUsedIn": "INTEGER",
+    }
+    with db.atomic():
+        for name, definition in columns.items():
+            if name not in existing:
+                db.execute_sql(f'ALTER TABLE "quote" ADD COLUMN "{name}" {definition}')
+
+
+def _add_quote_search_index() -> None:
+    """Adds the full text search index over the keywords and texts of the quotes.
+
+    It is an FTS5 table with the trigram tokenizer, so it finds any substring of at least three characters.
+    The index only stores the tokens and points back to the Quote table, triggers keep it in sync."""
+    statements = [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS "quote_search" USING fts5(
+            keyword, result, content='quote', content_rowid='id', tokenize='trigram'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS "quote_search_insert" AFTER INSERT ON "quote" BEGIN
+            INSERT INTO quote_search(rowid, keyword, result) VALUES (new.id, new.keyword, new.result);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS "quote_search_delete" AFTER DELETE ON "quote" BEGIN
+            INSERT INTO quote_search(quote_search, rowid, keyword, result)
+            VALUES ('delete', old.id, old.keyword, old.result);
+        END""",
+        # Only changes to the keyword or text touch the index, not the usage statistics.
+        """CREATE TRIGGER IF NOT EXISTS "quote_search_update" AFTER UPDATE OF keyword, result ON "quote" BEGIN
+            INSERT INTO quote_search(quote_search, rowid, keyword, result)
+            VALUES ('delete', old.id, old.keyword, old.result);
+            INSERT INTO quote_search(rowid, keyword, result) VALUES (new.id, new.keyword, new.result);
+        END""",
+        "INSERT INTO quote_search(quote_search) VALUES ('rebuild')",
+    ]
+    with db.atomic():
+        for statement in statements:
+            db.execute_sql(statement)
+
+
+# The schema changes for existing databases, the position in this list is the schema version they lead to.
+MIGRATIONS: Final[List[Callable[[], None]]] = [
+    _make_quote_index_unique,
+    _add_usage_columns,
+    _add_quote_search_index,
+]
+
+
+def migrate_database() -> int:
+    """Brings an existing database up to the newest schema version.
+
+    The version is stored in PRAGMA user_version, every migration only runs once.
+    This blocks, so it should run on the database thread after the tables were created.
+    :return: The schema version of the database.
+    """
+    version = db.execute_sql("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if version >= number:
+            continue
+        migration()
+        db.execute_sql(f"PRAGMA user_version = {number}")
+        version = number
+    return version
+
+
+def run_in_transaction(
+    jobs: List[Tuple[Callable[..., Any], Tuple[Any, ...]]]
+) -> List[Tuple[Optional[Exception], Any]]:
+    """Runs many writes in one transaction, so they share a single commit.
+
+    Every write gets its own savepoint, so a failing write is rolled back alone and the others are still committed.
+    This blocks, so it should run on the database thread.
+    :param jobs: (function, arguments) pairs.
+    :return: (the exception or None, the result) for every job, in the same order.
+    """
+    results: List[Tuple[Optional[Exception], Any]] = []
+    if len(jobs) == 1:
+        # A single write needs no extra transaction or savepoint.
+        func, args = jobs[0]
+        try:
+            results.append((None, func(*args)))
+        except Exception as error:  # pylint: disable=broad-except
+            results.append((error, None))
+        return results
+    with db.atomic():
+        for func, args in jobs:
+            try:
+                with db.atomic():
+                    results.append((None, func(*args)))
+            except Exception as error:  # pylint: disable=broad-except
+                results.append((error, None))
+    return results
+
+
+def set_quotes_anywhere(guild_id: int, enabled: bool) -> None:
+    """Saves whether quotes trigger anywhere in messages of that guild.
+
+    This blocks, so it should run on the database thread."""
+    GuildSettings.insert(guildId=guild_id, quotesAnywhere=enabled).on_conflict(
+        conflict_target=[GuildSettings.guildId],
+        update={GuildSettings.quotesAnywhere: enabled},
+    ).execute()
+
+
+def resolve_quote(guild_id: Optional[int], text: str) -> Optional[str]:
+    """Gets a quote from the database with a single query.
+
+    Guild and global candidates are fetched together using the (guildId, keyword) index
+    and the guild quote is preferred over the global one.
+    This blocks, so it should run on the database thread.
+    :param guild_id: The ID of the guild to check, or None for private channels.
+    :param text: The keyword to search for
+    :return: Either the found quote text, or None if nothing was found.
+    """
+    guild_ids = [GLOBAL_GUILD_ID] if guild_id is None else [guild_id, GLOBAL_GUILD_ID]
+    query = (
+        Quote.select(Quote.result)
+        .where(Quote.guildId.in_(guild_ids), Quote.keyword == text.lower())
+        .order_by(Quote.guildId == GLOBAL_GUILD_ID)
+        .limit(1)
+    )
+    result = query.scalar()
+    return None if result is None else str(result)
+
+
+def add_quote(guild_id: int, keyword: str, text: str, author_id: int) -> None:
+    """Saves a quote to the database, replacing the quote with the same keyword in that guild.
+
+    This is a single INSERT ... ON CONFLICT DO UPDATE statement.
+    This blocks, so it should run on the database thread."""
+    Quote.insert(
+        guildId=guild_id, keyword=keyword.lower(), result=text, authorId=author_id
+    ).on_conflict(
+        conflict_target=[Quote.guildId, Quote.keyword],
+        update={Quote.result: EXCLUDED.result, Quote.authorId: EXCLUDED.authorId},
+    ).execute()
+
+
+def add_global_quote(
+    keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+) -> bool:
+    """Saves a global quote to the database with a single statement.
+
+    This blocks, so it should run on the database thread.
+    :param overwrite: Whether an existing global quote with that keyword gets replaced.
+    :return: Whether the quote was saved."""
+    if overwrite:
+        add_quote(GLOBAL_GUILD_ID, keyword, text, author_id)
+        return True
+    query = Quote.insert(
+        guildId=GLOBAL_GUILD_ID,
+        keyword=keyword.lower(),
+        result=text,
+        authorId=author_id,
+    ).on_conflict_ignore()
+    return bool(db.execute(query).rowcount)
+
+
+def delete_quote(guild_id: int, keyword: str) -> bool:
+    """Deletes the quote with the given keyword from that guild.
+
+    This blocks, so it should run on the database thread.
+    :return: Whether a quote was deleted."""
+    deleted = (
+        Quote.delete()
+        .where(Quote.guildId == guild_id, Quote.keyword == keyword.lower())
+        .execute()
+    )
+    return bool(deleted)
+
+
+def record_usage(usages: Iterable[QuoteUsage]) -> None:
+    """Adds the usage statistics of many quotes in one transaction.
+
+    This blocks, so it should run on the database thread."""
+    with db.atomic():
+        for usage in usages:
+            Quote.update(
+                timesUsed=Quote.timesUsed + usage.uses,
+                # Stored as naive UTC, peewee can't read the time zone back.
+                lastUsedAt=usage.last_used_at.replace(tzinfo=None),
+                lastUsedBy=usage.last_used_by,
+                lastUsedIn=usage.last_used_in,
+            ).where(
+                Quote.guildId == usage.guild_id, Quote.keyword == usage.keyword
+            ).execute()
+
+
+def list_keywords_page(
+    guild_id: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: Optional[str] = None,
+    limit: int = 50,
+) -> List[str]:
+    """Gets one page of the keywords of a guild in alphabetical order.
+
+    This uses keyset pagination on the unique (guildId, keyword) index, so every page is a single index range scan,
+    no matter how far into the list it is.
+    This blocks, so it should run on the database thread.
+    :param after: Only get keywords after this one, for the next page.
+    :param before: Only get the keywords right before this one, for the previous page.
+    :param start: Only get keywords from this one on.
+    :param limit: How many keywords to get at most.
+    :return: The keywords in alphabetical order.
+    """
+    query = Quote.select(Quote.keyword).where(Quote.guildId == guild_id)
+    if start is not None:
+        query = query.where(Quote.keyword >= start.lower())
+    if before is not None:
+        query = query.where(Quote.keyword < before).order_by(Quote.keyword.desc())
+        return [keyword for (keyword,) in query.limit(limit).tuples()][::-1]
+    if after is not None:
+        query = query.where(Quote.keyword > after)
+    return [
+        keyword for (keyword,) in query.order_by(Quote.keyword).limit(limit).tuples()
+    ]
+
+
+def list_keywords(guild_id: int) -> List[str]:
+    """Gets the keywords of all quotes of a guild.
+
+    This blocks, so it should run on the database thread."""
+    query = Quote.select(Quote.keyword).where(Quote.guildId == guild_id).tuples()
+    return [keyword for (keyword,) in query]
+
+
+# Every keyword that starts with the search text sorts before the search text followed by this.
+_LAST_CHARACTER: Final[str] = "\U0010ffff"
+_SEARCH_QUERY: Final[
+    str
+] = """
+    SELECT quote.keyword, quote.result FROM quote_search
+    JOIN quote ON quote.id = quote_search.rowid
+    WHERE quote_search MATCH ? AND quote.guildId = ?
+    ORDER BY bm25(quote_search, 10.0, 1.0)
+    LIMIT ?
+"""
+
+
+def _fts_phrase(text: str) -> str:
+    """Quotes text for an FTS5 MATCH, so it is searched as it is."""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def closest_keywords(text: str, keywords: Iterable[str], limit: int) -> List[str]:
+    """Finds the keywords that look most like the text, for typos in a search.
+
+    :return: Up to `limit` keywords, the most similar first.
+    """
+    return difflib.get_close_matches(text, list(keywords), n=limit, cutoff=0.6)
+
+
+def search_quotes(guild_id: int, text: str, limit: int = 10) -> List[Tuple[str, str]]:
+    """Searches the quotes of a guild by keyword and text.
+
+    Keywords that start with the text come first, found with the (guildId, keyword) index.
+    Then come quotes that contain the text in their keyword or text, found with the trigram index.
+    If that is not enough, the keywords that share trigrams with the text are ranked by how similar they are,
+    which finds keywords with typos in them.
+    This blocks, so it should run on the database thread.
+    :param text: What to search for, at least three characters are needed for anything but the prefix search.
+    :param limit: How many quotes to return at most.
+    :return: (keyword, quote text) pairs, the best matches first.
+    """
+    text = text.strip().lower()
+    if not text:
+        return []
+    prefix_query = (
+        Quote.select(Quote.keyword, Quote.result)
+        .where(
+            Quote.guildId == guild_id,
+            Quote.keyword >= text,
+            Quote.keyword < text + _LAST_CHARACTER,
+        )
+        .order_by(Quote.keyword)
+        .limit(limit)
+        .tuples()
+    )
+    results: Dict[str, str] = dict(prefix_query)
+    # The trigram index can't find anything shorter than a trigram.
+    if len(results) >= limit or len(text) < 3:
+        return list(results.items())[:limit]
+    for keyword, result in db.execute_sql(
+        _SEARCH_QUERY, (_fts_phrase(text), guild_id, limit + len(results))
+    ):
+        results.setdefault(keyword, result)
+    if len(results) >= limit:
+        return list(results.items())[:limit]
+    trigrams = {text[start : start + 3] for start in range(len(text) - 2)}
+    fuzzy_match = "keyword : (" + " OR ".join(map(_fts_phrase, trigrams)) + ")"
+    candidates = dict(db.execute_sql(_SEARCH_QUERY, (fuzzy_match, guild_id, 200)))
+    for keyword in closest_keywords(text, candidates, limit):
+        results.setdefault(keyword, candidates[keyword])
+    return list(results.items())[:limit]
+
+
+# (guild id or None for private channels, lower case keyword)
+QuoteKey = Tuple[Optional[int], str]
+# (guild id of the quote or GLOBAL_GUILD_ID, lower case keyword, quote text)
+QuoteMatch = Tuple[int, str, str]
+
+
+def resolve_quotes(keys: Collection[QuoteKey]) -> Dict[QuoteKey, Optional[str]]:
+    """Gets the quotes for many (guild id, keyword) pairs with a single IN (...) query.
+
+    Like resolve_quote, a guild quote is preferred over a global one.
+    This blocks, so it should run on the database thread.
+    :param keys: The (guild id, lower case keyword) pairs to look up.
+    :return: The found quote text or None for every key.
+    """
+    guild_ids = {guild_id for guild_id, _ in keys if guild_id is not None}
+    guild_ids.add(GLOBAL_GUILD_ID)
+    keywords = {keyword for _, keyword in keys}
+    found: Dict[Tuple[int, str], str] = {}
+    query = (
+        Quote.select(Quote.guildId, Quote.keyword, Quote.result)
+        .where(Quote.guildId.in_(list(guild_ids)), Quote.keyword.in_(list(keywords)))
+        .order_by(Quote.id)
+        .tuples()
+    )
+    for guild_id, keyword, result in query:
+        found[(guild_id, keyword)] = result
+    results: Dict[QuoteKey, Optional[str]] = {}
+    for guild_id, keyword in keys:
+        result = found.get((guild_id, keyword)) if guild_id is not None else None
+        if result is None:
+            result = found.get((GLOBAL_GUILD_ID, keyword))
+        results[(guild_id, keyword)] = result
+    return results
+
+
+def read_quotes(guild_id: Optional[int] = None) -> Dict[int, Dict[str, str]]:
+    """Reads all quotes, or only the quotes of one guild.
+
+    This blocks, so it should run on the database thread.
+    :return: guild id -> keyword -> quote text, global quotes use GLOBAL_GUILD_ID.
+    """
+    query = Quote.select(Quote.guildId, Quote.keyword, Quote.result)
+    if guild_id is not None:
+        query = query.where(Quote.guildId == guild_id)
+    guilds: Dict[int, Dict[str, str]] = {}
+    for quote_guild, keyword, result in query.tuples().iterator():
+        guilds.setdefault(quote_guild, {})[keyword] = result
+    return guilds
+
+
+def read_quote_rows(
+    after_id: int, guild_id: Optional[int] = None, limit: int = 1000
+) -> List[Tuple[int, int, str, str, int]]:
+    """Reads the next batch of quotes ordered by id, for streaming through all of them.
+
+    Every batch is a keyset query (WHERE id > last id), so it costs the same at any position.
+    This blocks, so it should run on the database thread.
+    :param after_id: The id of the last quote of the batch before, 0 for the first batch.
+    :param guild_id: Only read the quotes of this guild, or all quotes if None.
+    :return: (id, guild id, keyword, quote text, author id) rows, an empty list at the end.
+    """
+    query = Quote.select(
+        Quote.id, Quote.guildId, Quote.keyword, Quote.result, Quote.authorId
+    ).where(Quote.id > after_id)
+    if guild_id is not None:
+        query = query.where(Quote.guildId == guild_id)
+    return list(query.order_by(Quote.id).limit(limit).tuples())
+
+
+def import_quotes(quotes: List[Dict[str, Any]], overwrite: bool = False) -> int:
+    """Saves many quotes in one transaction with a single multi-row INSERT.
+
+    This blocks, so it should run on the database thread.
+    :param quotes: Dicts with guildId, keyword (lower case), result and authorId.
+    :param overwrite: Whether quotes with the same keyword in the same guild get replaced, otherwise they are kept.
+    :return: How many quotes were inserted or replaced.
+    """
+    if not quotes:
+        return 0
+    query = Quote.insert_many(quotes)
+    if overwrite:
+        query = query.on_conflict(
+            conflict_target=[Quote.guildId, Quote.keyword],
+            update={Quote.result: EXCLUDED.result, Quote.authorId: EXCLUDED.authorId},
+        )
+    else:
+        query = query.on_conflict_ignore()
+    with db.atomic():
+        return db.execute(query).rowcount
+
+
+def read_anywhere_guilds() -> Set[int]:
+    """Reads the IDs of the guilds where quotes trigger anywhere in a message.
+
+    This blocks, so it should run on the database thread."""
+    query = GuildSettings.select(GuildSettings.guildId).where(
+        GuildSettings.quotesAnywhere == True
+    )
+    return {guild_id for (guild_id,) in query.tuples()}
+
+
+class QuotePrefilter:
+    """A cheap check whether a message could be a quote trigger at all.
+
+    For every guild this remembers which keyword lengths and which first characters exist.
+    A message whose length or first character fits no keyword of its guild or the global quotes
+    can never be a quote, so the quote lookup can be skipped after a few hash probes.
+    The filter can have false positives, but never false negatives."""
+
+    def __init__(self) -> None:
+        self._lengths: Dict[int, Counter[int]] = {}
+        self._first_chars: Dict[int, Counter[str]] = {}
+        self.checks = 0  # How many messages were checked.
+        self.rejected = 0  # How many messages the filter ruled out.
+        self.false_positives = (
+            0  # How many messages passed the filter but had no quote.
+        )
+
+    def clear(self) -> None:
+        """Forgets all keywords, but keeps the counters."""
+        self._lengths = {}
+        self._first_chars = {}
+
+    def add(self, guild_id: int, keyword: str) -> None:
+        """Adds a keyword to the filter."""
+        self._lengths.setdefault(guild_id, Counter())[len(keyword)] += 1
+        self._first_chars.setdefault(guild_id, Counter())[keyword[:1]] += 1
+
+    def add_many(self, guild_id: int, keywords: Collection[str]) -> None:
+        """Adds many keywords of a guild to the filter, counting them in bulk is much faster than one by one."""
+        self._lengths.setdefault(guild_id, Counter()).update(map(len, keywords))
+        self._first_chars.setdefault(guild_id, Counter()).update(
+            keyword[:1] for keyword in keywords
+        )
+
+    def discard(self, guild_id: int, keyword: str) -> None:
+        """Removes a keyword from the filter."""
+        for counters, key in (
+            (self._lengths, len(keyword)),
+            (self._first_chars, keyword[:1]),
+        ):
+            counter = counters.get(guild_id)
+            if counter is None or key not in counter:
+                continue
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+            if not counter:
+                del counters[guild_id]
+
+    def discard_guild(self, guild_id: int) -> None:
+        """Removes all keywords of a guild from the filter."""
+        self._lengths.pop(guild_id, None)
+        self._first_chars.pop(guild_id, None)
+
+    def _fits(self, guild_id: int, text: str) -> bool:
+        lengths = self._lengths.get(guild_id)
+        if lengths is None or len(text) not in lengths:
+            return False
+        return text[:1] in self._first_chars[guild_id]
+
+    def might_match(self, guild_id: Optional[int], text: str) -> bool:
+        """Checks whether the given lower case text could be a quote keyword in that guild.
+
+        :param guild_id: The ID of the guild to check, or None for private channels.
+        :param text: The lower case message text.
+        :return: False if the text definitely isn't a keyword, True if it might be one.
+        """
+        self.checks += 1
+        if (guild_id is not None and self._fits(guild_id, text)) or self._fits(
+            GLOBAL_GUILD_ID, text
+        ):
+            return True
+        self.rejected += 1
+        return False
+
+    def record_false_positive(self) -> None:
+        """Should be called when a text passed the filter, but there was no quote for it."""
+        self.false_positives += 1
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of checked messages that the filter ruled out."""
+        return self.rejected / self.checks if self.checks else 0.0
+
+    @property
+    def false_positive_rate(self) -> float:
+        """The share of messages that passed the filter without having a quote."""
+        passed = self.checks - self.rejected
+        return self.false_positives / passed if passed else 0.0
+
+
+class QuoteIndex:
+    """An in-memory copy of the Quote table, so that checking for a quote trigger is just a dict lookup.
+
+    The quotes are stored as guild id -> keyword -> quote text, global quotes use GLOBAL_GUILD_ID as guild id.
+    Everything that changes the Quote table must also update this index."""
+
+    def __init__(self, prefilter: QuotePrefilter) -> None:
+        self._guilds: Dict[int, Dict[str, str]] = {}
+        self._matchers: Dict[int, KeywordMatcher] = {}  # Only built once needed.
+        self.prefilter = prefilter
+        self.anywhere_guilds: Set[int] = set()  # Guilds where quotes trigger anywhere.
+        self.loaded = False
+        self.changes = 0  # Goes up with every change of the quotes, so a snapshot knows if it is outdated.
+        # The changes made while the quotes are read for replace(), see record_changes.
+        self._journal: Optional[
+            List[Tuple[Callable[..., None], Tuple[Any, ...]]]
+        ] = None
+
+    def _add_to_prefilter(self, guild_id: int, keywords: Collection[str]) -> None:
+        self.prefilter.add_many(guild_id, keywords)
+
+    def record_changes(self) -> None:
+        """Remembers every change from now on until the next replace(), which applies them again.
+
+        Reading all quotes takes a while and quotes can be added or deleted meanwhile,
+        so replacing the index with what was read would lose those changes otherwise."""
+        self._journal = []
+
+    def stop_recording(self) -> None:
+        """Forgets the recorded changes, for when the quotes couldn't be read."""
+        self._journal = None
+
+    def _record(self, change: Callable[..., None], *args: Any) -> None:
+        if self._journal is not None:
+            self._journal.append((change, args))
+
+    def replace(
+        self, guilds: Dict[int, Dict[str, str]], anywhere_guilds: Set[int]
+    ) -> None:
+        """Replaces the whole index, for example with the quotes read from a quote store.
+
+        The changes recorded since record_changes() are applied again on top.
+        :param guilds: guild id -> keyword -> quote text, global quotes use GLOBAL_GUILD_ID.
+        :param anywhere_guilds: The guilds where quotes trigger anywhere in a message.
+        """
+        journal, self._journal = self._journal, None
+        self.anywhere_guilds = set(anywhere_guilds)
+        self.prefilter.clear()
+        for guild_id, quotes in guilds.items():
+            self._add_to_prefilter(guild_id, quotes)
+        self._guilds = guilds
+        self._matchers = {}
+        self.loaded = True
+        self.changes += 1
+        for change, args in journal or ():
+            change(*args)
+
+    def load(self) -> None:
+        """Loads all quotes from the SQLite database into the index.
+
+        This blocks, so it should run on the database thread."""
+        self.replace(read_quotes(), read_anywhere_guilds())
+
+    def load_guild(self, guild_id: int) -> None:
+        """(Re)loads the quotes of a single guild from the SQLite database.
+
+        This blocks, so it should run on the database thread."""
+        self.replace_guild(guild_id, read_quotes(guild_id).get(guild_id, {}))
+
+    def replace_guild(self, guild_id: int, quotes: Dict[str, str]) -> None:
+        """Replaces the quotes of a single guild in the index."""
+        self._record(self.replace_guild, guild_id, dict(quotes))
+        self.changes += 1
+        self.prefilter.discard_guild(guild_id)
+        self._matchers.pop(guild_id, None)
+        if quotes:
+            self._add_to_prefilter(guild_id, quotes)
+            self._guilds[guild_id] = quotes
+        else:
+            self._guilds.pop(guild_id, None)
+
+    def export(self) -> Tuple[Dict[int, Dict[str, str]], Set[int]]:
+        """Gets the quotes and the anywhere guilds as they are stored, for writing a snapshot.
+
+        These are not copies, so they must be serialized before the index changes again."""
+        return self._guilds, self.anywhere_guilds
+
+    def count(self, guild_id: int) -> int:
+        """How many quotes a guild has."""
+        return len(self._guilds.get(guild_id, ()))
+
+    def match(self, guild_id: Optional[int], text: str) -> Optional[QuoteMatch]:
+        """Like get, but also tells which quote was found."""
+        keyword = text.lower()
+        if guild_id is not None:
+            quotes = self._guilds.get(guild_id)
+            if quotes is not None:
+                result = quotes.get(keyword)
+                if result is not None:
+                    return guild_id, keyword, result
+        global_quotes = self._guilds.get(GLOBAL_GUILD_ID)
+        if global_quotes is not None:
+            result = global_quotes.get(keyword)
+            if result is not None:
+                return GLOBAL_GUILD_ID, keyword, result
+        return None
+
+    def get(self, guild_id: Optional[int], text: str) -> Optional[str]:
+        """Gets the quote for the given text.
+
+        It prefers a guild specific quote, but if it can't find a guild quote, it will also look for a global quote.
+        :param guild_id: The ID of the guild to check, or None for private channels.
+        :param text: The keyword to search for
+        :return: Either the found quote text, or None if nothing was found.
+        """
+        found = self.match(guild_id, text)
+        return None if found is None else found[2]
+
+    def _matcher(self, guild_id: int) -> Optional[KeywordMatcher]:
+        """Gets the keyword matcher of a guild, building it on first use."""
+        matcher = self._matchers.get(guild_id)
+        if matcher is None:
+            quotes = self._guilds.get(guild_id)
+            if not quotes:
+                return None
+            matcher = KeywordMatcher(quotes)
+            self._matchers[guild_id] = matcher
+        return matcher
+
+    def match_anywhere(self, guild_id: int, text: str) -> Optional[QuoteMatch]:
+        """Like find_anywhere, but also tells which quote was found."""
+        text = text.lower()
+        for quote_guild in (guild_id, GLOBAL_GUILD_ID):
+            matcher = self._matcher(quote_guild)
+            if matcher is None:
+                continue
+            keyword = matcher.find(text)
+            if keyword is not None:
+                return quote_guild, keyword, self._guilds[quote_guild][keyword]
+        return None
+
+    def find_anywhere(self, guild_id: int, text: str) -> Optional[str]:
+        """Gets the quote whose keyword appears as a whole word anywhere in the text.
+
+        Guild quotes are preferred over global quotes.
+        :param guild_id: The ID of the guild to check.
+        :param text: The message text.
+        :return: Either the found quote text, or None if nothing was found.
+        """
+        found = self.match_anywhere(guild_id, text)
+        return None if found is None else found[2]
+
+    def set(self, guild_id: int, keyword: str, text: str) -> None:
+        """Adds or replaces a quote in the index."""
+        self._record(self.set, guild_id, keyword, text)
+        self.changes += 1
+        keyword = keyword.lower()
+        quotes = self._guilds.setdefault(guild_id, {})
+        if keyword not in quotes:
+            self.prefilter.add(guild_id, keyword)
+            matcher = self._matchers.get(guild_id)
+            if matcher is not None:
+                matcher.add(keyword)
+        quotes[keyword] = text
+
+    def remove(self, guild_id: int, keyword: str) -> None:
+        """Removes a quote from the index if it is in there."""
+        self._record(self.remove, guild_id, keyword)
+        quotes = self._guilds.get(guild_id)
+        if quotes is None:
+            return
+        keyword = keyword.lower()
+        if keyword in quotes:
+            self.changes += 1
+            del quotes[keyword]
+            self.prefilter.discard(guild_id, keyword)
+            matcher = self._matchers.get(guild_id)
+            if matcher is not None:
+                matcher.remove(keyword)
+        if not quotes:
+            del self._guilds[guild_id]
+            self._matchers.pop(guild_id, None)
+
+    def drop_guild(self, guild_id: int) -> None:
+        """Removes all quotes of a guild from the index, for example when the bot leaves that guild."""
+        self._record(self.drop_guild, guild_id)
+        self.changes += 1
+        self._guilds.pop(guild_id, None)
+        self._matchers.pop(guild_id, None)
+        self.prefilter.discard_guild(guild_id)
+
+    def set_anywhere(self, guild_id: int, enabled: bool) -> None:
+        """Sets whether the quotes of a guild trigger anywhere in a message."""
+        self._record(self.set_anywhere, guild_id, enabled)
+        if enabled:
+            self.anywhere_guilds.add(guild_id)
+        else:
+            self.anywhere_guilds.discard(guild_id)
 
 
-Quote.add_index(Quote.guildId, Quote.keyword)
+quote_prefilter = QuotePrefilter()
+quote_index = QuoteIndex(quote_prefilter)
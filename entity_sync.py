@@ -0,0 +1,206 @@
+from __future__ import annotations
+from typing import Awaitable, Dict, List, Optional, Set, Tuple
+
+import anyio
+import discord
+from loguru import logger
+
+from quote_store import QuoteStore
+
+
+class EntitySync:
+    """Saves the guilds, members and channels the bot sees to the quote store, in the background.
+
+    A full sync of a guild streams its members in chunks of `chunk_size`, every chunk is saved with one query,
+    and it pauses for `pause` seconds between chunks, so commands and quotes always come first.
+    After that, the events of the bot only queue diffs: users that changed, members that joined or left
+    and channels that were created or renamed. They are collected for `interval` seconds and saved together.
+    One task does all the writing, so the sync never uses more than one database connection.
+    Nothing is queued if the store doesn't keep entities, and writes that fail are logged and dropped,
+    the next full sync after a reconnect repairs them."""
+
+    def __init__(
+        self,
+        store: QuoteStore,
+        chunk_size: int = 500,
+        interval: float = 5.0,
+        pause: float = 0.1,
+    ) -> None:
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1.")
+        if interval < 0 or pause < 0:
+            raise ValueError("The sync interval and pause can't be negative.")
+        self.store = store
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.pause = pause
+        self.enabled = store.saves_entities
+        # The guilds that wait for a full sync, by ID.
+        self._guilds: Dict[int, discord.Guild] = {}
+        # The guilds whose name changed, by ID.
+        self._renamed: Dict[int, discord.Guild] = {}
+        self._users: Dict[int, Tuple[str, str]] = {}
+        self._joined: Dict[int, Set[int]] = {}
+        self._left: Dict[int, Set[int]] = {}
+        self._channels: Dict[int, Dict[int, str]] = {}
+        # This needs a running event loop, so it is created once the sync runs.
+        self._wake: Optional[anyio.Event] = None
+        self.full_syncs = 0  # How many guilds were fully synced.
+        self.users_saved = 0  # How many users were handed to the store.
+        self.failures = 0
+
+    @property
+    def pending(self) -> int:
+        """How many guilds, users and member changes are waiting to be saved."""
+        return (
+            len(self._guilds)
+            + len(self._renamed)
+            + len(self._users)
+            + sum(len(ids) for ids in self._joined.values())
+            + sum(len(ids) for ids in self._left.values())
+            + sum(len(channels) for channels in self._channels.values())
+        )
+
+    def _wake_up(self) -> None:
+        if self._wake is not None:
+            self._wake.set()
+
+    def sync_guild(self, guild: discord.Guild) -> None:
+        """Queues a full sync of a guild with all of its members and channels."""
+        if not self.enabled:
+            return
+        self._guilds[guild.id] = guild
+        # The full sync saves the current state, so the older diffs of this guild are not needed.
+        self._renamed.pop(guild.id, None)
+        self._joined.pop(guild.id, None)
+        self._left.pop(guild.id, None)
+        self._channels.pop(guild.id, None)
+        self._wake_up()
+
+    def guild_changed(self, guild: discord.Guild) -> None:
+        """Queues saving the new name of a guild."""
+        if self.enabled and guild.id not in self._guilds:
+            self._renamed[guild.id] = guild
+            self._wake_up()
+
+    def user_changed(self, user: discord.abc.User) -> None:
+        """Queues saving the new name or tag of a user."""
+        if self.enabled:
+            self._users[user.id] = (user.name, user.discriminator)
+            self._wake_up()
+
+    def member_joined(self, member: discord.Member) -> None:
+        """Queues adding a member to its guild."""
+        if not self.enabled or member.guild.id in self._guilds:
+            return
+        self.user_changed(member)
+        self._joined.setdefault(member.guild.id, set()).add(member.id)
+        self._left.get(member.guild.id, set()).discard(member.id)
+
+    def member_left(self, member: discord.Member) -> None:
+        """Queues removing a member from its guild."""
+        if not self.enabled or member.guild.id in self._guilds:
+            return
+        self._left.setdefault(member.guild.id, set()).add(member.id)
+        self._joined.get(member.guild.id, set()).discard(member.id)
+        self._wake_up()
+
+    def channel_changed(self, channel: discord.abc.GuildChannel) -> None:
+        """Queues saving a channel that was created or renamed."""
+        if self.enabled and channel.guild.id not in self._guilds:
+            self._channels.setdefault(channel.guild.id, {})[channel.id] = channel.name
+            self._wake_up()
+
+    async def _try(self, what: str, write: Awaitable[None]) -> bool:
+        try:
+            await write
+        except Exception:  # pylint: disable=broad-except
+            self.failures += 1
+            logger.exception(f"Could not save {what}.")
+            return False
+        return True
+
+    async def _save_users(self, users: List[Tuple[int, str, str]]) -> bool:
+        """Saves users in chunks and pauses between them."""
+        for start in range(0, len(users), self.chunk_size):
+            if start:
+                await anyio.sleep(self.pause)
+            chunk = users[start : start + self.chunk_size]
+            if not await self._try(f"{len(chunk)} users", self.store.save_users(chunk)):
+                return False
+            self.users_saved += len(chunk)
+        return True
+
+    async def _sync_guild(self, guild: discord.Guild) -> None:
+        members = guild.members
+        users = [(member.id, member.name, member.discriminator) for member in members]
+        if not await self._save_users(users):
+            return
+        saved = await self._try(
+            f"the guild {guild.id}",
+            self.store.save_guild(
+                guild.id,
+                guild.name,
+                [member.id for member in members],
+                self.chunk_size,
+            ),
+        )
+        if not saved:
+            return
+        channels = [(channel.id, channel.name) for channel in guild.channels]
+        if channels and not await self._try(
+            f"the channels of the guild {guild.id}",
+            self.store.save_guild_channels(guild.id, channels),
+        ):
+            return
+        self.full_syncs += 1
+        logger.debug(
+            f"Synced the guild {guild.id} with {len(users)} members and {len(channels)} channels."
+        )
+
+    async def flush(self) -> None:
+        """Saves everything that is queued now, full syncs first."""
+        while self._guilds:
+            guild_id = next(iter(self._guilds))
+            await self._sync_guild(self._guilds.pop(guild_id))
+            await anyio.sleep(self.pause)
+        users, self._users = self._users, {}
+        renamed, self._renamed = self._renamed, {}
+        joined, self._joined = self._joined, {}
+        left, self._left = self._left, {}
+        channels, self._channels = self._channels, {}
+        # Members can only be added to a guild once they are saved as users.
+        await self._save_users(
+            [(user_id, name, tag) for user_id, (name, tag) in users.items()]
+        )
+        for guild_id in joined.keys() | left.keys():
+            await self._try(
+                f"the member changes of the guild {guild_id}",
+                self.store.change_guild_members(
+                    guild_id, joined.get(guild_id, set()), left.get(guild_id, set())
+                ),
+            )
+        for guild in renamed.values():
+            await self._try(
+                f"the guild {guild.id}",
+                self.store.save_guild(
+                    guild.id,
+                    guild.name,
+                    [member.id for member in guild.members],
+                    self.chunk_size,
+                ),
+            )
+        for guild_id, guild_channels in channels.items():
+            await self._try(
+                f"the channels of the guild {guild_id}",
+                self.store.save_guild_channels(guild_id, list(guild_channels.items())),
+            )
+
+    async def run(self) -> None:
+        """Saves the queued changes in the background until it is cancelled."""
+        while True:
+            self._wake = anyio.Event()
+            if not self.pending:
+                await self._wake.wait()
+            await anyio.sleep(self.interval)
+            await self.flush()
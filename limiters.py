@@ -0,0 +1,101 @@
+from __future__ import annotations
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, TypeVar
+
+import anyio
+
+T = TypeVar("T")
+
+
+class InstrumentedLimiter:
+    """A capacity limiter that keeps track of how busy it is.
+
+    Different kinds of blocking work get their own limiter, so a slow job of one kind can't make
+    the other kinds wait. The anyio limiters are only created on first use, because anyio needs
+    to know the async library for that."""
+
+    def __init__(self, name: str, total_tokens: int) -> None:
+        self.name = name
+        self._total_tokens = total_tokens
+        self._limiter: Optional[anyio.CapacityLimiter] = None
+        # anyio's to_thread needs a limiter of its own, since our task already holds a token of _limiter.
+        self._thread_limiter: Optional[anyio.CapacityLimiter] = None
+        self.waiting = 0  # How many tasks are waiting for a token right now.
+        self.acquired = 0  # How often a token was acquired in total.
+        self.total_wait = 0.0  # How long tasks waited for a token in total, in seconds.
+        # The longest time a task had to wait for a token, in seconds.
+        self.max_wait = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self._total_tokens
+
+    @total_tokens.setter
+    def total_tokens(self, value: int) -> None:
+        if value < 1:
+            raise ValueError(f"The {self.name} pool needs at least one token.")
+        self._total_tokens = value
+        if self._limiter is not None and self._thread_limiter is not None:
+            self._limiter.total_tokens = value
+            self._thread_limiter.total_tokens = value
+
+    @property
+    def busy(self) -> int:
+        """How many tokens are in use right now."""
+        return 0 if self._limiter is None else int(self._limiter.borrowed_tokens)
+
+    @property
+    def mean_wait(self) -> float:
+        """The average time a task had to wait for a token, in seconds."""
+        return self.total_wait / self.acquired if self.acquired else 0.0
+
+    def _get_limiter(self) -> anyio.CapacityLimiter:
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self._total_tokens)
+            self._thread_limiter = anyio.CapacityLimiter(self._total_tokens)
+        return self._limiter
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Holds one token of this pool while the block runs."""
+        limiter = self._get_limiter()
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await limiter.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    async def run_sync(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs a blocking function in a worker thread of this pool."""
+        async with self.slot():
+            return await anyio.to_thread.run_sync(
+                func, *args, limiter=self._thread_limiter
+            )
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the current metrics of this pool."""
+        return {
+            "tokens": self.total_tokens,
+            "busy": self.busy,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "mean_wait": self.mean_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+# Limits how many database jobs can be in flight.
+db_limiter = InstrumentedLimiter("database", 20)
+# For any other blocking work.
+blocking_limiter = InstrumentedLimiter("blocking", 4)
+all_limiters: List[InstrumentedLimiter] = [db_limiter, blocking_limiter]
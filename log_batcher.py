@@ -0,0 +1,148 @@
+from __future__ import annotations
+from collections import deque
+from typing import Any, Deque, Final, Optional, Tuple
+
+import anyio
+
+# What happens to a record when the buffer is full: drop the oldest record, drop the new record,
+# or drop the oldest record with the lowest level, so warnings and errors survive bursts.
+# With the level policy the new record is only dropped if its level is lower than that of every waiting record.
+DROP_POLICIES: Final[Tuple[str, ...]] = ("oldest", "newest", "level")
+# The code block around a batch has to fit into a Discord message as well.
+_BLOCK_START: Final[str] = "```\n"
+_BLOCK_END: Final[str] = "```"
+
+
+class LogBatcher:
+    """Collects the log records for the log channel and packs as many as fit into one code block per message.
+
+    It is a loguru sink, so adding a record is cheap and never blocks or raises. The records wait in a
+    ring buffer of `capacity` records, once it is full the drop policy decides which record is lost.
+    The first record of a burst waits `interval` seconds, so the rest of the burst can join its message.
+    `dropped` counts the lost records and `coalesced` the records that shared a message with an earlier one."""
+
+    def __init__(
+        self,
+        capacity: int = 500,
+        drop_policy: str = "oldest",
+        max_length: int = 1950,
+        interval: float = 1.0,
+    ) -> None:
+        if capacity < 1:
+            raise ValueError("The log buffer needs room for at least one record.")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(
+                f"Unknown drop policy {drop_policy}, use one of {', '.join(DROP_POLICIES)}."
+            )
+        if max_length <= len(_BLOCK_START) + len(_BLOCK_END):
+            raise ValueError(
+                "The maximum message length is too short for a code block."
+            )
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.max_length = max_length
+        self.interval = interval
+        # (level number, text) of every record, the oldest first.
+        self._records: Deque[Tuple[int, str]] = deque()
+        # This needs a running event loop, so it is created once the first batch is awaited.
+        self._wake: Optional[anyio.Event] = None
+        self.closed = False
+        self.received = 0  # How many records were added.
+        self.dropped = 0  # How many records were lost because the buffer was full.
+        # How many records were sent in the same message as an earlier record.
+        self.coalesced = 0
+        # How many records were too long for one message and were cut.
+        self.truncated = 0
+        self.batches = 0  # How many messages were made.
+
+    @property
+    def pending(self) -> int:
+        """How many records wait to be sent."""
+        return len(self._records)
+
+    def __call__(self, message: Any) -> None:
+        """Adds a record, this is the loguru sink.
+
+        :param message: The formatted record, loguru passes a str with the record attached.
+        """
+        record = getattr(message, "record", None)
+        level = record["level"].no if record is not None else 0
+        self.add(str(message).rstrip("\n"), level)
+
+    def add(self, text: str, level: int = 0) -> None:
+        """Adds a record, dropping one if the buffer is full."""
+        if self.closed:
+            return
+        self.received += 1
+        if len(self._records) >= self.capacity:
+            self.dropped += 1
+            if self.drop_policy == "newest":
+                return
+            if self.drop_policy == "oldest":
+                self._records.popleft()
+            else:
+                lowest = min(record_level for record_level, _ in self._records)
+                if level < lowest:
+                    return
+                for index, (record_level, _) in enumerate(self._records):
+                    if record_level == lowest:
+                        del self._records[index]
+                        break
+        self._records.append((level, text))
+        if self._wake is not None:
+            self._wake.set()
+
+    def _fit(self, text: str) -> Tuple[str, bool]:
+        """Makes a record fit into a code block of one message.
+
+        :return: The text and whether it had to be cut.
+        """
+        # A record can't end the code block early, a zero width space breaks up its backticks.
+        # One pass leaves three of four or more backticks in a row, so this repeats until none are left.
+        while _BLOCK_END in text:
+            text = text.replace(_BLOCK_END, "`\u200b``")
+        room = self.max_length - len(_BLOCK_START) - len(_BLOCK_END) - 1
+        if len(text) > room:
+            return text[: room - 1] + "…", True
+        return text, False
+
+    def take_batch(self) -> Optional[str]:
+        """Takes as many records as fit into one message, the oldest first.
+
+        :return: The message with the records in a code block, or None if there are no records.
+        """
+        if not self._records:
+            return None
+        lines = []
+        length = len(_BLOCK_START) + len(_BLOCK_END)
+        while self._records:
+            text, cut = self._fit(self._records[0][1])
+            if lines and length + len(text) + 1 > self.max_length:
+                break
+            self._records.popleft()
+            self.truncated += cut
+            lines.append(text)
+            length += len(text) + 1
+        self.coalesced += len(lines) - 1
+        self.batches += 1
+        return _BLOCK_START + "\n".join(lines) + "\n" + _BLOCK_END
+
+    async def next_batch(self) -> Optional[str]:
+        """Waits for records and takes the next batch of them, see take_batch.
+
+        :return: The next message, or None once the batcher is closed.
+        """
+        while not self._records:
+            if self.closed:
+                return None
+            self._wake = anyio.Event()
+            await self._wake.wait()
+            if self.interval > 0 and not self.closed:
+                await anyio.sleep(self.interval)
+        return self.take_batch()
+
+    def close(self) -> None:
+        """Stops taking records, next_batch returns None once the remaining ones are taken."""
+        self.closed = True
+        if self._wake is not None:
+            self._wake.set()
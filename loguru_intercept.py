@@ -1,26 +1,97 @@
 from __future__ import annotations
 import logging
+import sys
+import time
+from typing import Any, Dict, Tuple, Union
 
 from loguru import logger
-from typing import Any, Union
 
 
 class InterceptHandler(logging.Handler):
-    """This class takes messages from a logging.Logger and converts it for usage with loguru."""
+    """This class takes messages from a logging.Logger and converts it for usage with loguru.
 
-    def emit(self, record: logging.LogRecord) -> None:
-        # Get corresponding Loguru level if it exists
-        try:
-            level: Union[int, str] = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+    discord.py logs a lot, so this is kept cheap: the loguru level of every logging level is looked up once,
+    the stack depth of every call site is only searched for the first time that site logs,
+    and the message is only formatted if a loguru sink actually takes the record."""
+
+    def __init__(self, level: Union[int, str] = logging.NOTSET) -> None:
+        super().__init__(level)
+        # logging level name -> loguru level name, or the level number if loguru doesn't have that level.
+        self._levels: Dict[str, Union[int, str]] = {}
+        # (file, line) of a logging call -> how many frames emit() is away from it.
+        self._depths: Dict[Tuple[str, int], int] = {}
+        # loguru loggers with the options for a depth, opt() creates a new logger every time.
+        self._loggers: Dict[int, Any] = {}
+
+    def _level(self, record: logging.LogRecord) -> Union[int, str]:
+        level = self._levels.get(record.levelname)
+        if level is None:
+            # Get corresponding Loguru level if it exists
+            try:
+                level = logger.level(record.levelname).name
+            except ValueError:
+                level = record.levelno
+            self._levels[record.levelname] = level
+        return level
 
+    def _depth(self, record: logging.LogRecord) -> int:
+        """How many frames the logging call is above emit()."""
+        # The logging functions between a call site and emit() are always the same for that site.
+        site = (record.pathname, record.lineno)
+        depth = self._depths.get(site)
+        if depth is not None:
+            try:
+                # This function is one frame below emit().
+                if sys._getframe(depth + 1).f_code.co_filename == record.pathname:
+                    return depth
+            except ValueError:
+                pass
         # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2  # type: Any, int
-        while frame.f_code.co_filename == logging.__file__:
+        frame, depth = sys._getframe(1), 0  # type: Any, int
+        while depth == 0 or frame.f_code.co_filename == logging.__file__:
             frame = frame.f_back
             depth += 1
+        self._depths[site] = depth
+        return depth
+
+    def emit(self, record: logging.LogRecord) -> None:
+        depth = self._depth(record)
+        if record.exc_info:
+            log = logger.opt(depth=depth, exception=record.exc_info, lazy=True)
+        else:
+            log = self._loggers.get(depth)
+            if log is None:
+                log = self._loggers[depth] = logger.opt(depth=depth, lazy=True)
+        # getMessage() only runs if a sink takes the record.
+        log.log(self._level(record), "{}", record.getMessage)
+
+
+class DebugSampler:
+    """A loguru filter that lets at most `limit` debug records per call site through every `interval` seconds.
+
+    Records of other levels always pass. Every sink needs its own sampler, because a sampler counts
+    every record it sees. `suppressed` counts the records that were left out."""
+
+    def __init__(self, limit: int = 10, interval: float = 1.0) -> None:
+        if limit < 1 or interval <= 0:
+            raise ValueError("The sampler has to let something through.")
+        self.limit = limit
+        self.interval = interval
+        self.suppressed = 0
+        # (module, line) -> (start of the current interval, records in it)
+        self._sites: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        self._debug = logger.level("DEBUG").no
 
-        logger.opt(depth=depth, exception=record.exc_info).log(
-            level, record.getMessage()
-        )
+    def __call__(self, record: Dict[str, Any]) -> bool:
+        if record["level"].no > self._debug:
+            return True
+        site = (record["name"], record["line"])
+        now = time.monotonic()
+        started, count = self._sites.get(site, (now, 0))
+        if now - started >= self.interval:
+            started, count = now, 0
+        if count >= self.limit:
+            self.suppressed += 1
+            return False
+        self._sites[site] = (started, count + 1)
+        return True
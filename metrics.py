@@ -0,0 +1,234 @@
+from __future__ import annotations
+import functools
+import os
+import time
+from bisect import bisect_left
+from pathlib import Path
+from types import TracebackType
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Final,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+import anyio
+from loguru import logger
+
+from limiters import blocking_limiter
+
+# The upper bounds of the histogram buckets in seconds, the last bucket takes everything above them.
+# They are fixed, so recording a time is one binary search and two additions.
+BUCKETS: Final[Tuple[float, ...]] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# The prefix of every metric in the Prometheus dump.
+_PREFIX: Final[str] = "gretabot"
+
+T = TypeVar("T")
+AsyncFunction = Callable[..., Coroutine[Any, Any, T]]
+
+
+class Histogram:
+    """Counts how long calls of one handler took in fixed buckets, how many calls failed and the totals."""
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind  # event, command, slash or quote
+        self.name = name
+        # counts[i] is how many calls took at most BUCKETS[i] and more than the bucket before it.
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.errors = 0  # How many calls raised an exception.
+        self.total_time = 0.0  # In seconds.
+        self.max_time = 0.0  # In seconds.
+
+    def observe(self, seconds: float, failed: bool = False) -> None:
+        """Records one call that took seconds."""
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.calls += 1
+        self.total_time += seconds
+        if seconds > self.max_time:
+            self.max_time = seconds
+        if failed:
+            self.errors += 1
+
+    @property
+    def mean_time(self) -> float:
+        """How long a call took on average, in seconds."""
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Estimates the time that the fraction q of the calls stayed under, in seconds.
+
+        The time is interpolated inside its bucket, so it is only as exact as the buckets are.
+        """
+        if not self.calls:
+            return 0.0
+        rank = q * self.calls
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max_time
+                # The slowest call is known exactly, so no estimate goes above it.
+                upper = min(upper, self.max_time)
+                return lower + (upper - lower) * max(rank - seen, 0) / count
+            seen += count
+        return self.max_time
+
+
+class _Measurement:
+    """Times the code in a with block and records it in a histogram, an exception counts as an error."""
+
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, exc is not None)
+
+
+class Metrics:
+    """Keeps a latency histogram for every event listener, command and slash command of the bot.
+
+    The handlers are wrapped when they are registered, see timed and time_invoke.
+    prometheus() renders everything in the Prometheus text format and run() writes that to a file regularly,
+    for example for the textfile collector of the node exporter."""
+
+    def __init__(self) -> None:
+        # (kind, name) -> histogram, in the order they were created.
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.started_at = time.monotonic()
+        self.writes = 0  # How many times the Prometheus file was written.
+
+    def histogram(self, kind: str, name: str) -> Histogram:
+        """:return: The histogram for that handler, it is created on first use."""
+        histogram = self._histograms.get((kind, name))
+        if histogram is None:
+            histogram = self._histograms[(kind, name)] = Histogram(kind, name)
+        return histogram
+
+    def histograms(self) -> List[Histogram]:
+        return list(self._histograms.values())
+
+    @property
+    def uptime(self) -> float:
+        """For how many seconds the metrics were collected."""
+        return time.monotonic() - self.started_at
+
+    def measure(self, kind: str, name: str) -> _Measurement:
+        """Times a with block, like `with metrics.measure("quote", "resolve"):`."""
+        return _Measurement(self.histogram(kind, name))
+
+    def timed(self, kind: str, name: str, func: AsyncFunction[T]) -> AsyncFunction[T]:
+        """Wraps an async function so that every call of it is timed.
+
+        :return: The wrapper, it keeps the name and the docstring of func.
+        """
+        histogram = self.histogram(kind, name)
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - started, failed)
+
+        return wrapper
+
+    def time_invoke(self, target: Any, kind: str, name: str) -> None:
+        """Times the invoke() coroutine of a command, the time includes the checks and the argument conversion.
+
+        The command itself has to stay unchanged, because discord.py reads the parameters of a command from
+        its callback, so only invoke() of that one command object is replaced.
+        Doing it again for the same object does nothing, so setting up the bot twice doesn't count calls twice.
+        """
+        if "invoke" in vars(target):
+            return
+        target.invoke = self.timed(kind, name, target.invoke)
+
+    def prometheus(self) -> str:
+        """:return: All histograms in the Prometheus text exposition format."""
+        seconds = f"{_PREFIX}_handler_seconds"
+        errors = f"{_PREFIX}_handler_errors_total"
+        lines = [
+            f"# HELP {seconds} How long the event listeners, commands and quote lookups of the bot took.",
+            f"# TYPE {seconds} histogram",
+        ]
+        histograms = self.histograms()
+        for histogram in histograms:
+            labels = f'kind="{histogram.kind}",name="{_escape(histogram.name)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{seconds}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{seconds}_bucket{{{labels},le="+Inf"}} {histogram.calls}')
+            lines.append(f"{seconds}_sum{{{labels}}} {histogram.total_time!r}")
+            lines.append(f"{seconds}_count{{{labels}}} {histogram.calls}")
+        lines.append(
+            f"# HELP {errors} How many calls of the handlers raised an exception."
+        )
+        lines.append(f"# TYPE {errors} counter")
+        for histogram in histograms:
+            labels = f'kind="{histogram.kind}",name="{_escape(histogram.name)}"'
+            lines.append(f"{errors}{{{labels}}} {histogram.errors}")
+        lines.append(f"# HELP {_PREFIX}_uptime_seconds For how long the bot runs.")
+        lines.append(f"# TYPE {_PREFIX}_uptime_seconds gauge")
+        lines.append(f"{_PREFIX}_uptime_seconds {self.uptime!r}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: Path, text: Optional[str] = None) -> None:
+        """Writes the Prometheus dump to path so that readers never see half a file, this blocks."""
+        temporary = path.with_name(path.name + ".tmp")
+        temporary.write_text(self.prometheus() if text is None else text)
+        os.replace(temporary, path)
+        self.writes += 1
+
+    async def run(self, path: Path, interval: float = 15.0) -> None:
+        """Writes the Prometheus dump to path every interval seconds, until it is cancelled."""
+        while True:
+            await anyio.sleep(interval)
+            # The text is made on the event loop, so no handler changes a histogram halfway through.
+            text = self.prometheus()
+            try:
+                await blocking_limiter.run_sync(self.write_file, path, text)
+            except OSError as error:
+                logger.warning(f"Couldn't write the metrics to {path}: {error}")
+
+
+def _escape(value: str) -> str:
+    """Escapes a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
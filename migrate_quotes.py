@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Copies the quotes from the SQLite database of the bot into EdgeDB.
+
+The rows are streamed in batches ordered by their id, so memory use doesn't depend on the size of the table.
+Every batch is written in its own EdgeDB transaction and the id of the last written row is saved to a
+checkpoint file afterwards, so an interrupted migration continues where it stopped.
+Run it with `python migrate_quotes.py` from the directory that contains bot.db."""
+from __future__ import annotations
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import anyio
+import edgedb
+from loguru import logger
+
+from database import (
+    db,
+    Quote,
+    GuildSettings,
+    GLOBAL_GUILD_ID,
+    configure_database,
+    migrate_database,
+)
+from queries.edgeql_queries import import_quotes, instance_name
+
+# The limits of the EdgeDB schema, rows outside of them would make the whole batch fail.
+MAX_KEYWORD_LENGTH = 300
+MAX_QUOTE_LENGTH = 1700
+
+
+def load_checkpoint(path: Path) -> Tuple[int, int]:
+    """Reads the checkpoint file.
+
+    :return: The id of the last migrated row and how many rows were migrated, or (0, 0) if there is no checkpoint.
+    """
+    if not path.exists():
+        return 0, 0
+    data = json.loads(path.read_text(encoding="utf-8"))
+    return int(data["last_id"]), int(data["migrated"])
+
+
+def save_checkpoint(path: Path, last_id: int, migrated: int) -> None:
+    """Writes the checkpoint file so that it is never left half written."""
+    temporary = path.with_name(path.name + ".tmp")
+    temporary.write_text(
+        json.dumps({"last_id": last_id, "migrated": migrated}), encoding="utf-8"
+    )
+    os.replace(temporary, path)
+
+
+def read_batches(
+    after_id: int, batch_size: int
+) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """Streams the quotes with an id greater than after_id.
+
+    Every batch is a separate keyset query (WHERE id > last id ORDER BY id), so no offset has to be skipped
+    and no cursor is kept open while EdgeDB writes.
+    :return: Pairs of the last id of the batch and the quotes of that batch.
+    """
+    last_id = after_id
+    while True:
+        rows = list(
+            Quote.select(
+                Quote.id, Quote.guildId, Quote.keyword, Quote.result, Quote.authorId
+            )
+            .where(Quote.id > last_id)
+            .order_by(Quote.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        quotes: List[Dict[str, Any]] = []
+        for quote_id, guild_id, keyword, result, author_id in rows:
+            too_long = (
+                len(keyword) > MAX_KEYWORD_LENGTH or len(result) > MAX_QUOTE_LENGTH
+            )
+            if too_long or not keyword or not result:
+                logger.warning(
+                    f"Skipping quote {quote_id} ({keyword[:50]}), it doesn't fit the EdgeDB schema."
+                )
+                continue
+            quotes.append(
+                {
+                    "guild_id": None if guild_id == GLOBAL_GUILD_ID else guild_id,
+                    "keyword": keyword,
+                    "quote_text": result,
+                    "author_id": author_id,
+                }
+            )
+        yield last_id, quotes
+
+
+async def migrate(
+    dsn: Optional[str], batch_size: int, checkpoint: Path, restart: bool
+) -> None:
+    """Runs the migration.
+
+    :param dsn: The EdgeDB instance name or DSN.
+    :param batch_size: How many rows are written per transaction.
+    :param checkpoint: The file that remembers how far the migration got.
+    :param restart: Whether to ignore the checkpoint and start from the first row.
+    """
+    last_id, migrated = (0, 0) if restart else load_checkpoint(checkpoint)
+    total = Quote.select().where(Quote.id > last_id).count()
+    if last_id:
+        logger.info(
+            f"Continuing after quote {last_id}, {migrated} rows were already done."
+        )
+    logger.info(f"{total} rows to migrate.")
+    client = edgedb.create_async_client(dsn)
+    inserted = 0
+    done = 0
+    started = time.perf_counter()
+    try:
+        for batch_last_id, quotes in read_batches(last_id, batch_size):
+            if quotes:
+                inserted += await import_quotes(client, quotes)
+            done += len(quotes)
+            migrated += len(quotes)
+            save_checkpoint(checkpoint, batch_last_id, migrated)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"{done}/{total} rows migrated, {done / elapsed:.0f} rows/s, {inserted} new quotes in EdgeDB."
+            )
+    finally:
+        await client.aclose()
+    elapsed = time.perf_counter() - started
+    logger.success(
+        f"Migrated {done} rows in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} rows/s), "
+        f"{done - inserted} already existed."
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sqlite", default="bot.db", help="The SQLite database to read."
+    )
+    parser.add_argument(
+        "--dsn", default=instance_name, help="The EdgeDB instance name or DSN."
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--checkpoint", default="migrate_quotes.checkpoint")
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore the checkpoint file."
+    )
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("The batch size must be at least 1.")
+    configure_database(path=args.sqlite)
+    db.connect()
+    try:
+        # Older databases can still contain duplicate keywords, so bring the schema up to date first.
+        db.create_tables([Quote, GuildSettings])
+        migrate_database()
+        anyio.run(
+            migrate,
+            args.dsn,
+            args.batch_size,
+            Path(args.checkpoint),
+            args.restart,
+            backend="asyncio",
+        )
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import time
+from typing import Any, Dict, List, Optional
+
+import anyio
+import discord
+
+
+class _Channel:
+    """The send queue of one channel, the lock hands out turns in the order they were asked for."""
+
+    def __init__(self) -> None:
+        self.lock = anyio.Lock()
+        self.waiting = 0
+
+
+class OutboundScheduler:
+    """Sends the messages of the bot in order per channel, as fast as Discord's rate limits allow.
+
+    Every channel has its own queue, so a busy channel never holds up the others. The parts of a long message
+    are sent back to back while holding the turn of their channel, so other messages can't end up between them.
+    The rate limits themselves are handled by the HTTP client of discord.py: it reads the rate limit headers of
+    every response, waits for the route bucket to refill once it is empty and stops all requests while the
+    global limit is hit. So nothing here sleeps for a fixed time, the wait for a bucket shows up in `send_time`.
+    The statistics tell how long messages waited for their turn and how long sending took."""
+
+    def __init__(self) -> None:
+        self._channels: Dict[int, _Channel] = {}
+        self.sent = 0  # How many messages were sent.
+        self.failed = 0  # How many messages could not be sent.
+        # How long messages waited for their turn in total, in seconds.
+        self.total_wait = 0.0
+        self.max_wait = 0.0  # In seconds.
+        # How long sending took in total, including the waits for rate limits, in seconds.
+        self.total_send_time = 0.0
+        self.max_send_time = 0.0  # In seconds.
+
+    @property
+    def queued(self) -> int:
+        """How many sends are waiting for their turn right now."""
+        return sum(channel.waiting for channel in self._channels.values())
+
+    @property
+    def busy_channels(self) -> int:
+        """How many channels are sending or have sends waiting."""
+        return len(self._channels)
+
+    @property
+    def mean_wait(self) -> float:
+        """The average time a message waited for its turn, in seconds."""
+        sends = self.sent + self.failed
+        return self.total_wait / sends if sends else 0.0
+
+    @property
+    def mean_send_time(self) -> float:
+        """The average time sending a message took, in seconds."""
+        sends = self.sent + self.failed
+        return self.total_send_time / sends if sends else 0.0
+
+    async def send(
+        self, target: discord.abc.Messageable, parts: List[str], **kwargs: Any
+    ) -> Optional[discord.Message]:
+        """Sends the parts of a message to target, one message each, once it is the turn of that channel.
+
+        :param parts: The text of every message, an empty string sends only the kwargs, like an embed.
+        :param kwargs: Additional arguments for target.send(). They go with the last part,
+            so an embed or a file comes after the whole text.
+        :raises: discord.Forbidden if it can't send the message
+        :raises: discord.HTTPException if the sending failed, the parts after it are not sent.
+        :return: The last message that was sent.
+        """
+        # Private channels don't have a guild, but every messageable has an ID.
+        key = getattr(target, "id", id(target))
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = _Channel()
+        queued_at = time.perf_counter()
+        channel.waiting += 1
+        try:
+            await channel.lock.acquire()
+        except BaseException:
+            channel.waiting -= 1
+            self._drop_if_idle(key, channel)
+            raise
+        channel.waiting -= 1
+        waited = time.perf_counter() - queued_at
+        sent: Optional[discord.Message] = None
+        try:
+            for index, part in enumerate(parts):
+                last = index == len(parts) - 1
+                started = time.perf_counter()
+                try:
+                    sent = await target.send(
+                        content=part or None, **(kwargs if last else {})
+                    )
+                except BaseException:
+                    self.failed += 1
+                    raise
+                else:
+                    self.sent += 1
+                finally:
+                    self._record(waited if index == 0 else 0.0, started)
+            return sent
+        finally:
+            channel.lock.release()
+            self._drop_if_idle(key, channel)
+
+    def _drop_if_idle(self, key: int, channel: _Channel) -> None:
+        if channel.waiting == 0 and not channel.lock.locked():
+            # Nobody else is queued for this channel, so its queue can go.
+            self._channels.pop(key, None)
+
+    def _record(self, waited: float, started: float) -> None:
+        send_time = time.perf_counter() - started
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.total_send_time += send_time
+        self.max_send_time = max(self.max_send_time, send_time)
@@ -1,20 +1,401 @@
 from __future__ import annotations
-import edgedb
+import json
+import re
+from edgedb.asyncio_client import AsyncIOIteration
 import discord
-from typing import Union, Optional, Final, cast
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Optional, Final, Tuple, cast
+
+from queries.entity_cache import EntityCache, PendingEntities
+from queries.registry import AsyncQuerySource, QueryRegistry, CONFLICT_RETRIES
 
 instance_name: Final[str] = "SAIL"
-AsyncQuerySource = Union[
-    edgedb.AsyncIOConnection, edgedb.AsyncIOTransaction, edgedb.AsyncIOPool
-]
+queries_dir: Final[Path] = Path(__file__).parent
+# All queries of this directory, they are loaded and checked on first use or by calling registry.load().
+registry = QueryRegistry(queries_dir)
+# The users, guilds and channels that are known to be saved, so unchanged ones are not written again.
+entity_cache = EntityCache()
+
+
+async def get_quote(
+    source: AsyncQuerySource,
+    keyword: str,
+    guild_id: Optional[int] = None,
+) -> Optional[str]:
+    """Resolves a quote trigger with a single round trip.
+
+    A guild quote is preferred over a global quote.
+    This only reads, so it doesn't need a transaction.
+    :param source: Where to run the query.
+    :param keyword: The keyword to search for.
+    :param guild_id: The ID of the guild the message was sent in, or None for private channels.
+    :return: Either the found quote text, or None if nothing was found.
+    """
+    result = await registry["getquote"](
+        source,
+        keyword=keyword.lower(),
+        guild_id=guild_id,
+    )
+    return cast(Optional[str], result)
+
+
+async def import_quotes(
+    source: AsyncQuerySource,
+    quotes: List[Dict[str, Any]],
+    pending: Optional[PendingEntities] = None,
+) -> int:
+    """Inserts a batch of quotes from the old SQLite database in a single transaction.
+
+    The missing users and guilds are created with placeholder names, which get replaced once the bot sees them.
+    Users and guilds in the entity cache are known to exist and are skipped.
+    Quotes that already exist are skipped, so a batch can safely be imported again.
+    :param source: Where to run the queries, a client starts a new transaction.
+    :param quotes: Dicts with guild_id (None for global quotes), keyword, quote_text and author_id.
+    :param pending: Collects the created users and guilds for the entity cache when source is a transaction,
+        the caller adds them to the cache after the commit.
+    :return: How many quotes were inserted.
+    """
+    if not isinstance(source, AsyncIOIteration):
+        async for tx in source.with_retry_options(CONFLICT_RETRIES).transaction():
+            async with tx:
+                # A retried transaction starts over, so it must not keep what the failed attempt saved.
+                pending = {}
+                inserted = await import_quotes(tx, quotes, pending)
+        entity_cache.remember_all(pending)
+        return inserted
+    if pending is None:
+        pending = {}
+    user_ids = sorted(
+        entity_cache.missing(
+            "user", {quote["author_id"] for quote in quotes if quote["author_id"] >= 0}
+        )
+    )
+    guild_quotes = [quote for quote in quotes if quote["guild_id"] is not None]
+    global_quotes = [quote for quote in quotes if quote["guild_id"] is None]
+    guild_ids = sorted(
+        entity_cache.missing("guild", {quote["guild_id"] for quote in guild_quotes})
+    )
+    inserted = 0
+    if user_ids:
+        await registry["import_users"](source, user_ids=user_ids)
+        for user_id in user_ids:
+            pending.setdefault(("user", user_id), {})
+    if guild_ids:
+        await registry["import_guilds"](source, guild_ids=guild_ids)
+        for guild_id in guild_ids:
+            pending.setdefault(("guild", guild_id), {})
+    if guild_quotes:
+        result = await registry["import_guild_quotes"](
+            source, quotes=json.dumps(guild_quotes)
+        )
+        inserted += len(result)
+    if global_quotes:
+        result = await registry["import_global_quotes"](
+            source,
+            quotes=json.dumps(global_quotes),
+        )
+        inserted += len(result)
+    return inserted
+
+
+async def delete_quote(
+    source: AsyncQuerySource, guild_id: Optional[int], keyword: str
+) -> bool:
+    """Deletes a guild quote, or a global quote if guild_id is None.
+
+    :return: Whether a quote was deleted.
+    """
+    if guild_id is None:
+        result = await registry["delete_global_quote"](source, keyword=keyword.lower())
+    else:
+        result = await registry["delete_guild_quote"](
+            source,
+            guild_id=guild_id,
+            keyword=keyword.lower(),
+        )
+    return len(result) > 0
+
 
+async def save_quote(
+    source: AsyncQuerySource, quote: Dict[str, Any], overwrite: bool = True
+) -> bool:
+    """Saves a single quote in one transaction.
 
-async def _run_query(
-    query: str, source: AsyncQuerySource, *args, **kwargs
-) -> edgedb.Set:
-    if not isinstance(source, edgedb.AsyncIOTransaction):
-        async for tx in source.retrying_transaction():
+    An existing quote is replaced in place with an UPDATE, so it keeps its usage statistics like with the
+    SQLite store.
+    :param source: Where to run the queries, a client starts a new transaction.
+    :param quote: A dict like the ones import_quotes takes.
+    :param overwrite: Whether an existing quote with that keyword gets replaced.
+    :return: Whether the quote was saved.
+    """
+    if not isinstance(source, AsyncIOIteration):
+        async for tx in source.with_retry_options(CONFLICT_RETRIES).transaction():
             async with tx:
-                return await _run_query(query, tx, args, kwargs)
+                pending: PendingEntities = {}
+                saved = await _save_quote(tx, quote, overwrite, pending)
+        entity_cache.remember_all(pending)
+        return saved
+    return await _save_quote(source, quote, overwrite)
+
+
+async def _save_quote(
+    tx: AsyncQuerySource,
+    quote: Dict[str, Any],
+    overwrite: bool,
+    pending: Optional[PendingEntities] = None,
+) -> bool:
+    # The import creates the author if it is missing, and skips the quote if the keyword is taken.
+    if await import_quotes(tx, [quote], pending) > 0:
+        return True
+    if not overwrite:
+        return False
+    if quote["guild_id"] is None:
+        result = await registry["update_global_quote"](
+            tx,
+            keyword=quote["keyword"],
+            quote_text=quote["quote_text"],
+            author_id=quote["author_id"],
+        )
+    else:
+        result = await registry["update_guild_quote"](
+            tx,
+            guild_id=quote["guild_id"],
+            keyword=quote["keyword"],
+            quote_text=quote["quote_text"],
+            author_id=quote["author_id"],
+        )
+    return len(result) > 0
+
+
+async def save_guild(
+    source: AsyncQuerySource,
+    guild_id: int,
+    name: str,
+    user_ids: Collection[int],
+    chunk_size: int = 500,
+) -> bool:
+    """Saves a Discord guild and which of the saved users are its members, if that changed since it was saved last.
+
+    Unknown guilds are upserted, known ones only get the changed fields with a plain UPDATE.
+    The member IDs are sent in chunks of chunk_size, the first one with the guild and the others with
+    add_guild_members, so a big guild doesn't need one huge query.
+    :param source: Where to run the queries, the guild is only cached if it is a client.
+    :return: Whether anything was sent to the database.
+    """
+    member_ids = sorted(user_ids)
+    fields: Dict[str, Any] = {"guild_name": name, "user_ids": member_ids}
+    changed = entity_cache.changed_fields("guild", guild_id, fields)
+    if changed is not None and not changed:
+        return False
+    first_chunk = member_ids[:chunk_size]
+    if changed is None:
+        await registry["sync_guild"](
+            source, guild_id=guild_id, guild_name=name, user_ids=first_chunk
+        )
+    else:
+        await registry["update_guild"](
+            source,
+            guild_id=guild_id,
+            guild_name=name if "guild_name" in changed else None,
+            user_ids=first_chunk if "user_ids" in changed else None,
+        )
+    if changed is None or "user_ids" in changed:
+        for start in range(chunk_size, len(member_ids), chunk_size):
+            await registry["add_guild_members"](
+                source,
+                guild_id=guild_id,
+                user_ids=member_ids[start : start + chunk_size],
+            )
+    if not isinstance(source, AsyncIOIteration):
+        # Every query is a single statement, so it is committed once it returns.
+        # If a chunk failed, the guild isn't cached and the next save sends all of it again.
+        entity_cache.remember("guild", guild_id, fields)
+    return True
+
+
+async def sync_users(
+    source: AsyncQuerySource, users: List[Tuple[int, str, str]]
+) -> int:
+    """Saves many users with one query, leaving out the ones that didn't change since they were saved last.
+
+    :param source: Where to run the query, the users are only cached if it is a client.
+    :param users: (user ID, name, tag) of every user.
+    :return: How many users were sent to the database.
+    """
+    changed = [
+        (user_id, name, tag)
+        for user_id, name, tag in users
+        if entity_cache.changed_fields(
+            "user", user_id, {"user_name": name, "user_tag": tag}
+        )
+        != set()
+    ]
+    if not changed:
+        return 0
+    await registry["sync_users"](
+        source,
+        users=json.dumps(
+            [
+                {"user_id": user_id, "name": name, "tag": tag}
+                for user_id, name, tag in changed
+            ]
+        ),
+    )
+    if not isinstance(source, AsyncIOIteration):
+        for user_id, name, tag in changed:
+            entity_cache.remember("user", user_id, {"user_name": name, "user_tag": tag})
+    return len(changed)
+
+
+async def sync_guild_channels(
+    source: AsyncQuerySource, guild_id: int, channels: List[Tuple[int, str]]
+) -> int:
+    """Saves many channels of a guild with one query, leaving out the ones that didn't change.
+
+    The guild has to be saved already.
+    :param source: Where to run the query, the channels are only cached if it is a client.
+    :param channels: (channel ID, name) of every channel.
+    :return: How many channels were sent to the database.
+    """
+    changed = [
+        (channel_id, name)
+        for channel_id, name in channels
+        if entity_cache.changed_fields("channel", channel_id, {"channel_name": name})
+        != set()
+    ]
+    if not changed:
+        return 0
+    await registry["sync_guild_channels"](
+        source,
+        guild_id=guild_id,
+        channels=json.dumps(
+            [{"channel_id": channel_id, "name": name} for channel_id, name in changed]
+        ),
+    )
+    if not isinstance(source, AsyncIOIteration):
+        for channel_id, name in changed:
+            entity_cache.remember("channel", channel_id, {"channel_name": name})
+    return len(changed)
+
+
+async def change_guild_members(
+    source: AsyncQuerySource,
+    guild_id: int,
+    joined: Collection[int],
+    left: Collection[int],
+) -> None:
+    """Adds and removes members of a guild without sending the whole member list.
+
+    The users that joined have to be saved already.
+    """
+    if joined:
+        await registry["add_guild_members"](
+            source, guild_id=guild_id, user_ids=sorted(joined)
+        )
+    if left:
+        await registry["remove_guild_members"](
+            source, guild_id=guild_id, user_ids=sorted(left)
+        )
+    if joined or left:
+        # The cache only knows the hash of the old member list, the next save_guild has to send it again.
+        entity_cache.invalidate("guild", guild_id, "user_ids")
+
+
+async def read_quotes(
+    source: AsyncQuerySource, guild_id: Optional[int] = None
+) -> Dict[Optional[int], Dict[str, str]]:
+    """Reads the quotes of one guild, or all guild and global quotes if guild_id is None.
+
+    :return: guild id (None for global quotes) -> keyword -> quote text.
+    """
+    quotes: Dict[Optional[int], Dict[str, str]] = {}
+    for quote in await registry["read_guild_quotes"](source, guild_id=guild_id):
+        quotes.setdefault(quote.guild_id, {})[quote.keyword] = quote.quote_text
+    if guild_id is None:
+        for quote in await registry["read_global_quotes"](source):
+            quotes.setdefault(None, {})[quote.keyword] = quote.quote_text
+    return quotes
+
+
+async def list_keywords(source: AsyncQuerySource, guild_id: Optional[int]) -> List[str]:
+    """Gets the keywords of all quotes of a guild, or of all global quotes if guild_id is None."""
+    if guild_id is None:
+        result = await registry["list_global_keywords"](source)
     else:
-        return await source.query(query, *args, **kwargs)
+        result = await registry["list_guild_keywords"](source, guild_id=guild_id)
+    return [str(keyword) for keyword in result]
+
+
+async def list_keywords_page(
+    source: AsyncQuerySource,
+    guild_id: Optional[int],
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: Optional[str] = None,
+    limit: int = 50,
+) -> List[str]:
+    """Gets one page of the keywords of a guild, or of the global quotes if guild_id is None.
+
+    :param after: Only get keywords after this one, for the next page.
+    :param before: Only get the keywords right before this one, for the previous page.
+    :param start: Only get keywords from this one on.
+    :param limit: How many keywords to get at most.
+    :return: The keywords in alphabetical order.
+    """
+    scope = "global" if guild_id is None else "guild"
+    arguments: Dict[str, Any] = {"limit": limit}
+    if guild_id is not None:
+        arguments["guild_id"] = guild_id
+    if start is not None:
+        arguments["start"] = start.lower()
+    if before is not None:
+        result = await registry[f"list_{scope}_keywords_before"](
+            source, before=before, **arguments
+        )
+        return [str(keyword) for keyword in reversed(list(result))]
+    result = await registry[f"list_{scope}_keywords_after"](
+        source, after=after, **arguments
+    )
+    return [str(keyword) for keyword in result]
+
+
+async def search_quotes(
+    source: AsyncQuerySource, guild_id: int, text: str, limit: int = 10
+) -> List[Tuple[str, str]]:
+    """Finds the quotes of a guild that contain the text in their keyword or text.
+
+    :return: (keyword, quote text) pairs, keywords that start with the text first.
+    """
+    escaped = re.sub(r"([\\%_])", r"\\\1", text.lower())
+    result = await registry["search_guild_quotes"](
+        source,
+        guild_id=guild_id,
+        pattern=f"%{escaped}%",
+        prefix=f"{escaped}%",
+        limit=limit,
+    )
+    return [(str(quote.keyword), str(quote.quote_text)) for quote in result]
+
+
+async def record_usage(source: AsyncQuerySource, usages: List[Dict[str, Any]]) -> None:
+    """Adds up the usage statistics of many quotes in one transaction.
+
+    :param source: Where to run the queries, a client starts a new transaction.
+    :param usages: Dicts with guild_id (None for global quotes), keyword, uses, last_used_at (ISO 8601),
+        last_used_by and last_used_in.
+    """
+    if not isinstance(source, AsyncIOIteration):
+        async for tx in source.with_retry_options(CONFLICT_RETRIES).transaction():
+            async with tx:
+                await record_usage(tx, usages)
+        return
+    guild_usages = [usage for usage in usages if usage["guild_id"] is not None]
+    global_usages = [usage for usage in usages if usage["guild_id"] is None]
+    if guild_usages:
+        await registry["record_guild_quote_usage"](
+            source, usages=json.dumps(guild_usages)
+        )
+    if global_usages:
+        await registry["record_global_quote_usage"](
+            source, usages=json.dumps(global_usages)
+        )
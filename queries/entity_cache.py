@@ -0,0 +1,120 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+# (kind, Discord ID), the kind is user, guild or channel.
+EntityKey = Tuple[str, int]
+# A state without fields means that the entity exists, but its content is not known.
+EntityState = Dict[str, int]
+# The entities a transaction saved and their fields, they are added to the cache once it is committed.
+PendingEntities = Dict[EntityKey, Dict[str, Any]]
+
+
+def content_hash(value: Any) -> int:
+    """Hashes a field value, sets and lists are hashed without their order."""
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return hash(frozenset(value))
+    return hash(value)
+
+
+class EntityCache:
+    """Remembers which users, guilds and channels are already saved in EdgeDB and what they contained.
+
+    For every entity only a hash per field is kept, so a guild with many members costs the same as a user.
+    Saving an entity can then be skipped if nothing changed, and only the changed fields have to be sent otherwise.
+    The cache holds at most `max_entries` entities and forgets the least recently used ones first,
+    an entity takes about half a kilobyte. It has to fit the members of all guilds,
+    otherwise a full sync evicts its own entries and the next one saves everything again.
+    It must only be updated after the transaction that saved the entities was committed."""
+
+    def __init__(self, max_entries: int = 100_000) -> None:
+        if max_entries < 1:
+            raise ValueError("The entity cache needs room for at least one entity.")
+        self.max_entries = max_entries
+        self._entries: OrderedDict[EntityKey, EntityState] = OrderedDict()
+        self.hits = 0  # Saves that could be skipped completely.
+        self.partial = 0  # Saves that only had to send some fields.
+        self.misses = 0  # Saves of entities that were not in the cache.
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def missing(self, kind: str, discord_ids: Iterable[int]) -> Set[int]:
+        """Gets the IDs that are not known to exist yet."""
+        return {
+            discord_id
+            for discord_id in discord_ids
+            if (kind, discord_id) not in self._entries
+        }
+
+    def changed_fields(
+        self, kind: str, discord_id: int, fields: Dict[str, Any]
+    ) -> Optional[Set[str]]:
+        """Compares fields with what was saved last.
+
+        :return: None if the entity is not known, else the names of the fields that changed, empty if none did.
+        """
+        key = (kind, discord_id)
+        state = self._entries.get(key)
+        if state is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        changed = {
+            name
+            for name, value in fields.items()
+            if state.get(name) != content_hash(value)
+        }
+        if changed:
+            self.partial += 1
+        else:
+            self.hits += 1
+        return changed
+
+    def remember(
+        self, kind: str, discord_id: int, fields: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Remembers that an entity was saved, with the fields that were saved, if they are known."""
+        key = (kind, discord_id)
+        state = self._entries.get(key)
+        if state is None:
+            state = self._entries[key] = {}
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._entries.move_to_end(key)
+        for name, value in (fields or {}).items():
+            state[name] = content_hash(value)
+
+    def forget(self, kind: str, discord_id: int) -> None:
+        """Forgets an entity, for example because it was deleted."""
+        self._entries.pop((kind, discord_id), None)
+
+    def invalidate(self, kind: str, discord_id: int, *fields: str) -> None:
+        """Forgets the saved content of some fields, the entity is still known to exist."""
+        state = self._entries.get((kind, discord_id))
+        if state is not None:
+            for name in fields:
+                state.pop(name, None)
+
+    def remember_all(self, pending: PendingEntities) -> None:
+        """Remembers everything a committed transaction saved."""
+        for (kind, discord_id), fields in pending.items():
+            self.remember(kind, discord_id, fields)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "partial": self.partial,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,231 @@
+from __future__ import annotations
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, Final, Iterator, List, Optional, Union
+
+import edgedb
+from edgedb.asyncio_client import AsyncIOIteration
+
+AsyncQuerySource = Union[edgedb.AsyncIOClient, AsyncIOIteration]
+
+# Writes are only retried if the transaction lost a serialization conflict, network errors are raised right away.
+CONFLICT_RETRIES: Final[edgedb.RetryOptions] = edgedb.RetryOptions(
+    attempts=1
+).with_rule(edgedb.RetryCondition.TransactionConflict, attempts=5)
+# Reads are not retried at all, a failed lookup is cheaper to give up on than to wait for.
+NO_RETRIES: Final[edgedb.RetryOptions] = edgedb.RetryOptions(attempts=1)
+
+_HEADER = re.compile(r"^#\s*(name|mode|returns):\s*(\S+)\s*$", re.MULTILINE)
+_CAST_PARAMETER = re.compile(
+    r"<\s*((?:optional\s+)?[\w:]+(?:\s*<[^<>$]+>)?)\s*>\s*\$(\w+)"
+)
+_PARAMETER = re.compile(r"\$(\w+)")
+_DML = re.compile(r"\b(INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+_COMMENT = re.compile(r"#[^\n]*")
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+
+
+class QueryError(Exception):
+    """A query file is not valid."""
+
+
+class Query:
+    """A named EdgeQL query that can be called like an async function.
+
+    Every query is a single statement, so it runs in the implicit transaction of that statement instead of
+    paying for START TRANSACTION and COMMIT. Read-only queries are never retried,
+    writes are only retried on serialization conflicts. Inside of a transaction, the transaction decides.
+    Every query keeps track of how often it ran and how long it took."""
+
+    def __init__(
+        self, name: str, text: str, read_only: bool, single: bool, source: str
+    ) -> None:
+        self.name = name
+        self.text = text
+        self.read_only = read_only
+        self.single = single  # Whether the query returns at most one element.
+        self.source = source  # Where the query was loaded from, for error messages.
+        self.parameters: Dict[str, str] = {}  # parameter name -> cast
+        self.optional_parameters: List[str] = []
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0  # In seconds.
+        self.max_time = 0.0  # In seconds.
+        self._validate()
+
+    def _validate(self) -> None:
+        code = _COMMENT.sub("", _STRING.sub("''", self.text))
+        if not code.strip():
+            raise QueryError(f"The query {self.name} in {self.source} is empty.")
+        statements = [part for part in code.split(";") if part.strip()]
+        if len(statements) > 1:
+            raise QueryError(
+                f"{self.source} has several statements in the query {self.name}, "
+                f"start each of them with a '# name:' line."
+            )
+        if self.read_only and _DML.search(code):
+            raise QueryError(
+                f"The query {self.name} in {self.source} is marked as read only, but it writes."
+            )
+        for cast, parameter in _CAST_PARAMETER.findall(code):
+            cast = " ".join(cast.split())
+            known = self.parameters.setdefault(parameter, cast)
+            if known != cast:
+                raise QueryError(
+                    f"The parameter ${parameter} of the query {self.name} is cast to {known} and {cast}."
+                )
+        for parameter in _PARAMETER.findall(code):
+            if parameter not in self.parameters:
+                raise QueryError(
+                    f"The parameter ${parameter} of the query {self.name} has no type cast."
+                )
+        self.optional_parameters = [
+            parameter
+            for parameter, cast in self.parameters.items()
+            if cast.startswith("optional")
+        ]
+
+    def _check_arguments(self, arguments: Dict[str, Any]) -> None:
+        """Catches wrong arguments before the query is sent to the server."""
+        missing = set(self.parameters) - set(self.optional_parameters) - set(arguments)
+        unknown = set(arguments) - set(self.parameters)
+        if missing or unknown:
+            raise TypeError(
+                f"The query {self.name} got wrong arguments, "
+                f"missing: {', '.join(sorted(missing)) or 'none'}, unknown: {', '.join(sorted(unknown)) or 'none'}."
+            )
+        for parameter in self.optional_parameters:
+            arguments.setdefault(parameter, None)
+
+    async def _execute(
+        self, source: AsyncQuerySource, arguments: Dict[str, Any]
+    ) -> Any:
+        if self.single:
+            return await source.query_single(self.text, **arguments)
+        return await source.query(self.text, **arguments)
+
+    async def __call__(self, source: AsyncQuerySource, **arguments: Any) -> Any:
+        """Runs the query.
+
+        :param source: A client, or a transaction the query should be part of.
+        :param arguments: The query parameters, optional ones can be left out.
+        :return: A set of results, or a single result (or None) for queries that return one element.
+        """
+        self._check_arguments(arguments)
+        started = time.perf_counter()
+        try:
+            if not isinstance(source, AsyncIOIteration):
+                # A single statement is atomic anyway, so it needs no explicit transaction.
+                source = source.with_retry_options(
+                    NO_RETRIES if self.read_only else CONFLICT_RETRIES
+                )
+            return await self._execute(source, arguments)
+        except BaseException:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def mean_time(self) -> float:
+        """How long the query took on average, in seconds."""
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def __repr__(self) -> str:
+        mode = "read" if self.read_only else "write"
+        return f"<Query {self.name} ({mode}) from {self.source}>"
+
+
+class QueryRegistry:
+    """Loads and validates all queries of a directory of .edgeql files once.
+
+    A file can contain several queries, each of them starts with a `# name: <name>` line.
+    Files without such a line contain a single query named like the file.
+    Optional headers after the name are `# mode: read` or `# mode: write` and `# returns: single`,
+    the mode is taken from the query itself if it is missing."""
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self._queries: Dict[str, Query] = {}
+        self.loaded = False
+
+    def load(self) -> None:
+        """Loads every query of the directory.
+
+        :raises: QueryError if a query is invalid or a name is used twice.
+        """
+        queries: Dict[str, Query] = {}
+        for path in sorted(self.directory.glob("*.edgeql")):
+            for query in self._parse_file(path):
+                if query.name in queries:
+                    raise QueryError(
+                        f"The query name {query.name} is used in {queries[query.name].source} and {query.source}."
+                    )
+                queries[query.name] = query
+        self._queries = queries
+        self.loaded = True
+
+    @staticmethod
+    def _parse_file(path: Path) -> Iterator[Query]:
+        text = path.read_text(encoding="utf-8")
+        names = [match for match in _HEADER.finditer(text) if match[1] == "name"]
+        if not names:
+            yield QueryRegistry._make_query(path.stem, text, path)
+            return
+        if _COMMENT.sub("", text[: names[0].start()]).strip():
+            raise QueryError(f"{path.name} has EdgeQL before the first '# name:' line.")
+        for index, match in enumerate(names):
+            end = names[index + 1].start() if index + 1 < len(names) else len(text)
+            yield QueryRegistry._make_query(match[2], text[match.start() : end], path)
+
+    @staticmethod
+    def _make_query(name: str, text: str, path: Path) -> Query:
+        headers = {key: value for key, value in _HEADER.findall(text)}
+        mode = headers.get("mode")
+        if mode not in (None, "read", "write"):
+            raise QueryError(
+                f"The query {name} in {path.name} has the unknown mode {mode}."
+            )
+        returns = headers.get("returns", "many")
+        if returns not in ("single", "many"):
+            raise QueryError(
+                f"The query {name} in {path.name} returns {returns}, use single or many."
+            )
+        code = _COMMENT.sub("", _STRING.sub("''", text))
+        read_only = mode == "read" if mode is not None else not _DML.search(code)
+        return Query(name, text, read_only, returns == "single", path.name)
+
+    def __getitem__(self, name: str) -> Query:
+        if not self.loaded:
+            self.load()
+        try:
+            return self._queries[name]
+        except KeyError:
+            raise KeyError(f"There is no query named {name}.") from None
+
+    def __contains__(self, name: object) -> bool:
+        if not self.loaded:
+            self.load()
+        return name in self._queries
+
+    def __iter__(self) -> Iterator[Query]:
+        if not self.loaded:
+            self.load()
+        return iter(self._queries.values())
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the timings of every query that ran at least once."""
+        return {
+            query.name: {
+                "calls": query.calls,
+                "errors": query.errors,
+                "mean_time": query.mean_time,
+                "max_time": query.max_time,
+            }
+            for query in self._queries.values()
+            if query.calls
+        }
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Awaitable, Callable, Collection, Dict, List, Optional
+
+import anyio
+from loguru import logger
+
+from database import QuoteKey
+
+# Gets the quotes for many (guild id, keyword) pairs at once, like QuoteStore.get_quotes.
+FetchQuotes = Callable[[Collection[QuoteKey]], Awaitable[Dict[QuoteKey, Optional[str]]]]
+
+
+class _Lookup:
+    """A single in-flight quote lookup that any number of tasks can wait for."""
+
+    def __init__(self, key: QuoteKey) -> None:
+        self.key = key
+        self.done = anyio.Event()
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class _Batch:
+    """Lookups that will be sent to the database together."""
+
+    def __init__(self) -> None:
+        self.lookups: List[_Lookup] = []
+        self.full = anyio.Event()
+
+
+class QuoteLookupBatcher:
+    """Coalesces concurrent quote lookups that have to go to the database.
+
+    Concurrent lookups for the same (guild, keyword) share one in-flight result.
+    Distinct lookups that arrive within `window` seconds are fetched together with one call of `fetch`,
+    a batch is sent early once it has `max_batch_size` lookups in it.
+    The first lookup of a batch waits for the window and then runs the query for everyone.
+
+    The bot only looks quotes up in the database until the quote index (or its snapshot) is loaded,
+    after that every message is answered from memory. So this only coalesces the lookups of a cold start,
+    when the messages that arrived while the bot was offline come in at once."""
+
+    def __init__(
+        self, fetch: FetchQuotes, window: float = 0.002, max_batch_size: int = 50
+    ) -> None:
+        if window < 0:
+            raise ValueError("The batching window can't be negative.")
+        if max_batch_size < 1:
+            raise ValueError("The maximum batch size must be at least 1.")
+        self.fetch = fetch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._in_flight: Dict[QuoteKey, _Lookup] = {}
+        self._open_batch: Optional[_Batch] = None
+
+    async def get(self, guild_id: Optional[int], text: str) -> Optional[str]:
+        """Gets the quote for the given text, preferring guild quotes over global quotes.
+
+        :param guild_id: The ID of the guild to check, or None for private channels.
+        :param text: The keyword to search for
+        :return: Either the found quote text, or None if nothing was found.
+        """
+        key: QuoteKey = (guild_id, text.lower())
+        lookup = self._in_flight.get(key)
+        if lookup is None:
+            lookup = _Lookup(key)
+            self._in_flight[key] = lookup
+            batch = self._open_batch
+            leader = batch is None
+            if batch is None:
+                batch = self._open_batch = _Batch()
+            batch.lookups.append(lookup)
+            if len(batch.lookups) >= self.max_batch_size:
+                self._open_batch = None
+                batch.full.set()
+            if leader:
+                # The other lookups of this batch depend on us, so we can't be cancelled.
+                with anyio.CancelScope(shield=True):
+                    await self._run_batch(batch)
+        await lookup.done.wait()
+        if lookup.error is not None:
+            raise lookup.error
+        return lookup.result
+
+    async def _run_batch(self, batch: _Batch) -> None:
+        """Waits for the batching window to end and then resolves all lookups of the batch."""
+        with anyio.move_on_after(self.window):
+            await batch.full.wait()
+        if self._open_batch is batch:
+            self._open_batch = None
+        keys = [lookup.key for lookup in batch.lookups]
+        logger.debug(f"Looking up {len(keys)} quotes in one query.")
+        try:
+            results = await self.fetch(keys)
+            for lookup in batch.lookups:
+                lookup.result = results.get(lookup.key)
+        except Exception as ex:  # pylint: disable=broad-except
+            for lookup in batch.lookups:
+                lookup.error = ex
+        finally:
+            for lookup in batch.lookups:
+                del self._in_flight[lookup.key]
+                lookup.done.set()
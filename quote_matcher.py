@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Set, Iterable, Tuple
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class KeywordMatcher:
+    """An Aho-Corasick automaton that finds quote keywords as whole words anywhere in a text.
+
+    Adding and removing keywords only changes the trie, the failure links are rebuilt lazily on the next search.
+    Searching costs O(len(text)) no matter how many keywords there are.
+    All keywords and texts are expected to be lower case already."""
+
+    def __init__(self, keywords: Iterable[str] = ()) -> None:
+        self._keywords: Set[str] = set()
+        self._removed = 0  # How many keywords were removed since the trie was last built from scratch.
+        self._reset()
+        for keyword in keywords:
+            self.add(keyword)
+
+    def _reset(self) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._terminal: List[Optional[str]] = [None]  # The keyword that ends at a node.
+        # The next node on the failure chain that ends a keyword.
+        self._out: List[int] = [0]
+        self._max_len = 0
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._keywords)
+
+    def __contains__(self, keyword: object) -> bool:
+        return keyword in self._keywords
+
+    def _insert(self, keyword: str) -> None:
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._terminal.append(None)
+                self._out.append(0)
+                self._goto[node][char] = next_node
+            node = next_node
+        self._terminal[node] = keyword
+        self._max_len = max(self._max_len, len(keyword))
+
+    def add(self, keyword: str) -> None:
+        """Adds a keyword to the automaton."""
+        if not keyword or keyword in self._keywords:
+            return
+        self._keywords.add(keyword)
+        self._insert(keyword)
+        self._dirty = True
+
+    def remove(self, keyword: str) -> None:
+        """Removes a keyword from the automaton."""
+        if keyword not in self._keywords:
+            return
+        self._keywords.remove(keyword)
+        self._removed += 1
+        if self._removed > len(self._keywords):
+            # Too many dead nodes, so build the trie from scratch.
+            self._removed = 0
+            self._reset()
+            for remaining in self._keywords:
+                self._insert(remaining)
+        else:
+            node = 0
+            for char in keyword:
+                node = self._goto[node][char]
+            self._terminal[node] = None
+        self._dirty = True
+
+    def _build(self) -> None:
+        """Computes the failure and output links with a breadth first walk over the trie."""
+        queue: List[int] = []
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            self._out[child] = 0
+            queue.append(child)
+        position = 0
+        while position < len(queue):
+            node = queue[position]
+            position += 1
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail
+                self._out[child] = (
+                    fail if self._terminal[fail] is not None else self._out[fail]
+                )
+                queue.append(child)
+        self._dirty = False
+
+    def find(self, text: str) -> Optional[str]:
+        """Finds the keyword that appears as a whole word in the text.
+
+        If multiple keywords appear, the leftmost one wins and then the longest one.
+        :param text: The lower case text to search in.
+        :return: The found keyword or None.
+        """
+        if not self._keywords:
+            return None
+        if self._dirty:
+            self._build()
+        goto, fail, terminal, out = self._goto, self._fail, self._terminal, self._out
+        best: Optional[Tuple[int, int, str]] = None  # (start, -length, keyword)
+        node = 0
+        for end, char in enumerate(text):
+            if best is not None and end - self._max_len >= best[0]:
+                break  # No keyword that ends here can start further left.
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if terminal[node] is not None else out[node]
+            while match:
+                keyword = terminal[match]
+                assert keyword is not None
+                start = end - len(keyword) + 1
+                candidate = (start, -len(keyword), keyword)
+                if (best is None or candidate < best) and self._is_whole_word(
+                    text, start, end, keyword
+                ):
+                    best = candidate
+                match = out[match]
+        return best[2] if best is not None else None
+
+    @staticmethod
+    def _is_whole_word(text: str, start: int, end: int, keyword: str) -> bool:
+        """Checks that the keyword isn't just part of a longer word.
+
+        Keywords that start or end with punctuation don't need a word boundary on that side."""
+        if start > 0 and _is_word_char(keyword[0]) and _is_word_char(text[start - 1]):
+            return False
+        if (
+            end + 1 < len(text)
+            and _is_word_char(keyword[-1])
+            and _is_word_char(text[end + 1])
+        ):
+            return False
+        return True
@@ -0,0 +1,172 @@
+from __future__ import annotations
+import marshal
+import os
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Final, Optional, Set, Tuple
+
+import anyio
+import attr
+from loguru import logger
+
+from database import QuoteIndex
+from limiters import blocking_limiter
+
+# magic, format version, Python major and minor version, payload length, CRC32 of the payload
+_HEADER: Final[struct.Struct] = struct.Struct("<4sHBBII")
+_MAGIC: Final[bytes] = b"GBQS"
+_FORMAT_VERSION: Final[int] = 1
+
+
+@attr.s(auto_attribs=True, slots=True)
+class QuoteSnapshot:
+    """The quote index as it was saved in a snapshot file."""
+
+    backend: str  # The quote store the quotes came from.
+    created_at: float  # Unix time.
+    guilds: Dict[int, Dict[str, str]]
+    anywhere_guilds: Set[int]
+
+    @property
+    def quotes(self) -> int:
+        return sum(len(quotes) for quotes in self.guilds.values())
+
+
+def dump_snapshot(
+    backend: str, guilds: Dict[int, Dict[str, str]], anywhere_guilds: Set[int]
+) -> bytes:
+    """Serializes the quote index into the bytes of a snapshot file.
+
+    The payload is marshal data, which Python reads back in one C call. The format of marshal can change between
+    Python versions, so the version is part of the header and a snapshot of another version is ignored.
+    This only takes a few milliseconds and holds the GIL, so it is safe to call on the event loop
+    while nothing else changes the index."""
+    payload = marshal.dumps(
+        (backend, time.time(), guilds, sorted(anywhere_guilds)), marshal.version
+    )
+    header = _HEADER.pack(
+        _MAGIC,
+        _FORMAT_VERSION,
+        sys.version_info.major,
+        sys.version_info.minor,
+        len(payload),
+        zlib.crc32(payload),
+    )
+    return header + payload
+
+
+def write_snapshot(path: Path, data: bytes) -> None:
+    """Writes a snapshot file so that it is never left half written, this blocks."""
+    temporary = path.with_name(path.name + ".tmp")
+    with temporary.open("wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def read_snapshot(path: Path, backend: str) -> Optional[QuoteSnapshot]:
+    """Reads a snapshot file with one sequential read, this blocks.
+
+    :param backend: The quote store in use, a snapshot of another store is ignored.
+    :return: The snapshot, or None if there is none or it can't be used.
+    """
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    if len(data) < _HEADER.size:
+        logger.warning(f"The quote snapshot {path} is too short, ignoring it.")
+        return None
+    magic, version, major, minor, length, checksum = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _FORMAT_VERSION:
+        logger.warning(f"{path} is not a quote snapshot of this version, ignoring it.")
+        return None
+    if (major, minor) != sys.version_info[:2]:
+        logger.info(
+            f"The quote snapshot was written by Python {major}.{minor}, ignoring it."
+        )
+        return None
+    payload = memoryview(data)[_HEADER.size :]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        logger.warning(f"The quote snapshot {path} is damaged, ignoring it.")
+        return None
+    try:
+        snapshot_backend, created_at, guilds, anywhere_guilds = marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        logger.warning(f"The quote snapshot {path} can't be read, ignoring it.")
+        return None
+    if snapshot_backend != backend:
+        logger.info(
+            f"The quote snapshot is from the {snapshot_backend} store, not {backend}, ignoring it."
+        )
+        return None
+    return QuoteSnapshot(backend, created_at, guilds, set(anywhere_guilds))
+
+
+class QuoteSnapshotWriter:
+    """Saves the quote index to a snapshot file, every `interval` seconds if it changed and on shutdown.
+
+    Serializing happens on the event loop, so the index can't change halfway through,
+    only writing the file happens in a worker thread."""
+
+    def __init__(
+        self, index: QuoteIndex, path: Path, backend: str, interval: float = 600.0
+    ) -> None:
+        self.index = index
+        self.path = path
+        self.backend = backend
+        self.interval = interval
+        self.writes = 0
+        self._written_state: Optional[Tuple[int, frozenset]] = None
+        # This needs a running event loop, so it is created on first use.
+        self._lock: Optional[anyio.Lock] = None
+
+    def _state(self) -> Tuple[int, frozenset]:
+        return self.index.changes, frozenset(self.index.anywhere_guilds)
+
+    async def write(self) -> bool:
+        """Writes the snapshot if the index changed since the last write.
+
+        :return: Whether a snapshot was written.
+        """
+        if self._lock is None:
+            self._lock = anyio.Lock()
+        async with self._lock:
+            state = self._state()
+            # An index that was never loaded would overwrite a good snapshot with nothing.
+            if not self.index.loaded or state == self._written_state:
+                return False
+            started = time.perf_counter()
+            data = dump_snapshot(self.backend, *self.index.export())
+            await blocking_limiter.run_sync(write_snapshot, self.path, data)
+            self._written_state = state
+            self.writes += 1
+            logger.debug(
+                f"Wrote the quote snapshot ({len(data)} bytes) in {(time.perf_counter() - started) * 1000:.1f}ms."
+            )
+            return True
+
+    def mark_written(self) -> None:
+        """Remembers that the index is the same as the snapshot file, for example right after loading it."""
+        self._written_state = self._state()
+
+    async def run(self) -> None:
+        """Writes the snapshot in the background until it is cancelled."""
+        while True:
+            await anyio.sleep(self.interval)
+            try:
+                await self.write()
+            except OSError:
+                logger.exception("Could not write the quote snapshot.")
+
+    async def aclose(self) -> None:
+        """Writes the last snapshot, this should be called on shutdown."""
+        with anyio.CancelScope(shield=True):
+            try:
+                await self.write()
+            except OSError:
+                logger.exception("Could not write the quote snapshot.")
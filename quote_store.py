@@ -0,0 +1,505 @@
+from __future__ import annotations
+import abc
+import bisect
+from typing import Any, Collection, Dict, Final, List, Optional, Tuple, Type
+
+import anyio
+
+import async_database
+import database
+from async_database import db_thread
+from database import GLOBAL_GUILD_ID, QuoteKey, closest_keywords
+from quote_usage import QuoteUsage
+
+
+class QuoteStore(abc.ABC):
+    """Where the quotes are kept.
+
+    Everything the bot does with quotes goes through this interface, so the storage engine can be swapped
+    in the config. Global quotes use GLOBAL_GUILD_ID as guild id and all keywords are compared in lower case.
+    """
+
+    name: str = ""
+
+    async def open(self) -> None:
+        """Gets the store ready, this is called once before it is used."""
+
+    async def close(self) -> None:
+        """Releases everything the store holds."""
+
+    def query_stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the timings of the queries this store ran, by query name."""
+        return {}
+
+    # Whether the store keeps the users, guilds and channels the bot sees, see entity_sync.py.
+    # The other stores ignore the entity methods.
+    saves_entities: bool = False
+
+    async def save_users(self, users: List[Tuple[int, str, str]]) -> None:
+        """Saves many users at once, as (user ID, name, tag)."""
+
+    async def save_guild(
+        self,
+        guild_id: int,
+        name: str,
+        member_ids: Collection[int],
+        chunk_size: int = 500,
+    ) -> None:
+        """Saves a guild with its whole member list, the members have to be saved already.
+
+        :param chunk_size: How many member IDs are sent with one query at most.
+        """
+
+    async def save_guild_channels(
+        self, guild_id: int, channels: List[Tuple[int, str]]
+    ) -> None:
+        """Saves many channels of a saved guild at once, as (channel ID, name)."""
+
+    async def change_guild_members(
+        self, guild_id: int, joined: Collection[int], left: Collection[int]
+    ) -> None:
+        """Adds and removes members of a saved guild, the members that joined have to be saved already."""
+
+    @abc.abstractmethod
+    async def get_quotes(
+        self, keys: Collection[QuoteKey]
+    ) -> Dict[QuoteKey, Optional[str]]:
+        """Gets the quotes for many (guild id, keyword) pairs.
+
+        A guild quote is preferred over a global one, a guild id of None only finds global quotes.
+        :return: The found quote text or None for every key.
+        """
+
+    async def get_quote(self, guild_id: Optional[int], keyword: str) -> Optional[str]:
+        """Gets the quote for one keyword, preferring the guild quote over the global one."""
+        key: QuoteKey = (guild_id, keyword.lower())
+        return (await self.get_quotes([key]))[key]
+
+    @abc.abstractmethod
+    async def add_quote(
+        self, guild_id: int, keyword: str, text: str, author_id: int
+    ) -> None:
+        """Saves a quote, replacing the quote with the same keyword in that guild."""
+
+    @abc.abstractmethod
+    async def add_global_quote(
+        self, keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+    ) -> bool:
+        """Saves a global quote.
+
+        :param overwrite: Whether an existing global quote with that keyword gets replaced.
+        :return: Whether the quote was saved.
+        """
+
+    @abc.abstractmethod
+    async def delete_quote(self, guild_id: int, keyword: str) -> bool:
+        """Deletes the quote with the given keyword from that guild and returns whether there was one."""
+
+    @abc.abstractmethod
+    async def list_keywords(self, guild_id: int) -> List[str]:
+        """Gets the keywords of all quotes of a guild."""
+
+    @abc.abstractmethod
+    async def list_keywords_page(
+        self,
+        guild_id: int,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        start: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[str]:
+        """Gets one page of the keywords of a guild in alphabetical order.
+
+        Pages are found by keyword (keyset pagination), not by offset, so every page is equally cheap.
+        :param after: Only get keywords after this one, for the next page.
+        :param before: Only get the keywords right before this one, for the previous page.
+        :param start: Only get keywords from this one on.
+        :param limit: How many keywords to get at most.
+        """
+
+    @abc.abstractmethod
+    async def search_quotes(
+        self, guild_id: int, text: str, limit: int = 10
+    ) -> List[Tuple[str, str]]:
+        """Searches the quotes of a guild by keyword and text.
+
+        Keywords that start with the text come first, then quotes that contain it,
+        then keywords that are only similar to it, so typos still find something.
+        :return: Up to `limit` (keyword, quote text) pairs, the best matches first.
+        """
+
+    @abc.abstractmethod
+    async def read_quotes(
+        self, guild_id: Optional[int] = None
+    ) -> Dict[int, Dict[str, str]]:
+        """Reads all quotes, or only the quotes of one guild, for the in-memory quote index.
+
+        :return: guild id -> keyword -> quote text.
+        """
+
+    @abc.abstractmethod
+    async def record_usage(self, usages: List[QuoteUsage]) -> None:
+        """Adds up the usage statistics of many quotes in one batch."""
+
+
+class MemoryQuoteStore(QuoteStore):
+    """Keeps the quotes in a dict, nothing is saved. Useful for tests and benchmarks."""
+
+    name = "memory"
+
+    def __init__(self) -> None:
+        self._guilds: Dict[int, Dict[str, str]] = {}
+        self.times_used: Dict[Tuple[int, str], int] = {}
+
+    async def get_quotes(
+        self, keys: Collection[QuoteKey]
+    ) -> Dict[QuoteKey, Optional[str]]:
+        global_quotes = self._guilds.get(GLOBAL_GUILD_ID, {})
+        results: Dict[QuoteKey, Optional[str]] = {}
+        for guild_id, keyword in keys:
+            result = None
+            if guild_id is not None:
+                result = self._guilds.get(guild_id, {}).get(keyword)
+            results[(guild_id, keyword)] = (
+                result if result is not None else global_quotes.get(keyword)
+            )
+        return results
+
+    async def add_quote(
+        self, guild_id: int, keyword: str, text: str, author_id: int
+    ) -> None:
+        self._guilds.setdefault(guild_id, {})[keyword.lower()] = text
+
+    async def add_global_quote(
+        self, keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+    ) -> bool:
+        quotes = self._guilds.setdefault(GLOBAL_GUILD_ID, {})
+        if not overwrite and keyword.lower() in quotes:
+            return False
+        quotes[keyword.lower()] = text
+        return True
+
+    async def delete_quote(self, guild_id: int, keyword: str) -> bool:
+        return self._guilds.get(guild_id, {}).pop(keyword.lower(), None) is not None
+
+    async def list_keywords(self, guild_id: int) -> List[str]:
+        return list(self._guilds.get(guild_id, {}))
+
+    async def list_keywords_page(
+        self,
+        guild_id: int,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        start: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[str]:
+        keywords = sorted(self._guilds.get(guild_id, {}))
+        low = 0 if start is None else bisect.bisect_left(keywords, start.lower())
+        if before is not None:
+            high = bisect.bisect_left(keywords, before)
+            return keywords[max(low, high - limit) : high]
+        if after is not None:
+            low = max(low, bisect.bisect_right(keywords, after))
+        return keywords[low : low + limit]
+
+    async def search_quotes(
+        self, guild_id: int, text: str, limit: int = 10
+    ) -> List[Tuple[str, str]]:
+        text = text.strip().lower()
+        if not text:
+            return []
+        quotes = self._guilds.get(guild_id, {})
+        keywords = sorted(quotes)
+        found = [keyword for keyword in keywords if keyword.startswith(text)]
+        found += [
+            keyword
+            for keyword in keywords
+            if text in keyword[1:] or text in quotes[keyword].lower()
+        ]
+        found += closest_keywords(text, keywords, limit)
+        return [(keyword, quotes[keyword]) for keyword in dict.fromkeys(found)][:limit]
+
+    async def read_quotes(
+        self, guild_id: Optional[int] = None
+    ) -> Dict[int, Dict[str, str]]:
+        if guild_id is None:
+            return {guild: dict(quotes) for guild, quotes in self._guilds.items()}
+        return {guild_id: dict(self._guilds.get(guild_id, {}))}
+
+    async def record_usage(self, usages: List[QuoteUsage]) -> None:
+        for usage in usages:
+            key = (usage.guild_id, usage.keyword)
+            if usage.keyword in self._guilds.get(usage.guild_id, {}):
+                self.times_used[key] = self.times_used.get(key, 0) + usage.uses
+
+
+class SQLiteQuoteStore(QuoteStore):
+    """Keeps the quotes in the peewee Quote table, all queries run on the database thread.
+
+    The database thread is started by the bot, because the guild settings live in SQLite with every store."""
+
+    name = "sqlite"
+
+    async def get_quotes(
+        self, keys: Collection[QuoteKey]
+    ) -> Dict[QuoteKey, Optional[str]]:
+        return await async_database.get_quotes(list(keys))
+
+    async def add_quote(
+        self, guild_id: int, keyword: str, text: str, author_id: int
+    ) -> None:
+        await async_database.add_quote(guild_id, keyword, text, author_id)
+
+    async def add_global_quote(
+        self, keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+    ) -> bool:
+        return await async_database.add_global_quote(
+            keyword, text, author_id, overwrite
+        )
+
+    async def delete_quote(self, guild_id: int, keyword: str) -> bool:
+        return await async_database.delete_quote(guild_id, keyword)
+
+    async def list_keywords(self, guild_id: int) -> List[str]:
+        return await async_database.list_keywords(guild_id)
+
+    async def list_keywords_page(
+        self,
+        guild_id: int,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        start: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[str]:
+        return await async_database.list_keywords_page(
+            guild_id, after, before, start, limit
+        )
+
+    async def search_quotes(
+        self, guild_id: int, text: str, limit: int = 10
+    ) -> List[Tuple[str, str]]:
+        return await async_database.search_quotes(guild_id, text, limit)
+
+    async def read_quotes(
+        self, guild_id: Optional[int] = None
+    ) -> Dict[int, Dict[str, str]]:
+        return await db_thread.run(database.read_quotes, guild_id)
+
+    async def record_usage(self, usages: List[QuoteUsage]) -> None:
+        await async_database.record_usage(usages)
+
+
+class EdgeDBQuoteStore(QuoteStore):
+    """Keeps the quotes in EdgeDB.
+
+    The client keeps a pool of up to `max_concurrency` connections and every write is its own transaction,
+    which the client retries on transaction conflicts.
+    `entity_cache_size` is how many saved users, guilds and channels are remembered, see EntityCache."""
+
+    name = "edgedb"
+
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        max_concurrency: int = 10,
+        entity_cache_size: int = 100_000,
+    ) -> None:
+        self.dsn = dsn
+        self.max_concurrency = max_concurrency
+        self.entity_cache_size = entity_cache_size
+        self._client: Any = None
+        self._queries: Any = None
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            raise RuntimeError("The EdgeDB quote store is not open.")
+        return self._client
+
+    async def open(self) -> None:
+        # edgedb is only imported when this store is used.
+        import edgedb
+        from queries import edgeql_queries
+
+        self._queries = edgeql_queries
+        edgeql_queries.entity_cache.max_entries = self.entity_cache_size
+        # Invalid query files should stop the bot right at the start, not on first use.
+        edgeql_queries.registry.load()
+        self._client = edgedb.create_async_client(
+            self.dsn or edgeql_queries.instance_name,
+            max_concurrency=self.max_concurrency,
+        )
+        await self._client.ensure_connected()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def query_stats(self) -> Dict[str, Dict[str, float]]:
+        return {} if self._queries is None else self._queries.registry.stats()
+
+    saves_entities = True
+
+    async def save_users(self, users: List[Tuple[int, str, str]]) -> None:
+        await self._queries.sync_users(self.client, users)
+
+    async def save_guild(
+        self,
+        guild_id: int,
+        name: str,
+        member_ids: Collection[int],
+        chunk_size: int = 500,
+    ) -> None:
+        await self._queries.save_guild(
+            self.client, guild_id, name, member_ids, chunk_size
+        )
+
+    async def save_guild_channels(
+        self, guild_id: int, channels: List[Tuple[int, str]]
+    ) -> None:
+        await self._queries.sync_guild_channels(self.client, guild_id, channels)
+
+    async def change_guild_members(
+        self, guild_id: int, joined: Collection[int], left: Collection[int]
+    ) -> None:
+        await self._queries.change_guild_members(self.client, guild_id, joined, left)
+
+    @staticmethod
+    def _guild(guild_id: Optional[int]) -> Optional[int]:
+        """EdgeDB has its own type for global quotes, so they use None as guild id there."""
+        return None if guild_id == GLOBAL_GUILD_ID else guild_id
+
+    async def get_quote(self, guild_id: Optional[int], keyword: str) -> Optional[str]:
+        return await self._queries.get_quote(
+            self.client, keyword, guild_id=self._guild(guild_id)
+        )
+
+    async def get_quotes(
+        self, keys: Collection[QuoteKey]
+    ) -> Dict[QuoteKey, Optional[str]]:
+        results: Dict[QuoteKey, Optional[str]] = {}
+
+        async def lookup(key: QuoteKey) -> None:
+            results[key] = await self.get_quote(*key)
+
+        # The lookups run concurrently over the connection pool.
+        async with anyio.create_task_group() as task_group:
+            for key in set(keys):
+                task_group.start_soon(lookup, key)
+        return results
+
+    def _quote(
+        self, guild_id: Optional[int], keyword: str, text: str, author_id: int
+    ) -> Dict[str, Any]:
+        return {
+            "guild_id": self._guild(guild_id),
+            "keyword": keyword.lower(),
+            "quote_text": text,
+            "author_id": author_id,
+        }
+
+    async def add_quote(
+        self, guild_id: int, keyword: str, text: str, author_id: int
+    ) -> None:
+        await self._queries.save_quote(
+            self.client, self._quote(guild_id, keyword, text, author_id)
+        )
+
+    async def add_global_quote(
+        self, keyword: str, text: str, author_id: int = -1, overwrite: bool = False
+    ) -> bool:
+        return await self._queries.save_quote(
+            self.client,
+            self._quote(GLOBAL_GUILD_ID, keyword, text, author_id),
+            overwrite=overwrite,
+        )
+
+    async def delete_quote(self, guild_id: int, keyword: str) -> bool:
+        return await self._queries.delete_quote(
+            self.client, self._guild(guild_id), keyword
+        )
+
+    async def list_keywords(self, guild_id: int) -> List[str]:
+        return await self._queries.list_keywords(self.client, self._guild(guild_id))
+
+    async def list_keywords_page(
+        self,
+        guild_id: int,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        start: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[str]:
+        return await self._queries.list_keywords_page(
+            self.client, self._guild(guild_id), after, before, start, limit
+        )
+
+    async def search_quotes(
+        self, guild_id: int, text: str, limit: int = 10
+    ) -> List[Tuple[str, str]]:
+        text = text.strip().lower()
+        if not text:
+            return []
+        results = dict(
+            await self._queries.search_quotes(self.client, guild_id, text, limit)
+        )
+        if len(results) < limit:
+            # There is no trigram index in EdgeDB, so typos are matched against all keywords of the guild.
+            keywords = await self.list_keywords(guild_id)
+            for keyword in closest_keywords(text, keywords, limit):
+                if keyword not in results:
+                    results[keyword] = await self.get_quote(guild_id, keyword) or ""
+        return list(results.items())[:limit]
+
+    async def read_quotes(
+        self, guild_id: Optional[int] = None
+    ) -> Dict[int, Dict[str, str]]:
+        # Global quotes can only be read together with all other quotes.
+        quotes_by_guild = await self._queries.read_quotes(
+            self.client, self._guild(guild_id)
+        )
+        guilds = {
+            GLOBAL_GUILD_ID if guild is None else guild: quotes
+            for guild, quotes in quotes_by_guild.items()
+        }
+        if guild_id is None:
+            return guilds
+        return {guild_id: guilds.get(guild_id, {})}
+
+    async def record_usage(self, usages: List[QuoteUsage]) -> None:
+        await self._queries.record_usage(
+            self.client,
+            [
+                {
+                    "guild_id": self._guild(usage.guild_id),
+                    "keyword": usage.keyword,
+                    "uses": usage.uses,
+                    "last_used_at": usage.last_used_at.isoformat(),
+                    "last_used_by": usage.last_used_by,
+                    "last_used_in": usage.last_used_in,
+                }
+                for usage in usages
+            ],
+        )
+
+
+STORES: Final[Dict[str, Type[QuoteStore]]] = {
+    store.name: store
+    for store in (MemoryQuoteStore, SQLiteQuoteStore, EdgeDBQuoteStore)
+}
+
+
+def create_quote_store(backend: str, **options: Any) -> QuoteStore:
+    """Creates the quote store for the given backend name.
+
+    :param backend: One of memory, sqlite and edgedb.
+    :param options: Passed on to the store, for example the dsn of the EdgeDB store.
+    :raises: ValueError if there is no such backend.
+    """
+    store_class = STORES.get(backend.lower())
+    if store_class is None:
+        raise ValueError(
+            f"Unknown quote backend {backend}, use one of {', '.join(STORES)}."
+        )
+    return store_class(**options)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Exports the quotes of the bot to a JSONL or CSV file and imports them from one.
+
+Both directions stream: the database is read in keyset batches and the file line by line,
+so memory use doesn't depend on the number of quotes. Imports are written in one transaction per batch.
+The format is taken from the file extension (.jsonl or .csv), every row has the fields
+guild_id, keyword, quote and author_id. Global quotes have the guild id -1.
+
+Run it from the directory that contains bot.db:
+    python quote_transfer.py export quotes.jsonl [--guild ID]
+    python quote_transfer.py import quotes.csv [--guild ID] [--overwrite]"""
+from __future__ import annotations
+import argparse
+import csv
+import json
+import os
+import string
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Final, Iterator, List, Optional, Set, Tuple
+
+import attr
+from loguru import logger
+
+from database import (
+    db,
+    Quote,
+    GuildSettings,
+    configure_database,
+    import_quotes,
+    migrate_database,
+    read_quote_rows,
+)
+
+FIELDS: Final[Tuple[str, ...]] = ("guild_id", "keyword", "quote", "author_id")
+FORMATS: Final[Tuple[str, ...]] = ("jsonl", "csv")
+MAX_KEYWORD_LENGTH: Final[int] = 300
+MAX_QUOTE_LENGTH: Final[
+    int
+] = 2000  # Longer quotes can't be sent in one Discord message.
+# Four columns per quote and SQLite allows 32766 variables per statement.
+MAX_BATCH_SIZE: Final[int] = 8000
+
+
+class QuoteFileError(ValueError):
+    """A row of a quote file can't be imported."""
+
+
+@attr.s(auto_attribs=True, slots=True)
+class ImportResult:
+    """What an import did."""
+
+    rows: int = 0  # How many rows were read from the file.
+    written: int = 0  # How many quotes were inserted or replaced.
+    invalid: int = 0  # How many rows were skipped because they are not valid.
+    guilds: Set[int] = attr.Factory(set)  # The guild ids that got quotes.
+
+    @property
+    def kept(self) -> int:
+        """How many valid rows were not written, because the keyword already existed."""
+        return self.rows - self.invalid - self.written
+
+
+def file_format(path: Path) -> str:
+    """Gets the format of a quote file from its extension.
+
+    :raises: QuoteFileError if the format is not supported.
+    """
+    suffix = path.suffix.lower().lstrip(".")
+    if suffix == "json":
+        suffix = "jsonl"
+    if suffix not in FORMATS:
+        raise QuoteFileError(
+            f"Unknown quote file format {path.suffix}, use .jsonl or .csv."
+        )
+    return suffix
+
+
+class QuoteWriter:
+    """Writes quote rows to an open text file in one of the formats."""
+
+    def __init__(self, file: Any, format_name: str) -> None:
+        self.format_name = format_name
+        self.written = 0
+        self._file = file
+        self._csv = csv.writer(file) if format_name == "csv" else None
+        if self._csv is not None:
+            self._csv.writerow(FIELDS)
+
+    def write(self, rows: List[Tuple[int, int, str, str, int]]) -> None:
+        """Writes rows as they come from database.read_quote_rows."""
+        for _, guild_id, keyword, result, author_id in rows:
+            if self._csv is not None:
+                self._csv.writerow((guild_id, keyword, result, author_id))
+            else:
+                self._file.write(
+                    json.dumps(
+                        dict(zip(FIELDS, (guild_id, keyword, result, author_id))),
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+        self.written += len(rows)
+
+
+def validate_row(row: Dict[str, Any], guild_id: Optional[int] = None) -> Dict[str, Any]:
+    """Turns a row of a quote file into the fields of a Quote.
+
+    :param guild_id: Put the quote into this guild instead of the one in the row.
+    :raises: QuoteFileError if the row is not a valid quote.
+    """
+    required = ("keyword", "quote") if guild_id is not None else FIELDS[:3]
+    for field in required:
+        # CSV rows with too few columns have None in the missing fields.
+        if row.get(field) is None:
+            raise QuoteFileError(f"The field {field} is missing.")
+    try:
+        keyword = str(row["keyword"]).strip().lower()
+        text = str(row["quote"])
+        target = int(row["guild_id"]) if guild_id is None else guild_id
+        author = row.get("author_id")
+        author_id = -1 if author in (None, "") else int(author)
+    except (TypeError, ValueError) as error:
+        raise QuoteFileError(f"A field has the wrong type: {error}") from None
+    if not keyword or len(keyword) > MAX_KEYWORD_LENGTH:
+        raise QuoteFileError(
+            f"The keyword must have 1 to {MAX_KEYWORD_LENGTH} characters."
+        )
+    if not text.strip() or len(text) > MAX_QUOTE_LENGTH:
+        raise QuoteFileError(f"The quote must have 1 to {MAX_QUOTE_LENGTH} characters.")
+    if keyword[0] in string.punctuation or text[0] in string.punctuation:
+        raise QuoteFileError(
+            "Neither the keyword nor the quote can start with punctuation, so they don't run bot commands."
+        )
+    return {
+        "guildId": target,
+        "keyword": keyword,
+        "result": text,
+        "authorId": author_id,
+    }
+
+
+class QuoteReader:
+    """Reads the valid rows of a quote file in batches.
+
+    The file is read line by line, so only one batch is in memory at a time.
+    Invalid rows are logged and skipped, `bytes_read` and `size` tell how far the reader got."""
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        format_name: str,
+        guild_id: Optional[int] = None,
+        batch_size: int = 1000,
+    ) -> None:
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"The batch size must be between 1 and {MAX_BATCH_SIZE}.")
+        self.format_name = format_name
+        self.guild_id = guild_id
+        self.batch_size = batch_size
+        self.bytes_read = 0
+        self.rows = 0
+        self.invalid = 0
+        self._file = file
+        self.size = os.fstat(file.fileno()).st_size
+        self._rows = self._read_rows()
+
+    def _lines(self) -> Iterator[str]:
+        for number, line in enumerate(self._file):
+            self.bytes_read += len(line)
+            # Files saved by Excel start with a byte order mark.
+            yield line.decode("utf-8-sig" if number == 0 else "utf-8")
+
+    def _read_rows(self) -> Iterator[Dict[str, Any]]:
+        if self.format_name == "csv":
+            # The csv module joins quoted fields that span several lines by itself.
+            reader = csv.DictReader(self._lines())
+            for row in reader:
+                yield self._validate(reader.line_num, row)
+            return
+        for number, line in enumerate(self._lines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield self._invalid(number, f"It is not valid JSON: {error}")
+                continue
+            if not isinstance(row, dict):
+                yield self._invalid(number, "It is not a JSON object.")
+                continue
+            yield self._validate(number, row)
+
+    def _invalid(self, line: int, reason: str) -> Dict[str, Any]:
+        self.invalid += 1
+        logger.warning(f"Skipping line {line} of the quote file. {reason}")
+        return {}
+
+    def _validate(self, line: int, row: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return validate_row(row, self.guild_id)
+        except QuoteFileError as error:
+            return self._invalid(line, str(error))
+
+    def read_batch(self) -> List[Dict[str, Any]]:
+        """Reads the next batch of valid quotes, an empty list at the end of the file."""
+        batch: List[Dict[str, Any]] = []
+        for quote in self._rows:
+            self.rows += 1
+            if quote:
+                batch.append(quote)
+                if len(batch) >= self.batch_size:
+                    break
+        return batch
+
+    @property
+    def progress(self) -> str:
+        """How far the reader got, for progress messages."""
+        if not self.size:
+            return f"{self.rows} rows"
+        return f"{self.rows} rows ({self.bytes_read / self.size:.0%})"
+
+
+def export_file(
+    path: Path, guild_id: Optional[int] = None, batch_size: int = 1000
+) -> int:
+    """Exports the quotes into a file, this blocks and uses the database directly.
+
+    :param guild_id: Only export the quotes of this guild, or all quotes if None.
+    :return: How many quotes were exported.
+    """
+    started = time.perf_counter()
+    with path.open("w", encoding="utf-8", newline="") as file:
+        writer = QuoteWriter(file, file_format(path))
+        last_id = 0
+        while rows := read_quote_rows(last_id, guild_id, batch_size):
+            writer.write(rows)
+            last_id = rows[-1][0]
+            logger.info(f"{writer.written} quotes exported.")
+    elapsed = time.perf_counter() - started
+    logger.success(f"Exported {writer.written} quotes to {path} in {elapsed:.1f}s.")
+    return writer.written
+
+
+def import_file(
+    path: Path,
+    guild_id: Optional[int] = None,
+    overwrite: bool = False,
+    batch_size: int = 1000,
+) -> ImportResult:
+    """Imports the quotes of a file, this blocks and uses the database directly.
+
+    :param guild_id: Put all quotes into this guild instead of the ones in the file.
+    :param overwrite: Whether existing quotes with the same keyword get replaced.
+    """
+    result = ImportResult()
+    started = time.perf_counter()
+    with path.open("rb") as file:
+        reader = QuoteReader(file, file_format(path), guild_id, batch_size)
+        while batch := reader.read_batch():
+            result.written += import_quotes(batch, overwrite)
+            result.guilds.update(quote["guildId"] for quote in batch)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"{reader.progress} read, {result.written} quotes written, {reader.rows / elapsed:.0f} rows/s."
+            )
+    result.rows = reader.rows
+    result.invalid = reader.invalid
+    logger.success(
+        f"Imported {result.written} of {result.rows} rows from {path}, "
+        f"{result.kept} quotes already existed and {result.invalid} rows were invalid."
+    )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("file", type=Path, help="A .jsonl or .csv file.")
+    parser.add_argument(
+        "--sqlite", default="bot.db", help="The SQLite database to use."
+    )
+    parser.add_argument(
+        "--guild",
+        type=int,
+        default=None,
+        help="Only export this guild, or import all quotes into this guild.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Replace existing quotes with the same keyword on import.",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    if not 1 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f"The batch size must be between 1 and {MAX_BATCH_SIZE}.")
+    try:
+        file_format(args.file)
+    except QuoteFileError as error:
+        parser.error(str(error))
+    configure_database(path=args.sqlite)
+    db.connect()
+    try:
+        db.create_tables([Quote, GuildSettings])
+        migrate_database()
+        if args.action == "export":
+            export_file(args.file, args.guild, args.batch_size)
+        else:
+            import_file(args.file, args.guild, args.overwrite, args.batch_size)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from __future__ import annotations
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import anyio
+import attr
+from loguru import logger
+
+
+@attr.s(auto_attribs=True, slots=True)
+class QuoteUsage:
+    """How often a quote was used since the last flush and who used it last."""
+
+    guild_id: int  # The guild of the quote, GLOBAL_GUILD_ID for global quotes.
+    keyword: str
+    uses: int
+    last_used_at: datetime
+    last_used_by: int  # The ID of the user.
+    last_used_in: int  # The ID of the channel.
+
+
+class QuoteUsageTracker:
+    """Collects quote usage statistics in memory and writes them in batches.
+
+    Recording a use is just a dict update, so it costs almost nothing when the bot replies with a quote.
+    Uses of the same quote are added up and everything is handed to `flush` at once,
+    every `interval` seconds, as soon as `max_pending` different quotes are waiting, and on shutdown.
+    If a flush fails, its uses are kept and written with the next one."""
+
+    def __init__(
+        self,
+        flush: Callable[[List[QuoteUsage]], Awaitable[None]],
+        interval: float = 60.0,
+        max_pending: int = 500,
+    ) -> None:
+        if interval <= 0:
+            raise ValueError("The flush interval must be positive.")
+        if max_pending < 1:
+            raise ValueError("At least one quote has to fit into a flush.")
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: Dict[Tuple[int, str], QuoteUsage] = {}
+        # These need a running event loop, so they are created once the tracker runs.
+        self._wake: Optional[anyio.Event] = None
+        self._lock: Optional[anyio.Lock] = None
+        self.recorded = 0  # How many uses were recorded in total.
+        self.written = 0  # How many uses were written in total.
+        self.flushes = 0  # How many flushes succeeded.
+        self.failed_flushes = 0
+
+    @property
+    def pending(self) -> int:
+        """How many different quotes are waiting to be written."""
+        return len(self._pending)
+
+    def record(
+        self, guild_id: int, keyword: str, user_id: int, channel_id: int
+    ) -> None:
+        """Records that a quote was used.
+
+        :param guild_id: The guild of the quote, GLOBAL_GUILD_ID for global quotes.
+        :param keyword: The lower case keyword of the quote.
+        :param user_id: Who triggered the quote.
+        :param channel_id: Where the quote was triggered.
+        """
+        now = datetime.now(timezone.utc)
+        usage = self._pending.get((guild_id, keyword))
+        if usage is None:
+            self._pending[(guild_id, keyword)] = QuoteUsage(
+                guild_id, keyword, 1, now, user_id, channel_id
+            )
+            if len(self._pending) >= self.max_pending and self._wake is not None:
+                self._wake.set()
+        else:
+            usage.uses += 1
+            usage.last_used_at = now
+            usage.last_used_by = user_id
+            usage.last_used_in = channel_id
+        self.recorded += 1
+
+    def _restore(self, usages: List[QuoteUsage]) -> None:
+        """Puts the uses of a failed flush back, uses recorded in the meantime are newer."""
+        for usage in usages:
+            newer = self._pending.get((usage.guild_id, usage.keyword))
+            if newer is None:
+                self._pending[(usage.guild_id, usage.keyword)] = usage
+            else:
+                newer.uses += usage.uses
+
+    async def flush(self) -> int:
+        """Writes all pending uses now.
+
+        :return: How many uses were written.
+        """
+        if self._lock is None:
+            self._lock = anyio.Lock()
+        async with self._lock:
+            if not self._pending:
+                return 0
+            usages = list(self._pending.values())
+            self._pending = {}
+            try:
+                # The uses are only in this list now, so a cancellation must not lose them.
+                with anyio.CancelScope(shield=True):
+                    await self._flush(usages)
+            except Exception:  # pylint: disable=broad-except
+                self.failed_flushes += 1
+                self._restore(usages)
+                logger.exception(
+                    f"Could not write the usage of {len(usages)} quotes, trying again later."
+                )
+                return 0
+            written = sum(usage.uses for usage in usages)
+            self.written += written
+            self.flushes += 1
+            logger.debug(f"Wrote {written} uses of {len(usages)} quotes.")
+            return written
+
+    async def run(self) -> None:
+        """Flushes in the background until it is cancelled."""
+        while True:
+            self._wake = anyio.Event()
+            with anyio.move_on_after(self.interval):
+                await self._wake.wait()
+            await self.flush()
+
+    async def aclose(self) -> None:
+        """Writes the last pending uses, this should be called on shutdown."""
+        with anyio.CancelScope(shield=True):
+            await self.flush()